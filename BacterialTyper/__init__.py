@@ -1,6 +1,6 @@
-from pkg_resources import get_distribution
+from importlib import metadata
 try:
-	__version__ = get_distribution('BacterialTyper').version
+	__version__ = metadata.version('BacterialTyper')
 except:
 	try:
 		__version__ = pkg_resources.resorce_filename('BacterialTyper', VERSION)
@@ -19,7 +19,14 @@ __all__ = [
 	'report'
 ]
 
-from BacterialTyper import *
+## submodules are imported when first used (e.g. BacterialTyper.modules) so that
+## starting BacterialTyper does not load the dependencies of every module
+import importlib
+
+def __getattr__(name):
+	if name in __all__:
+		return importlib.import_module(__name__ + '.' + name)
+	raise AttributeError("module %r has no attribute %r" %(__name__, name))
 
 
 
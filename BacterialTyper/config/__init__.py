@@ -4,5 +4,11 @@ __all__ = [
         'install_dependencies'
 ]
 
-from BacterialTyper.config import *
+## import submodules when first used (see BacterialTyper/__init__.py)
+import importlib
+
+def __getattr__(name):
+    if name in __all__:
+        return importlib.import_module(__name__ + '.' + name)
+    raise AttributeError("module %r has no attribute %r" %(__name__, name))
 
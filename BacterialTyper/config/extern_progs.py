@@ -30,6 +30,9 @@ from BacterialTyper.scripts import functions
 from BacterialTyper.config import set_config
 from BacterialTyper.config import install_dependencies
 
+## dependencies information read within this process
+dependencies_info = {}
+
 ####################################################################
 def file_list(wanted_data):
 	"""
@@ -66,11 +69,14 @@ def read_dependencies():
 		- :func:`BacterialTyper.config.extern_progs.file_list`
 
 		- :func:`BacterialTyper.scripts.functions.get_data`	
-	"""
 
-	## read from file: prog2default.csv
-	dependencies_file = file_list("dependencies")
-	return(functions.get_data(dependencies_file, ',', 'index_col=0'))
+	File is only read once within each process.
+	"""
+	if not dependencies_info:
+		## read from file: prog2default.csv
+		dependencies_file = file_list("dependencies")
+		dependencies_info['df'] = functions.get_data(dependencies_file, ',', 'index_col=0')
+	return(dependencies_info['df'])
 
 #######################
 def return_defatult_soft(soft):
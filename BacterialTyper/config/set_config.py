@@ -15,6 +15,8 @@ Provides configuration for the pipeline.
 ## useful imports
 import os
 import re
+import json
+import threading
 import subprocess
 from termcolor import colored
 from distutils.version import LooseVersion
@@ -32,6 +34,16 @@ import HCGB.functions.aesthetics_functions as HCGB_aes
 ## Software
 ################
 
+## executables resolved within this process: (prog, environment variable, $PATH) -> (path, version)
+exe_cache = {}
+
+## versions retrieved for each binary, saved across executions. 
+## Entries are invalidated if the binary is modified (size or modification time).
+version_cache_file = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')),
+                                  'BacterialTyper', 'software_versions.json')
+version_cache = {}
+version_cache_lock = threading.Lock()
+
 ##################
 def get_exe(prog, Debug=False, Return_Version=False):
     """Return absolute path of the executable program requested.
@@ -59,7 +71,17 @@ def get_exe(prog, Debug=False, Return_Version=False):
 
         Give them credit accordingly.
 
+    Executables and versions are resolved once within each process (see :data:`exe_cache`) and 
+    versions are saved on disk for later executions (see :func:`BacterialTyper.config.set_config.get_version`).
     """
+    ## previously resolved
+    memo_key = (prog, os.environ.get(prog), os.environ.get("PATH"))
+    if memo_key in exe_cache:
+        if (Return_Version):
+            return (exe_cache[memo_key])
+        else:
+            return (exe_cache[memo_key][0])
+
     exe = ""
     if prog in os.environ: 
         exe = os.environ[prog] ## python environent variables
@@ -108,6 +130,7 @@ def get_exe(prog, Debug=False, Return_Version=False):
     ## no min version available
     if min_version == 'na':
         if exe_path_tmp:
+            exe_cache[memo_key] = (exe_path_tmp[0], '')
             if (Return_Version):
                 return (exe_path_tmp[0], '') ## return first item
             else:
@@ -140,6 +163,7 @@ def get_exe(prog, Debug=False, Return_Version=False):
         if LooseVersion(prog_ver) >= LooseVersion(min_version):
             if (Debug):
                 print (colored("** Debug: Version OK", 'yellow'))
+            exe_cache[memo_key] = (p, prog_ver)
             if (Return_Version):
                 return (p, prog_ver)
             else:
@@ -291,15 +315,97 @@ def get_version(prog, path, Debug=False):
         The code implemented here was retrieved and modified from ARIBA (https://github.com/sanger-pathogens/ariba)
 
         Give them credit accordingly.
+
+    Versions are saved in :data:`version_cache_file` for the binary path, size and modification 
+    time, so the software is only called again if modified (see :func:`BacterialTyper.config.set_config.call_version`).
     """
 
     ## read dependencies information
     dependencies_pd = extern_progs.read_dependencies()
 
     ## get information for prog
-    regex = re.compile(dependencies_pd.loc[prog, 'get_version'])
+    pattern = dependencies_pd.loc[prog, 'get_version']
     args = dependencies_pd.loc[prog, 'version_cmd']
 
+    ## check version saved for the same binary and command
+    try:
+        stat = os.stat(path)
+        stamp = "%s:%s:%s:%s" %(prog, path, stat.st_size, stat.st_mtime)
+    except OSError:
+        stamp = ""
+
+    with version_cache_lock:
+        entry = read_version_cache().get(stamp)
+    if entry and entry.get('get_version') == pattern and entry.get('version_cmd') == str(args):
+        if (Debug):
+            print(colored("** Debug: version for %s retrieved from %s" %(path, version_cache_file), 'yellow'))
+        return (entry['version'])
+
+    prog_ver = call_version(prog, path, pattern, args, Debug)
+
+    ## save if version retrieved
+    if stamp and prog_ver:
+        save_version_cache(stamp, {'version': prog_ver, 'get_version': pattern, 'version_cmd': str(args)})
+
+    return (prog_ver)
+
+##################
+def read_version_cache():
+    """Returns versions saved by previous executions in :data:`version_cache_file`. File is only read once."""
+    if not version_cache and os.path.isfile(version_cache_file):
+        try:
+            with open(version_cache_file) as fh:
+                version_cache.update(json.load(fh))
+        except (ValueError, OSError):
+            pass
+    return (version_cache)
+
+##################
+def save_version_cache(stamp, entry):
+    """Adds version retrieved for a binary in :data:`version_cache_file`.
+    
+    Entries saved meanwhile by other processes are kept and previous entries for the same binary removed. 
+    Errors are ignored as the file is only used to speed up checks.
+    """
+    with version_cache_lock:
+        version_cache[stamp] = entry
+        try:
+            if os.path.isfile(version_cache_file):
+                with open(version_cache_file) as fh:
+                    saved = json.load(fh)
+                saved.update(version_cache)
+                version_cache.update(saved)
+
+            ## binary modified: prog:path:size:mtime
+            for old_stamp in [key for key in version_cache if key != stamp and key.rsplit(':', 2)[0] == stamp.rsplit(':', 2)[0]]:
+                del version_cache[old_stamp]
+
+            os.makedirs(os.path.dirname(version_cache_file), exist_ok=True)
+            tmp_file = version_cache_file + '.tmp' + str(os.getpid())
+            with open(tmp_file, 'w') as fh:
+                json.dump(version_cache, fh, indent=2, sort_keys=True)
+            os.replace(tmp_file, version_cache_file)
+        except (ValueError, OSError):
+            pass
+
+##################
+def call_version(prog, path, pattern, args, Debug=False):
+    """Calls software to retrieve its version.
+
+    :param prog: Program name
+    :param path: Absolute path
+    :param pattern: Regular expression to retrieve version from software output (see *get_version* in :file:`BacterialTyper/config/software/dependencies.csv`)
+    :param args: Arguments to print version. Software is called without arguments if empty or ``''`` (e.g. bwa).
+    :param Debug: True/False
+
+    :returns: String containing version or empty string if not found.
+    """
+    regex = re.compile(pattern)
+
+    ## no arguments: '' in dependencies.csv
+    if not isinstance(args, str) or args.strip("'\"") == "":
+        args = ""
+
     ## debug messages
     if (Debug):
         print(colored("** Debug: regex: %s" %regex,'yellow'))
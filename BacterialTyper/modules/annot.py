@@ -9,13 +9,13 @@ Generates a functional assembly annotation and checks quality using BUSCO
 ## useful imports
 import time
 import os
-import concurrent.futures
 from termcolor import colored
 
 ## import my modules
 from BacterialTyper.scripts import annotation
 from BacterialTyper.modules import qc
 from BacterialTyper.scripts import multiQC_report
+from BacterialTyper.scripts import scheduler
 from BacterialTyper.modules import help_info
 from BacterialTyper import __version__ as pipeline_version
 
@@ -144,28 +144,15 @@ def run_annotation(options):
     print ("\t-Option: addmrna;  Add 'mRNA' features for each 'CDS' feature")
     print ("\t-Option: cdsrnaolap;  Allow [tr]RNA to overlap CDS")
 
-    ## optimize threads
-    name_list = set(pd_samples_retrieved["name"].tolist())
-    threads_job = HCGB_main.optimize_threads(options.threads, len(name_list)) ## threads optimization
-    max_workers_int = int(options.threads/threads_job)
-
     ## debug message
     if (Debug):
         print (colored("**DEBUG: options.threads " +  str(options.threads) + " **", 'yellow'))
-        print (colored("**DEBUG: max_workers " +  str(max_workers_int) + " **", 'yellow'))
-        print (colored("**DEBUG: cpu_here " +  str(threads_job) + " **", 'yellow'))
-
-    ## send for each sample
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers_int) as executor:
-        commandsSent = { executor.submit(annot_caller, row['sample'], outdir_dict[row['name']], options, row['name'], threads_job): index for index, row in pd_samples_retrieved.iterrows() }
-        for cmd2 in concurrent.futures.as_completed(commandsSent):
-            details = commandsSent[cmd2]
-            try:
-                data = cmd2.result()
-            except Exception as exc:
-                print ('***ERROR:')
-                print (cmd2)
-                print('%r generated an exception: %s' % (details, exc))
+
+    ## send for each sample: threads and memory according to Prokka profile
+    scheduler.run_batch('prokka', annot_caller, 
+                        { index: [row['sample'], outdir_dict[row['name']], options, row['name'], scheduler.THREADS] 
+                         for index, row in pd_samples_retrieved.iterrows() }, 
+                        options.threads, Debug)
 
     ## time stamp
     start_time_partial = HCGB_time.timestamp(start_time_total)
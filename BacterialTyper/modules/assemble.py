@@ -7,13 +7,13 @@
 ## useful imports
 import time
 import os
-import concurrent.futures
 from termcolor import colored
 import pandas as pd
-import shutil
 
 ## import my modules
 from BacterialTyper.scripts import spades_assembler
+from BacterialTyper.scripts import assembly_stats_caller
+from BacterialTyper.scripts import scheduler
 from BacterialTyper.modules import qc
 from BacterialTyper.modules import help_info
 from BacterialTyper import __version__ as pipeline_version
@@ -21,7 +21,6 @@ from BacterialTyper import __version__ as pipeline_version
 from HCGB import sampleParser
 import HCGB.functions.aesthetics_functions as HCGB_aes
 import HCGB.functions.time_functions as HCGB_time
-import HCGB.functions.main_functions as HCGB_main
 import HCGB.functions.files_functions as HCGB_files
 import HCGB.functions.info_functions as HCGB_info
 
@@ -29,6 +28,10 @@ import HCGB.functions.info_functions as HCGB_info
 global assembly_stats
 assembly_stats = {}
 
+## statistics generated for each assembly
+global assembly_stats_results
+assembly_stats_results = {}
+
 ####################################
 def run_assembly(options):
     """Main function of the assemble module.
@@ -143,37 +146,20 @@ def run_assembly(options):
     start_time_partial = start_time_total
     start_time_partial_assembly = start_time_partial
     
-    ## optimize threads
-    name_list = set(pd_samples_retrieved["name"].tolist())
-    threads_job = HCGB_main.optimize_threads(options.threads, len(name_list)) ## threads optimization
-    max_workers_int = int(options.threads/threads_job)
-
     ## debug message
     if (Debug):
         HCGB_aes.debug_message("options.threads: " + str(options.threads), "yellow")
-        HCGB_aes.debug_message("max_workers: " + str(max_workers_int), "yellow")
-        HCGB_aes.debug_message("cpu_here: " + str(threads_job), "yellow")
         
     # Group dataframe by sample name
     sample_frame = pd_samples_retrieved.groupby(["name"])
 
-    # We can use a with statement to ensure threads are cleaned up promptly
+    ## send for each sample: threads and memory according to SPADES profile
     print ('+ Running modules SPADES...')
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers_int) as executor:
-        ## send for each sample
-        commandsSent = { executor.submit( check_sample_assembly, 
-                                        name[0], outdir_dict[name[0]],  
-                                        sorted(cluster["sample"].tolist()), 
-                                        threads_job): name[0] for name, cluster in sample_frame }
-
-        for cmd2 in concurrent.futures.as_completed(commandsSent):
-            details = commandsSent[cmd2]
-            try:
-                data = cmd2.result()
-            except Exception as exc:
-                print ('***ERROR:')
-                print (cmd2)
-                print('%r generated an exception: %s' % (details, exc))
+    scheduler.run_batch('spades', check_sample_assembly, 
+                        { name[0]: [name[0], outdir_dict[name[0]], 
+                                    sorted(cluster["sample"].tolist()), 
+                                    scheduler.THREADS] for name, cluster in sample_frame }, 
+                        options.threads, Debug)
         
     ## functions.timestamp
     print ("\n+ Assembly of all samples finished: ")
@@ -189,7 +175,7 @@ def run_assembly(options):
             print (assembly_stats)
     
         ## create single file    
-        get_assembly_stats_all(assembly_stats, outdir_report, Debug)        
+        get_assembly_stats_all(assembly_stats, outdir_report, options.threads, Debug, assembly_stats_results)        
     
     ### symbolic links
     print ("+ Retrieve all genomes assembled...")
@@ -229,74 +215,53 @@ def run_assembly(options):
     return()
 
 ####################################
-def get_assembly_stats_all(assembly_stats_dict, outdir_report, debug):
+def get_assembly_stats_all(assembly_files, outdir_report, threads, debug, dict_stats=None):
+    """Generates a single summary of assembly statistics for all samples.
+    
+    Statistics for each assembly are reused if generated during the assembly, or generated in parallel
+    (or retrieved if previously generated) using :func:`BacterialTyper.scripts.assembly_stats_caller.assembly_stats_all` 
+    and saved in a single table (csv and excel) with a row per sample and sequence type.
+    
+    :param assembly_files: Dictionary containing sample name as keys and assembly fasta file as values.
+    :param outdir_report: Absolute path to report folder.
+    :param threads: Number of CPUs to use.
+    :param debug: Boolean for debugging messages
+    :param dict_stats: Dictionary containing sample name as keys and statistics generated during the assembly as values.
+    """
     ## get all assembly stats
     final_dir = HCGB_files.create_subfolder("assembly_stats", outdir_report)
-    final_sub_dir = HCGB_files.create_subfolder("samples", final_dir)
-    
-    #### summary and information
-    results_summary_toPrint_all = pd.DataFrame()        
-    column_names = ("Type", "Sample", "Total Sequences", "GC% Content", 
-                    "Longest sequence", "Shortest sequence", "Median length",
-                "Mean length", "Total Length (bp)",  "L10", "N10", "L20", 
-                "N20", "L30", "N30", "L40", "N40", "L50", "N50")
     
     ## debugging messages
     if debug:
         HCGB_aes.debug_message("Create assembly statistic for all samples")
         
-    for sample_name in assembly_stats:
-        excel_file_stats = assembly_stats[sample_name][1]
-        
-        if debug:
-            HCGB_aes.debug_message("sample_name: " + sample_name, 'yellow')
-            HCGB_aes.debug_message("excel: " + excel_file_stats, 'yellow')
-            HCGB_aes.debug_message("contig stats dictionary: ", 'yellow')
-            print (assembly_stats[sample_name][0]['Contig Stats'])
-            HCGB_aes.debug_message("scaffold stats dictionary: ", 'yellow')
-            print (assembly_stats[sample_name][0]['Scaffold Stats'])
-            
-        # get contig
-        contig_stats = pd.DataFrame.from_dict(assembly_stats[sample_name][0]['Contig Stats'], orient='index').transpose()
-        contig_stats['type'] = 'contigs'
-        contig_stats['sample_name'] = sample_name
-
-        # get scaffold
-        scaff_stats = pd.DataFrame.from_dict(assembly_stats[sample_name][0]['Scaffold Stats'], orient='index').transpose()
-        scaff_stats['type'] = 'scaffolds'
-        scaff_stats['sample_name'] = sample_name
-
-        ## copy individual excel file
-        shutil.copy(excel_file_stats, final_sub_dir)
+    ## sample: (assembly fasta, output name)
+    dict_files = { sample_name: (fasta_file, fasta_file.split(".fna")[0]) 
+                  for sample_name, fasta_file in assembly_files.items() }
+    results_summary_toPrint_all = assembly_stats_caller.assembly_stats_all(dict_files, threads, debug, dict_stats)
     
-        ## add all data
-        results_summary_toPrint_all = pd.concat([results_summary_toPrint_all, contig_stats, scaff_stats], ignore_index=True)
-
-    ## reorder columns
-    cols = results_summary_toPrint_all.columns.tolist()
-    cols = cols[-1:] + cols[:-1]
-    cols = cols[-1:] + cols[:-1]
-    results_summary_toPrint_all = results_summary_toPrint_all[cols]
+    if debug:
+        HCGB_aes.debug_message("results_summary_toPrint_all", "yellow")
+        print (results_summary_toPrint_all)
     
-    ## filter important columns        
-    #results_summary_toPrint_all = results_summary_toPrint_all.set_axis(column_names, 1)
+    ## save in csv
+    results_summary_toPrint_all.to_csv(os.path.join(final_dir, 'summary_stats.csv'), index=False)
     
     ## write to excel
     name_excel_summary = os.path.join(final_dir, 'summary_stats.xlsx')
-    
-    ## save in excel
     with pd.ExcelWriter(name_excel_summary, engine="xlsxwriter", engine_kwargs={"options": {"nan_inf_to_errors": True}}) as writer:
-        results_summary_toPrint_all.to_excel(writer)  
-    
+        results_summary_toPrint_all.to_excel(writer, index=False)  
     
+    print ("+ Assembly statistics for all samples saved in folder:\n\t%s" %final_dir)
 
 #############################################
 def check_sample_assembly(name, sample_folder, files, threads):
     """Checks if sample is assembled.
     
-    It checks whether a sample is assembled or not by reading file *sample_folder/.success_all*. 
+    It calls :func:`BacterialTyper.scripts.spades_assembler.run_module_assembly` to generate assembly for the sample speficied. 
     
-    If file not available (no previous assembly or not suceeded it) it calls :func:`BacterialTyper.scripts.spades_assembler.run_module_assembly` to generate assembly for the sample speficied.
+    The assembly is only generated again if reads, options or SPADES version changed since a previous assembly 
+    (see :mod:`BacterialTyper.scripts.result_cache`).
     
     :param name: Sample name or tag to identify sample.
     :param sample_folder:  directory to generate assembly ouptut. It must exist.
@@ -307,7 +272,7 @@ def check_sample_assembly(name, sample_folder, files, threads):
     :type files: list
     :type threads: integer
     
-    :return: Populates dictionary assembly_stats with assembly stats dictionary information
+    :return: Populates dictionary assembly_stats with the assembly fasta file and assembly_stats_results with its statistics
     :rtype: Dataframe
     
     .. seealso:: This function depends on other BacterialTyper and HCGB functions called:
@@ -315,36 +280,17 @@ def check_sample_assembly(name, sample_folder, files, threads):
         - :func:`BacterialTyper.scripts.spades_assembler.run_module_assembly`
     
     """
-    ## check if previously assembled and succeeded
-    filename_stamp = sample_folder + '/.success_all'
-    if os.path.isfile(filename_stamp):
-        stamp =    HCGB_time.read_time_stamp(filename_stamp)
-        print (colored("\tA previous command generated results on: %s [%s]" %(stamp, name), 'yellow'))
-        
-        ## Get information
-        stat_output = {
-            'Contig Stats': HCGB_main.file2dictionary(sample_folder + '/' + name + '_assembly-contigs.csv',','),
-            'Scaffold Stats': HCGB_main.file2dictionary(sample_folder + '/' + name + '_assembly-scaffolds.csv',',')
-        }
-                
-        ## populate main dictionary
-        assembly_stats[name] = [stat_output, sample_folder + '/' + name + '_assembly_stats.xlsx']
+    ## debug message
+    if (Debug):
+        HCGB_aes.debug_message("spades_assembler.run_module_assembly call:", "yellow")
+        print ("spades_assembler.run_module_assembly " + name + "\t" + sample_folder + "\t" + files[0] + "\t" + files[1] + "\t" +str(threads) + "\n")
 
-    else:
-    
-        ## debug message
-        if (Debug):
-            HCGB_aes.debug_message("spades_assembler.run_module_assembly call:", "yellow")
-            print ("spades_assembler.run_module_assembly " + name + "\t" + sample_folder + "\t" + files[0] + "\t" + files[1] + "\t" +str(threads) + "\n")
+    # Call spades_assembler: previous assembly is reused if available for the same reads
+    code = spades_assembler.run_module_assembly(name, sample_folder, files[0], files[1], threads)
     
-        # Call spades_assembler
-        code = spades_assembler.run_module_assembly(name, sample_folder, files[0], files[1], threads)
-        
-        if (code != 'FAIL'):
-            ## success stamps
-            filename_stamp = sample_folder + '/.success_all'
-            stamp =    HCGB_time.print_time_stamp(filename_stamp)
-            assembly_stats[name] = code # list containing dictionary of data and excel
-        else:
-            print("Some error occurred for sample %s while generating the assembly. " %name)
+    if (code != 'FAIL'):
+        assembly_stats[name] = code[1] # assembly fasta file
+        assembly_stats_results[name] = code[0] # assembly statistics
+    else:
+        print("Some error occurred for sample %s while generating the assembly. " %name)
 
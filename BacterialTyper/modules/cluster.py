@@ -145,23 +145,18 @@ def run_cluster(options):
         print (retrieve_databases)
 
     ## check if all samples in user_data or genbank are indexed
-    siglist_all = []
+    db_entries = {}
     for index, row in retrieve_databases.iterrows():
+        sigfile = None
         if not row['path'] == 'NaN':
             if (Debug):
                 HCGB_aes.print_sepLine("*",25, False)
                 print (row)
                 
             if all([ int(options.kmer_size) == int(row['ksize']), int(options.n_sketch) == int(row['num_sketch']) ]):
-                siglist_all.append(min_hash_caller.read_signature(row['path'], options.kmer_size))
-                continue
+                sigfile = row['path']
 
-        ## index assembly or reads...
-        (sigfile, siglist) = generate_sketch(row['folder'], row['original'], index, options.kmer_size, options.n_sketch, Debug)
-        retrieve_databases.loc[index]['path'] = sigfile
-        retrieve_databases.loc[index]['ksize'] = options.kmer_size
-        retrieve_databases.loc[index]['num_sketch'] = options.n_sketch
-        siglist_all.append(siglist)
+        db_entries[index] = (row['folder'], row['original'], sigfile)
     
     ### Cluster project samples
     print (colored("\n+ Collect project data", 'green'))
@@ -173,36 +168,45 @@ def run_cluster(options):
         print (colored("**DEBUG: pd_samples **", 'yellow'))
         print (pd_samples)
 
-    ## init dataframe for project data
-    colname = ["source", "name", "path", "original", "ksize", "num_sketch"]
-    pd_samples_sketched  = pd.DataFrame(columns = colname)
+    project_entries = {}
     for index, row in pd_samples.iterrows():
         if index in retrieve_databases.index:
             print (colored('\t+ Sketched signature (%s) available within user data...' %index, 'yellow'))
             continue
 
+        sigfile = None
         this_sig = outdir_dict[index] + '/' + index + '.sig'
         if os.path.exists(this_sig):
             ## File signature might exist
 
             ## read original
             file2print = outdir_dict[index] + '/.original'
-            if not os.path.exists(file2print):
-                original = ['NaN']
-            else:
+            if os.path.exists(file2print):
                 original = HCGB_main.readList_fromFile(file2print)
                 if all([ int(options.kmer_size) == int(original[1]), int(options.n_sketch) == int(original[2])]):
-                    siglist_all.append(min_hash_caller.read_signature(this_sig, options.kmer_size)) 
-                    pd_samples_sketched.loc[len(pd_samples_sketched)] = ('project_data', index, this_sig, row['sample'], options.kmer_size, options.n_sketch)
-                    print (colored('\t+ Sketched signature available (%s) in project folder...' %index, 'green'))
-                    continue            
-                    
-        print (colored('\t+ Sketched signature to be generated: (%s)...' %index, 'yellow'))
-        ## index assembly or reads...
-        (sigfile, siglist) = generate_sketch(outdir_dict[index], row['sample'], index, options.kmer_size, options.n_sketch, Debug)
-        pd_samples_sketched.loc[len(pd_samples_sketched)] = ('project_data', index, sigfile, row['sample'], options.kmer_size, options.n_sketch)
+                    sigfile = this_sig
+
+        project_entries[index] = (outdir_dict[index], row['sample'], sigfile)
+    
+    ## get signatures from store, previous files or sketch them
+    store_folder = os.path.join(os.path.abspath(options.database), 'mash_store')
+    signatures = collect_signatures({**db_entries, **project_entries}, store_folder, 
+                                    options.kmer_size, options.n_sketch, options.threads, Debug)
+    
+    siglist_all = []
+    for index, (sigfile, siglist) in signatures.items():
+        if index in db_entries:
+            retrieve_databases.loc[index, 'path'] = sigfile
+            retrieve_databases.loc[index, 'ksize'] = options.kmer_size
+            retrieve_databases.loc[index, 'num_sketch'] = options.n_sketch
         siglist_all.append(siglist)
-        
+
+    ## init dataframe for project data
+    colname = ["source", "name", "path", "original", "ksize", "num_sketch"]
+    pd_samples_sketched  = pd.DataFrame(columns = colname)
+    for index in project_entries:
+        if index in signatures:
+            pd_samples_sketched.loc[len(pd_samples_sketched)] = ('project_data', index, signatures[index][0], project_entries[index][1], options.kmer_size, options.n_sketch)
     
     ## remove any duplicated signature
     siglist_all = list(set(siglist_all))
@@ -271,16 +275,22 @@ def run_cluster(options):
     tag_cluster_info = final_dir + '/' + name
     print ('+ Saving results in folder: ', final_dir)
     print ('\tFile name: ', name)
-    (DataMatrix, labeltext) = min_hash_caller.compare(siglist_all, tag_cluster_info, Debug)
-
-    ## get colorLabels    
     
-    ## plot images
-    pdf = True
-    cluster_returned = min_hash_caller.plot(DataMatrix, labeltext, tag_cluster_info, pdf, colorLabels)
+    if options.nearest:
+        ## only closest database genomes for each project sample
+        get_nearest(signatures, project_entries, db_entries, retrieve_databases, 
+                    options, tag_cluster_info, Debug)
+    else:
+        ## reuse similarity values from previous run: only new samples are compared
+        previous_matrix = os.path.join(final_dir, '.previous_matrix.npz')
+        (DataMatrix, labeltext) = min_hash_caller.compare(siglist_all, tag_cluster_info, Debug, options.threads, previous_matrix)
     
-    ## generate newick tree 
-    min_hash_caller.get_Newick_tree(cluster_returned, DataMatrix, labeltext, tag_cluster_info)    
+        ## plot images
+        pdf = True
+        cluster_returned = min_hash_caller.plot(DataMatrix, labeltext, tag_cluster_info, pdf, colorLabels)
+        
+        ## generate newick tree 
+        min_hash_caller.get_Newick_tree(cluster_returned, DataMatrix, labeltext, tag_cluster_info)    
     
     print ("\n*************** Finish *******************")
     start_time_partial = HCGB_time.timestamp(start_time_total)
@@ -382,11 +392,94 @@ def get_options_db(options):
     return (pd_MASH)
 
 ############################################################    
-def generate_sketch(folder, assembly, entry, ksize, n_sketch, Debug):
+def get_nearest(signatures, project_entries, db_entries, retrieve_databases, options, output, Debug):
+    ##
+    ## Search the top-K closest database genomes (genbank/user_data) for each
+    ## project sample using an index of the database signatures, instead
+    ## of the all-vs-all comparison.
+    ##
+    query_siglist = [signatures[entry][1] for entry in project_entries if entry in signatures]
+    ref_siglist = [signatures[entry][1] for entry in db_entries if entry in signatures]
+    
+    if not query_siglist or not ref_siglist:
+        print (colored("** No project samples or database genomes available for nearest neighbour search. **", 'yellow'))
+        return ()
+    
+    print ("\n+ Searching %s closest database genomes for each sample..." %options.nearest)
+    store_folder = os.path.join(os.path.abspath(options.database), 'mash_store')
+    HCGB_files.create_folder(store_folder)
+    index_file = os.path.join(store_folder, 'nearest_k%s_n%s.npz' %(options.kmer_size, options.n_sketch))
+    results_df = min_hash_caller.nearest(query_siglist, ref_siglist, options.nearest, output, 
+                                         index_file, retrieve_databases['source'].to_dict())
 
-    (sigfile, siglist) = min_hash_caller.sketch_database({ entry: assembly }, folder, Debug, ksize, n_sketch)
-    #functions.print_sepLine("*",50, False)
+    ## debug message
+    if (Debug):
+        print (colored("**DEBUG: nearest results **", 'yellow'))
+        print (results_df)
+
+    return ()
+
+############################################################    
+def collect_signatures(dict_entries, store_folder, ksize, n_sketch, threads, Debug):
+    ##
+    ## Get a signature for each entry. dict_entries contains for each entry a tuple 
+    ## with the folder, sequence file and previous signature file (None if not valid).
+    ##
+    ## Signatures are retrieved from the signature store using the checksum of the 
+    ## sequence file, kmer size and sketch size, in a single read. Otherwise, previous 
+    ## signature files are read or new sketches generated, and added to the store.
+    ##
+    index_df = min_hash_caller.load_signature_store(store_folder)
+    lookup_table = min_hash_caller.store_lookup_table(index_df)
+    
+    store_keys = {}
+    to_store = {}
+    sketch_pending = {}
+    signatures = {}
+    for entry, (folder, seq_file, sigfile) in dict_entries.items():
+        if os.path.isfile(str(seq_file)):
+            (key, checksum, available) = min_hash_caller.store_lookup(lookup_table, seq_file, ksize, n_sketch)
+            if available:
+                print (colored('\t+ Sketched signature available (%s) in signature store...' %entry, 'green'))
+                store_keys[entry] = key
+                continue
+            to_store[entry] = (seq_file, checksum)
+
+        if sigfile:
+            print (colored('\t+ Sketched signature available (%s)...' %entry, 'green'))
+            signatures[entry] = (sigfile, min_hash_caller.read_signature(sigfile, ksize))
+        else:
+            print (colored('\t+ Sketched signature to be generated: (%s)...' %entry, 'yellow'))
+            sketch_pending[entry] = (folder, seq_file)
+
+    ## bulk read from store: signature file is written if not available, as it is reported 
+    ## later in the database and samples information
+    store_signatures = min_hash_caller.get_store_signatures(store_folder, index_df, store_keys)
+    for entry, sig in store_signatures.items():
+        (folder, seq_file, sigfile) = dict_entries[entry]
+        sigfile = folder + '/' + str(entry) + '.sig'
+        if not os.path.isfile(sigfile):
+            HCGB_files.create_folder(folder)
+            min_hash_caller.save_signature(sig, sigfile)
+            write_original(folder, seq_file, ksize, n_sketch)
+        signatures[entry] = (sigfile, sig)
+    
+    ## index assembly or reads...
+    if sketch_pending:
+        signatures.update(generate_sketch_all(sketch_pending, ksize, n_sketch, threads, Debug))
+
+    ## save new signatures in store
+    new_entries = { entry: (to_store[entry][0], to_store[entry][1], signatures[entry][1]) for entry in to_store if entry in signatures }
+    min_hash_caller.add_store_signatures(store_folder, index_df, new_entries, ksize, n_sketch)
     
+    ## debug message
+    if (Debug):
+        print (colored("**DEBUG: signatures from store: %s; new in store: %s **" %(len(store_keys), len(new_entries)), 'yellow'))
+    
+    return (signatures)
+
+############################################################    
+def write_original(folder, assembly, ksize, n_sketch):
     ## print original in file
     file2print = folder + '/.original'
     
@@ -396,6 +489,35 @@ def generate_sketch(folder, assembly, entry, ksize, n_sketch, Debug):
     
     list_fna = [assembly_tmp_path, str(ksize), str(n_sketch)]
     HCGB_main.printList2file(file2print, list_fna)
+
+############################################################    
+def generate_sketch(folder, assembly, entry, ksize, n_sketch, Debug):
+
+    (sigfile, siglist) = min_hash_caller.sketch_database({ entry: assembly }, folder, Debug, ksize, n_sketch)
+    #functions.print_sepLine("*",50, False)
+    
+    write_original(folder, assembly, ksize, n_sketch)
     return (sigfile[0], siglist[0])
 
+############################################################    
+def generate_sketch_all(dict_entries, ksize, n_sketch, threads, Debug):
+    ##
+    ## Sketch several entries in parallel. dict_entries contains for each
+    ## entry a tuple with the folder and assembly (or reads) file.
+    ## Each .original file is written as soon as its signature is saved,
+    ## so signatures finished before any crash are reused in the next run.
+    ##
+    dict_files = {}
+    dict_outfiles = {}
+    for entry, (folder, assembly) in dict_entries.items():
+        HCGB_files.create_folder(folder)
+        dict_files[entry] = assembly
+        dict_outfiles[entry] = folder + '/' + str(entry) + '.sig'
+    
+    def on_complete(entry, sigfile):
+        write_original(dict_entries[entry][0], dict_entries[entry][1], ksize, n_sketch)
+    
+    sketch_results = min_hash_caller.sketch_files(dict_files, dict_outfiles, Debug, ksize, n_sketch, threads, on_complete)
+    return (sketch_results)
+
     
@@ -87,6 +87,13 @@ def run_database(options):
     ## set some vars
     kma_bin = set_config.get_exe("kma")
 
+    ## KMA databases in shared memory
+    if options.kma_shm_status or options.kma_unload is not None:
+        if options.kma_unload is not None:
+            KMA_caller.unload_db(kma_bin, options.kma_unload)
+        KMA_caller.shm_status()
+        return ()
+
     ## create folder absolute
     options.path = os.path.abspath(options.path)    
     HCGB_files.create_folder(options.path)
@@ -116,7 +123,7 @@ def run_database(options):
                 ## get file information
                 print ("\t+ Obtaining information from file: %s" %abs_path_file)
                 strains2get = HCGB_main.get_data(abs_path_file, ',', '')
-                dataBase_NCBI = database_generator.NCBI_DB(strains2get, NCBI_folder, Debug)
+                dataBase_NCBI = database_generator.NCBI_DB(strains2get, NCBI_folder, Debug, options.threads, options.ncbi_mirror)
 
                 #########
                 if Debug:
@@ -9,24 +9,37 @@ Prints help messages for several modules and options.
 ## useful imports
 from termcolor import colored
 import os
+import importlib
+
+##########################
+class lazy_module():
+    """Module imported when any of its attributes is first used.
+    
+    All modules call :func:`help_info` at start, so scripts are only imported if their help message is requested.
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, attr):
+        return getattr(importlib.import_module(self.name), attr)
 
 ## import my modules
-from BacterialTyper.scripts import bacteriophage
-from BacterialTyper.modules import MGE
+bacteriophage = lazy_module('BacterialTyper.scripts.bacteriophage')
+MGE = lazy_module('BacterialTyper.modules.MGE')
 
-from BacterialTyper.scripts import variant_calling
-from BacterialTyper.scripts import genomic_island
-from BacterialTyper.scripts import BUSCO_caller
-from BacterialTyper.scripts import multiQC_report
-from BacterialTyper.scripts import annotation
-from BacterialTyper.scripts import ariba_caller
-from BacterialTyper.scripts import min_hash_caller
-from BacterialTyper.scripts import trimmomatic_call
-from BacterialTyper.scripts import KMA_caller
-from BacterialTyper.scripts import kraken2_caller
-from BacterialTyper.scripts import MLST_caller
-from BacterialTyper.scripts import amrfinder_caller
-from BacterialTyper.report.Staphylococcus import get_spa_typing
+variant_calling = lazy_module('BacterialTyper.scripts.variant_calling')
+genomic_island = lazy_module('BacterialTyper.scripts.genomic_island')
+BUSCO_caller = lazy_module('BacterialTyper.scripts.BUSCO_caller')
+multiQC_report = lazy_module('BacterialTyper.scripts.multiQC_report')
+annotation = lazy_module('BacterialTyper.scripts.annotation')
+ariba_caller = lazy_module('BacterialTyper.scripts.ariba_caller')
+min_hash_caller = lazy_module('BacterialTyper.scripts.min_hash_caller')
+trimmomatic_call = lazy_module('BacterialTyper.scripts.trimmomatic_call')
+KMA_caller = lazy_module('BacterialTyper.scripts.KMA_caller')
+kraken2_caller = lazy_module('BacterialTyper.scripts.kraken2_caller')
+MLST_caller = lazy_module('BacterialTyper.scripts.MLST_caller')
+amrfinder_caller = lazy_module('BacterialTyper.scripts.amrfinder_caller')
+get_spa_typing = lazy_module('BacterialTyper.report.Staphylococcus.get_spa_typing')
 from BacterialTyper import __version__ as pipeline_version
 
 import HCGB.functions.aesthetics_functions as HCGB_aes
@@ -10,7 +10,7 @@ Looks for similar entries on GenBank and retrieves them.
 ## useful imports
 import time
 import os
-import concurrent.futures
+import math
 from termcolor import colored
 import pandas as pd
 import pprint
@@ -24,9 +24,10 @@ from BacterialTyper.scripts import edirect_caller
 from BacterialTyper.modules import help_info
 from BacterialTyper.config import set_config
 from BacterialTyper.scripts import database_user
+from BacterialTyper.scripts import scheduler
+from BacterialTyper.scripts import project_index
 from BacterialTyper import __version__ as pipeline_version
 
-from HCGB import sampleParser
 import HCGB.functions.aesthetics_functions as HCGB_aes
 import HCGB.functions.time_functions as HCGB_time
 import HCGB.functions.main_functions as HCGB_main
@@ -237,7 +238,7 @@ def run_ident(options):
         ## Flag to identify from scratch using kraken2
 
         ######## Kraken2 identification
-        dataFrame_kraken = Kraken_ident(options, pd_samples_retrieved, outdir_dict, retrieve_databases, start_time_partial)
+        (dataFrame_kraken, bracken_results) = Kraken_ident(options, pd_samples_retrieved, outdir_dict, retrieve_databases, start_time_partial)
         
         ## functions.timestamp
         start_time_partial = HCGB_time.timestamp(start_time_partial)
@@ -367,8 +368,9 @@ def run_ident(options):
         HCGB_main.print_all_pandaDF(sample_results_summary)
     
     ## init some variables
-    bracken_results = pd.DataFrame()
     results_summary_KMA = pd.DataFrame()
+    if options.kraken2:
+        bracken_samples = dict(tuple(bracken_results.groupby('sample', observed=True)))
 
     ###########################################################################
     ## Loop for each sample and save results in ident/samples folder generated
@@ -403,12 +405,8 @@ def run_ident(options):
             elif options.kraken2:
             ###########################################################################
                 
-                bracken_df = pd.read_csv(grouped['sample'], sep="\t")
-                bracken_df['name'] = grouped['name_sample']
-                bracken_results = pd.concat([bracken_results, bracken_df])
-    
                 ## print kraken2/bracken results in xlsx format
-                bracken_df.to_excel(writer_sample, sheet_name="Kraken2") ## write excel handle
+                bracken_samples.get(name, bracken_results.iloc[0:0]).to_excel(writer_sample, sheet_name="Kraken2") ## write excel handle
                 ## kraken already saves species name in .species file                
                 
                 
@@ -457,9 +455,11 @@ def run_ident(options):
         ###
         elif options.kraken2:
             
-            ## read ecah bracken file and create merge dataframe
+            ## bracken results of all samples and species identified
             print()
             bracken_results.to_excel(writer, sheet_name='Kraken2')
+            dataFrame_MLST[['name', 'species_id', 'fraction', 'taxa', 
+                            'multi_isolate', 'contamination', 'mlst']].to_excel(writer, sheet_name='Kraken2_species')
             
             
         else:
@@ -495,7 +495,7 @@ def run_ident(options):
         data2download = dataFrame_edirect.filter(['genus','species', 'strain', 'genome'])
         data2download = data2download.rename(columns={'genome': 'NCBI_assembly_ID', 'strain' : 'name'})
         NCBI_folder = os.path.abspath(options.database) + '/NCBI'
-        database_generator.NCBI_DB(data2download, NCBI_folder, Debug)
+        database_generator.NCBI_DB(data2download, NCBI_folder, Debug, options.threads)
 
     else:
         print ("+ No update of the database has been requested [Default]. Use option --slow instead")
@@ -597,60 +597,35 @@ def KMA_ident(options, pd_samples_retrieved, outdir_dict, retrieve_databases, ti
     results_summary = pd.DataFrame()
 #    return results_summary
 
-    ## optimize threads
-    name_list = set(pd_samples_retrieved.index)
-    threads_job = HCGB_main.optimize_threads(options.threads, len(name_list)) ## threads optimization
-    max_workers_int = int(options.threads/threads_job)
-
     ## debug message
     if (Debug):
         print (colored("**DEBUG: options.threads " +  str(options.threads) + " **", 'yellow'))
-        print (colored("**DEBUG: max_workers " +  str(max_workers_int) + " **", 'yellow'))
-        print (colored("**DEBUG: cpu_here " +  str(threads_job) + " **", 'yellow'))
 
     # Group dataframe by sample name
     sample_frame = pd_samples_retrieved.groupby(["name_sample"])
     
     ## send for each sample
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers_int) as executor:
-        for db2use in databases2use:
-            try:
-                print ("+ Removing database from memory...")
-                return_code_rm = KMA_caller.remove_db(kma_bin, db2use)
-            except:
-                pass
-            
-            
-            ## load database on memory
-            print ("+ Loading database on memory for faster identification.")
-            return_code_load = KMA_caller.load_db(kma_bin, db2use)
-            
-            print ("+ Sending jobs for species identification.")
-            ## send for each sample
-            commandsSent = { executor.submit(send_kma_job, 
-                                            outdir_dict[name[0]], 
-                                            sorted(cluster[ cluster['ext']=='fastq']["sample"].tolist()), 
-                                            name[0], db2use, threads_job, Debug): name[0] for name, cluster in sample_frame }
-
-            for cmd2 in concurrent.futures.as_completed(commandsSent):
-                details = commandsSent[cmd2]
-                try:
-                    data = cmd2.result()
-                except Exception as exc:
-                    print ('***ERROR:')
-                    print (cmd2)
-                    print('%r generated an exception: %s' % (details, exc))
-
-            ## remove database from memory
-            print ("+ Removing database from memory...")
-            return_code_rm = KMA_caller.remove_db(kma_bin, db2use)
-            
-            if (return_code_rm == 'FAIL'):
-                cmd_rm_db = "kma shm -t_db %s -shmLvl 1 -destroy" %db2use
-                print (colored("***ERROR: Removing database from memory failed. Please do it manually! Execute command: %s" %cmd_rm_db,'red'))
+    for db2use in databases2use:
+        ## load database on memory or attach to database already loaded by previous calls
+        return_code_load = KMA_caller.attach_db(kma_bin, db2use, options.kma_keep_loaded, Debug)
         
-            ## functions.timestamp
-            time_partial = HCGB_time.timestamp(time_partial)
+        print ("+ Sending jobs for species identification.")
+        ## send for each sample: database is shared in memory, threads according to KMA profile
+        scheduler.run_batch('kma', send_kma_job, 
+                            { name[0]: [outdir_dict[name[0]], 
+                                        sorted(cluster[ cluster['ext']=='fastq']["sample"].tolist()), 
+                                        name[0], db2use, scheduler.THREADS, Debug] for name, cluster in sample_frame }, 
+                            options.threads, Debug)
+
+        ## remove database from memory if no other process is using it
+        return_code_rm = KMA_caller.detach_db(kma_bin, db2use)
+        
+        if (return_code_rm == 'FAIL'):
+            cmd_rm_db = "kma shm -t_db %s -shmLvl 1 -destroy" %db2use
+            print (colored("***ERROR: Removing database from memory failed. Please do it manually! Execute command: %s" %cmd_rm_db,'red'))
+    
+        ## functions.timestamp
+        time_partial = HCGB_time.timestamp(time_partial)
         
     ## parse results        
     print ("+ KMA identification call finished for all samples...")
@@ -857,7 +832,7 @@ def edirect_ident(dataFrame, outdir_dict, Debug):
     
         - :func:`BacterialTyper.scripts.functions.print_time_stamp`
 
-        - :func:`BacterialTyper.scripts.functions.optimize_threads`
+        - :func:`BacterialTyper.scripts.scheduler.run_batch`
     
         - :func:`BacterialTyper.scripts.functions.create_subfolder`
     
@@ -1045,43 +1020,57 @@ def MLST_ident(options, dataFrame, dataFrame_species, outdir_dict, time_partial)
     ## Start identification of samples
     print ("\n+ Send MLST identification jobs...")
     
-    ## optimize threads
-    name_list = set(subset_Df.index)
-    threads_job = HCGB_main.optimize_threads(options.threads, len(name_list)) ## threads optimization
-    max_workers_int = int(options.threads/threads_job)
-     
     ## debug message
     if (Debug):
         print (colored("**DEBUG: options.threads " +  str(options.threads) + " **", 'yellow'))
-        print (colored("**DEBUG: max_workers " +  str(max_workers_int) + " **", 'yellow'))
-        print (colored("**DEBUG: cpu_here " +  str(threads_job) + " **", 'yellow'))
     
+    ## scheme for each sample validated against schemes available, so mlst is not called 
+    ## again if the name provided is not correct (e.g. mtuberculosis: mtuberculosis_2)
+    name_column = 'name' if 'name' in dataFrame_species.columns else 'sample'
+    schemes = {}
+    for name, mlst2use in zip(dataFrame_species[name_column], dataFrame_species['mlst']):
+        schemes[name] = MLST_caller.resolve_scheme(mlst2use, mlst_profile_dict)
+        if mlst2use and schemes[name] != mlst2use:
+            print (colored("\t- MLST scheme for sample %s: %s -> %s" %(name, mlst2use, schemes[name] or 'automatic detection'), 'yellow'))
+    
+    ## group samples by scheme: a single mlst call for each batch of samples
+    samples_scheme = {}
+    for index, row in subset_Df.iterrows():
+        scheme = schemes.get(row['name_sample'], "")
+        samples_scheme.setdefault(scheme, {})[row['name_sample']] = (outdir_dict[row['name_sample']], row['sample'])
+    
+    ## built-in allele caller: samples with a scheme are typed in a process pool
+    if options.mlst_engine == 'native':
+        for scheme in [ scheme for scheme in samples_scheme if scheme ]:
+            print ("+ Type %s samples using scheme %s" %(len(samples_scheme[scheme]), scheme))
+            MLST_caller.MLST_native(samples_scheme.pop(scheme), scheme, options.database, options.threads, 
+                                    minid=options.minid, mincov=options.mincov, debug=Debug)
+    
+    ## batches sized from threads available: as many batches as concurrent mlst jobs 
+    ## (threads/sweet spot), up to batch_size samples each
+    slots = max(1, options.threads // scheduler.tool_profiles['mlst'][1])
+    dict_batches = {}
+    for scheme, samples in samples_scheme.items():
+        names = list(samples)
+        size = max(1, min(MLST_caller.batch_size, math.ceil(len(names) / slots)))
+        for start in range(0, len(names), size):
+            dict_batches['%s_%s' %(scheme or 'auto', start)] = dict(samples = { name: samples[name] for name in names[start:start + size] },
+                                                                     mlst_profile = scheme,
+                                                                     threads = scheduler.THREADS,
+                                                                     minid=options.minid, 
+                                                                     mincov=options.mincov, 
+                                                                     minscore=options.minscore, 
+                                                                     debug=Debug)
     
-    ## send for each sample
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers_int) as executor:
-         ## send for each sample
-         commandsSent = { executor.submit(MLST_caller.MLST_call,
-                                          outfolder = outdir_dict[row['name_sample']],  ## outfolder
-                                          assembly_file = row['sample'],             ## assembly file
-                                          mlst_profile = dataFrame_species.loc[ dataFrame_species['name'] == row['name_sample'], 'mlst'].item(), 
-                                          sample_name = row['name_sample'],
-                                          minid=options.minid, 
-                                          mincov=options.mincov, 
-                                          minscore=options.minscore, 
-                                          debug=Debug): index for index, row in subset_Df.iterrows() }
-    
-         for cmd2 in concurrent.futures.as_completed(commandsSent):
-             details = commandsSent[cmd2]
-             try:
-                 data = cmd2.result()
-             except Exception as exc:
-                 print ('***ERROR:')
-                 print (cmd2)
-                 print(details)
-                 print('%r generated an exception: %s' % (details, exc))
-    
-         ## functions.timestamp
-         time_partial = HCGB_time.timestamp(time_partial)
+    ## debug message
+    if (Debug):
+        HCGB_aes.debug_message("MLST batches")
+        pprint.pprint({ batch: list(args['samples']) for batch, args in dict_batches.items() })
+    
+    scheduler.run_batch('mlst', MLST_caller.MLST_batch, dict_batches, options.threads, Debug)
+    
+    ## functions.timestamp
+    time_partial = HCGB_time.timestamp(time_partial)
 
 
     ## parse results and return
@@ -1337,67 +1326,43 @@ def Kraken_ident(options, dataFrame_samples, outdir_dict, retrieve_databases, ti
     ## Start identification of samples
     print ("\n+ Send Kraken2 identification jobs...")
     
-    ## optimize threads
-    name_list = set(dataFrame_samples.index)
-    threads_job = HCGB_main.optimize_threads(options.threads, len(name_list)) ## threads optimization
-    max_workers_int = int(options.threads/threads_job)
-
     ## debug message
     if (Debug):
         print (colored("**DEBUG: options.threads " +  str(options.threads) + " **", 'yellow'))
-        print (colored("**DEBUG: max_workers " +  str(max_workers_int) + " **", 'yellow'))
-        print (colored("**DEBUG: cpu_here " +  str(threads_job) + " **", 'yellow'))
 
     # Group dataframe by sample name
     sample_frame = dataFrame_samples.groupby(["name"])
     
-    # ## send for each sample
-    # with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers_int) as executor:
-    #      ## send for each sample
-    #      ## sample_name, read_files, threads_num, db_fold, outfolder, 
-    #      ## level_abundance="S", thres_count = 50, hit_groups=3, others="", debug=False
-         
-    #      commandsSent = { executor.submit(kraken2_caller.kraken_run_all,
-    #                      name[0],                                                       ## sample_name
-    #                      sorted(cluster[ cluster['ext']=='fastq']["sample"].tolist()),  ## read_files
-    #                      threads_job,                                                   ## threads                    
-    #                      databases2use[0],                                              ## database
-    #                      outdir_dict[name[0]],                                          ## outfolder
-    #                      options.kraken2_level,                                         ## level_abundance
-    #                      options.kraken2_read_count,                                    ## read threshold
-    #                      options.kraken2_hit_groups,                                    ## hit groups kraken2
-    #                      options.others_kraken2,                                        ## other options
-    #                      Debug): name[0] for name, cluster in sample_frame }
-
-    #      for cmd2 in concurrent.futures.as_completed(commandsSent):
-    #          details = commandsSent[cmd2]
-    #          try:
-    #              data = cmd2.result()
-    #          except Exception as exc:
-    #              print ('***ERROR:')
-    #              print (cmd2)
-    #              print('%r generated an exception: %s' % (details, exc))
-
-    #      ## functions.timestamp
-    #      time_partial = HCGB_time.timestamp(time_partial)
-
-    for name, cluster in sample_frame:
-        kraken2_caller.kraken_run_all( 
-                         name[0],                                                       ## sample_name
-                         sorted(cluster[ cluster['ext']=='fastq']["sample"].tolist()),  ## read_files
-                         options.threads,                                                   ## threads                    
-                         databases2use[0],                                              ## database
-                         outdir_dict[name[0]],                                          ## outfolder
-                         options.kraken2_level,                                         ## level_abundance
-                         options.kraken2_read_count,                                    ## read threshold
-                         options.kraken2_hit_groups,                                    ## hit groups kraken2
-                         options.others_kraken2,                                        ## other options
-                         Debug)
-
-        ## functions.timestamp
-        time_partial = HCGB_time.timestamp(time_partial)
-    
+    ## kraken2 jobs memory-map the database (--memory-mapping): it is read once into the page 
+    ## cache and shared by all jobs, so its size is only counted once within the memory available
+    max_memory = options.memory if options.memory else scheduler.available_memory()
+    size_db = kraken2_caller.db_size(databases2use[0])
+    if size_db < max_memory:
+        kraken2_caller.preload_db(databases2use[0], Debug)
+    else:
+        print (colored("** Kraken2 database (%.1f GB) does not fit in the memory available (%.1f GB): it will be read from disk by each job" %(size_db, max_memory), 'yellow'))
+    max_memory_jobs = max(kraken2_caller.job_memory, max_memory - size_db)
     
+    ## send for each sample
+    ## sample_name, read_files, threads_num, db_fold, outfolder, 
+    ## level_abundance="S", thres_count = 50, hit_groups=3, others="", debug=False
+    scheduler.run_batch('kraken2', kraken2_caller.kraken_run_all, 
+                        { name[0]: [name[0],                                                       ## sample_name
+                                    sorted(cluster[ cluster['ext']=='fastq']["sample"].tolist()),  ## read_files
+                                    scheduler.THREADS,                                             ## threads                    
+                                    databases2use[0],                                              ## database
+                                    outdir_dict[name[0]],                                          ## outfolder
+                                    options.kraken2_level,                                         ## level_abundance
+                                    options.kraken2_read_count,                                    ## read threshold
+                                    options.kraken2_hit_groups,                                    ## hit groups kraken2
+                                    options.others_kraken2,                                        ## other options
+                                    Debug,                                                         ## debug
+                                    options.kraken2_output] for name, cluster in sample_frame }, 
+                        options.threads, Debug, max_memory=max_memory_jobs, 
+                        memory=kraken2_caller.job_memory, max_jobs=options.kraken2_jobs)
+
+    ## functions.timestamp
+    time_partial = HCGB_time.timestamp(time_partial)
     
     ## parse results        
     print ("+ Kraken2 identification call finished for all samples...")
@@ -1405,7 +1370,7 @@ def Kraken_ident(options, dataFrame_samples, outdir_dict, retrieve_databases, ti
     
     ## parse results and generate summary file
     results_summary = pd.DataFrame()
-    pd_samples_bracken = sampleParser.files.get_files(options, options.input, "ident", ["bracken"], options.debug)
+    pd_samples_bracken = project_index.get_files(options, options.input, "ident", ["bracken"], options.debug)
 
     ## debug message
     if (Debug):
@@ -1413,34 +1378,39 @@ def Kraken_ident(options, dataFrame_samples, outdir_dict, retrieve_databases, ti
         HCGB_main.print_all_pandaDF(pd_samples_bracken)
 
 
-    ## 
-    mlst_profile_dict = MLST_caller.get_MLST_profiles()
-    pd_samples_bracken['species_id'] = ""
-    pd_samples_bracken['mlst'] = ""
-
+    ## read all bracken results in a single table and call species for all samples at once
     print("+ Parsing kraken2/bracken results")
-    for i in range( len(pd_samples_bracken) ):
-        print("Sample: " + pd_samples_bracken.loc[i, "name"])
-        try:
-            species2use = kraken2_caller.parse_results(bracken_res= pd_samples_bracken.loc[i, "sample"], 
-                                     folder = os.path.dirname(pd_samples_bracken.loc[i, "sample"]), cut_off=0.90)
-        except:
-            HCGB_aes.error_message("Parsing error for Kraken output")
-            print(pd_samples_bracken.loc[i])
-            HCGB_aes.raise_and_exit("")
-
-        print("\tSpecies: " + species2use)
-
-        pd_samples_bracken.loc[i, "species_id"] = species2use
-        species2use_list = species2use.split(" ")
-        mlst2use = (species2use_list[0][0] + species2use_list[1]).lower()
-        print("\tMLST profile: " + mlst2use)
-        try:
-            if mlst_profile_dict[mlst2use]:
-                print(colored("\t- Species name matches MLST available: OK", 'green'))
-                pd_samples_bracken.loc[i, "mlst"] = mlst2use
-
-        except:
+    try:
+        bracken_results = kraken2_caller.read_bracken(dict(zip(pd_samples_bracken['name'], pd_samples_bracken['sample'])))
+    except Exception as error:
+        HCGB_aes.error_message("Parsing error for Kraken output: %s" %error)
+        HCGB_aes.raise_and_exit("")
+    
+    species_calls = kraken2_caller.species_calls(bracken_results, cut_off=0.90)
+    pd_samples_bracken = pd_samples_bracken.join(species_calls, on='name')
+    
+    ## MLST profile: first letter of genus and species name (e.g. Staphylococcus aureus: saureus)
+    mlst_profile_dict = MLST_caller.get_MLST_profiles()
+    mlst_names = pd_samples_bracken['species_id'].str.extract(r'^(\S)\S*\s+(\S+)')
+    mlst2use = (mlst_names[0] + mlst_names[1]).str.lower()
+    pd_samples_bracken['mlst'] = mlst2use.where(mlst2use.isin(list(mlst_profile_dict)), "")
+    
+    for index, row in pd_samples_bracken.iterrows():
+        kraken2_caller.write_species(os.path.dirname(row['sample']), row['species_id'])
+        print("Sample: " + row['name'])
+        print("\tSpecies: %s [%.2f%% reads]" %(row['species_id'] if row['species_id'] else "not identified", 100*row['fraction']))
+        if row['multi_isolate'] or row['contamination']:
+            HCGB_aes.warning_message("Sample %s: %s taxa above contamination threshold" %(row['name'], row['taxa']))
+        
+        if not row['species_id']:
+            HCGB_aes.error_message("No species above %s%% of reads" %(100*0.90))
+            HCGB_aes.warning_message("This sample will not be processed in the MLST analysis")
+            continue
+        
+        print("\tMLST profile: " + str(mlst2use[index]))
+        if row['mlst']:
+            print(colored("\t- Species name matches MLST available: OK", 'green'))
+        else:
             print("\n")
             HCGB_aes.error_message("MLST provided is not available")
             HCGB_aes.warning_message("This sample will not be processed in the MLST analysis")
@@ -1450,5 +1420,5 @@ def Kraken_ident(options, dataFrame_samples, outdir_dict, retrieve_databases, ti
         HCGB_aes.debug_message("pd_samples_bracken")
         HCGB_main.print_all_pandaDF(pd_samples_bracken)
     
-    return pd_samples_bracken
+    return (pd_samples_bracken, bracken_results)
     
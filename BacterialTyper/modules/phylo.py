@@ -12,7 +12,6 @@ import io
 import os
 import re
 import sys
-import concurrent.futures
 from termcolor import colored
 import pandas as pd
 
@@ -22,6 +21,7 @@ from BacterialTyper.scripts import database_generator
 from BacterialTyper.scripts import database_user
 from BacterialTyper.scripts import variant_calling
 from BacterialTyper.scripts import phylo_parser
+from BacterialTyper.scripts import scheduler
 from BacterialTyper.config import set_config
 from BacterialTyper import __version__ as pipeline_version
 
@@ -29,7 +29,6 @@ import HCGB
 from HCGB import sampleParser
 import HCGB.functions.aesthetics_functions as HCGB_aes
 import HCGB.functions.time_functions as HCGB_time
-import HCGB.functions.main_functions as HCGB_main
 import HCGB.functions.files_functions as HCGB_files
 import HCGB.functions.info_functions as HCGB_info
 
@@ -129,14 +128,23 @@ def run_phylo(options):
     
     countGaps = False
     aln_file = os.path.join(snippy_dir, options.name + '.aln')
-    phylo_parser.get_snp_distance(aln_file, options.output_format, countGaps, name_matrix, Debug)
+    
+    ## keep only polymorphic columns for distance and tree
+    compressed_aln = phylo_parser.variable_sites(aln_file, options.output_format, Debug)
+    phylo_parser.get_snp_distance(aln_file, options.output_format, countGaps, name_matrix, Debug, 
+                                  options.threads, variable_only=True)
     
     ## time stamp
     start_time_partial = HCGB_time.timestamp(start_time_total)
 
     ## phylogenetic analysis
     iqtree_output = HCGB_files.create_subfolder("iqtree", analysis_dir)
-    phylo_parser.ml_tree(snippy_dir, options.name, options.threads, iqtree_output, Debug)
+    if len(compressed_aln['positions']):
+        phylo_parser.ml_tree(snippy_dir, options.name, options.threads, iqtree_output, Debug, 
+                             compressed_aln['aln'], compressed_aln['fconst'])
+    else:
+        ## an alignment without variable sites is not informative and IQ-TREE fails
+        print (colored("** No variable sites in core alignment: samples are identical. Phylogenetic tree is not generated.", 'yellow'))
     
     ## time stamp
     start_time_partial = HCGB_files.timestamp(start_time_total)
@@ -242,16 +250,22 @@ def map_samples(options, reference_gbk_file, input_dir, outdir):
     ## for fastq samples
     ####################################
 
-    # optimize threads
-    name_list = set(pd_samples_retrieved_merge["name"].tolist())
-    threads_job = HCGB_main.optimize_threads(options.threads, len(name_list)) ## threads optimization
-    max_workers_int = int(options.threads/threads_job)
+    ## prepare reference once: shared by all samples
+    ref_fasta = None
+    if not contig_option:
+        print ("\n+ Prepare reference for mapping:")
+        reference_dir = HCGB_files.create_subfolder("reference", 
+                                HCGB_files.create_subfolder(options.name, 
+                                    HCGB_files.create_subfolder("phylo", 
+                                        HCGB_files.create_subfolder("report", outdir))))
+        ref_fasta = variant_calling.prepare_reference(reference_gbk_file, reference_dir, options.debug)
+        if not ref_fasta:
+            print (colored("** WARNING: Reference could not be indexed. Each sample would index it.", 'yellow'))
+            ref_fasta = None
 
     ## debug message
     if (options.debug):
         print (colored("**DEBUG: options.threads " +  str(options.threads) + " **", 'yellow'))
-        print (colored("**DEBUG: max_workers " +  str(max_workers_int) + " **", 'yellow'))
-        print (colored("**DEBUG: cpu_here " +  str(threads_job) + " **", 'yellow'))
 
     ## call snippy
     print ("\n+ Create mapping of fastq reads for project samples:")
@@ -259,20 +273,13 @@ def map_samples(options, reference_gbk_file, input_dir, outdir):
     # Group dataframe by sample name
     sample_frame = pd_samples_retrieved_merge.groupby(["name"])
     
-    ## send for each sample
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers_int) as executor:
-        commandsSent = { executor.submit(snippy_variant_caller, 
-                                         reference_gbk_file, sorted(cluster["sample"].tolist()), 
-                                         threads_job, outdir_dict[name[0]], options.name, 
-                                         contig_option, options.other_options, name[0], options.debug): name[0] for name, cluster in sample_frame }
-        for cmd2 in concurrent.futures.as_completed(commandsSent):
-            details = commandsSent[cmd2]
-            try:
-                data = cmd2.result()
-            except Exception as exc:
-                print ('***ERROR:')
-                print (cmd2)
-                print('%r generated an exception: %s' % (details, exc))
+    ## send for each sample: threads and memory according to snippy profile
+    scheduler.run_batch('snippy', snippy_variant_caller, 
+                        { name[0]: [reference_gbk_file, sorted(cluster["sample"].tolist()), 
+                                    scheduler.THREADS, outdir_dict[name[0]], options.name, 
+                                    contig_option, options.other_options, name[0], options.debug, 
+                                    ref_fasta] for name, cluster in sample_frame }, 
+                        options.threads, options.debug)
 
     ## subfolder within phylo for this mapping
     new_outdir_dict = {}
@@ -428,7 +435,7 @@ def get_reference_gbk(options):
     return (reference_gbk_file)
 
 #############################################
-def snippy_variant_caller(reference, files, threads, outdir, name, contig_option, other_options, sample_name, Debug):
+def snippy_variant_caller(reference, files, threads, outdir, name, contig_option, other_options, sample_name, Debug, ref_fasta=None):
     
     ## create subfolder within phylo for this mapping
     tag = sample_name + '_vs_' + name
@@ -441,9 +448,17 @@ def snippy_variant_caller(reference, files, threads, outdir, name, contig_option
         stamp = HCGB_time.read_time_stamp(filename_stamp)
         print (colored("\tA previous command generated results on: %s [%s]" %(stamp, tag), 'yellow'))
     else:
-         # Call variant calling
+        ## map reads to the shared reference index
+        bam_file = None
+        if ref_fasta and not contig_option:
+            bam_file = variant_calling.map_reads(ref_fasta, files, threads, subdir, sample_name, Debug)
+            if not bam_file:
+                print (colored("** WARNING: Mapping to shared reference failed [%s]. Using snippy mapping." %tag, 'yellow'))
+                bam_file = None
+        
+        # Call variant calling
         code = variant_calling.snippy_call(reference, files, threads, subdir, 
-                                           sample_name, contig_option, other_options, Debug)
+                                           sample_name, contig_option, other_options, Debug, bam_file)
         if code == 'OK':
             stamp = HCGB_time.print_time_stamp(filename_stamp)
 
@@ -10,7 +10,6 @@ Generates a resistance and virulence profile for each sample.
 ## useful imports
 import time
 import os
-import concurrent.futures
 from termcolor import colored
 import pandas as pd
 import shutil
@@ -25,11 +24,12 @@ from BacterialTyper.modules import help_info
 from BacterialTyper.scripts import database_user
 from BacterialTyper.scripts import amrfinder_caller
 from BacterialTyper.scripts import argnorm_caller
+from BacterialTyper.scripts import scheduler
+from BacterialTyper.scripts import project_index
 
 
 from BacterialTyper import __version__ as pipeline_version
 
-import HCGB.sampleParser as sampleParser
 import HCGB.functions.aesthetics_functions as HCGB_aes
 import HCGB.functions.time_functions as HCGB_time
 import HCGB.functions.main_functions as HCGB_main
@@ -378,51 +378,35 @@ def ARIBA_ident(options, pd_samples_retrieved, outdir_dict, retrieve_databases,
     if not (options.ARIBA_cutoff):
         options.ARIBA_cutoff = 0.90
 
-    ## optimize threads
-    name_list = set(pd_samples_retrieved["name_sample"].tolist())
-    threads_job = HCGB_main.optimize_threads(options.threads, len(name_list)) ## threads optimization
-    max_workers_int = int(options.threads/threads_job)
-
     ## debug message
     if (Debug):
         print (colored("**DEBUG: options.threads " +  str(options.threads) + " **", 'yellow'))
-        print (colored("**DEBUG: max_workers " +  str(max_workers_int) + " **", 'yellow'))
-        print (colored("**DEBUG: cpu_here " +  str(threads_job) + " **", 'yellow'))
 
     ## loop
     results_df = pd.DataFrame()
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers_int) as executor:
-        for db2use in databases2use:
-            print (colored("+ Working with database: " + db2use[1], 'yellow'))
-            ## send for each sample
-            commandsSent = { executor.submit(ariba_run_caller, 
-                                            db2use[0], db2use[1],                                 ## database path & dbname
-                                            sorted(cluster["sample"].tolist()),                   ## files
-                                            outdir_samples.loc[(name[0], db2use[1]), 'output'],   ## output
-                                            threads_job, options.ARIBA_cutoff): name[0] for name, cluster in sample_frame }
-                
-            for cmd2 in concurrent.futures.as_completed(commandsSent):
-                details = commandsSent[cmd2]
-                try:
-                    data = cmd2.result()
-                except Exception as exc:
-                    print ('***ERROR:')
-                    print (cmd2)
-                    print('%r generated an exception: %s' % (details, exc))
-            
-            print ("+ Jobs finished for database %s ..." %db2use[1])
+    for db2use in databases2use:
+        print (colored("+ Working with database: " + db2use[1], 'yellow'))
+        ## send for each sample: threads and memory according to ARIBA profile
+        scheduler.run_batch('ariba', ariba_run_caller, 
+                            { name[0]: [db2use[0], db2use[1],                                 ## database path & dbname
+                                        sorted(cluster["sample"].tolist()),                   ## files
+                                        outdir_samples.loc[(name[0], db2use[1]), 'output'],   ## output
+                                        scheduler.THREADS, options.ARIBA_cutoff] for name, cluster in sample_frame }, 
+                            options.threads, Debug)
+        
+        print ("+ Jobs finished for database %s ..." %db2use[1])
 
-            ## functions.timestamp
-            start_time_partial = HCGB_time.timestamp(start_time_partial)
-            
-            print()
-            print ("+ Collecting information for each sample analyzed for database: " + db2use[1])
-            ## check results for each database
-            results_df_tmp = virulence_resistance.check_results(db2use[1], outdir_samples, options.ARIBA_cutoff, card_trick_info)
-            results_df = pd.concat([results_df, results_df_tmp])
-                        
-            ## functions.timestamp
-            start_time_partial = HCGB_time.timestamp(start_time_partial)
+        ## functions.timestamp
+        start_time_partial = HCGB_time.timestamp(start_time_partial)
+        
+        print()
+        print ("+ Collecting information for each sample analyzed for database: " + db2use[1])
+        ## check results for each database
+        results_df_tmp = virulence_resistance.check_results(db2use[1], outdir_samples, options.ARIBA_cutoff, card_trick_info)
+        results_df = pd.concat([results_df, results_df_tmp])
+                    
+        ## functions.timestamp
+        start_time_partial = HCGB_time.timestamp(start_time_partial)
 
     ######################################################
     ## Generate final report for all samples
@@ -613,38 +597,20 @@ def AMRfinder_ident(options, samples_retrieved, out_dict, retrieve_db, start_tim
     ## send for each sample
     ######################################################
     
-    ## optimize threads
-    #name_list = set(samples_retrieved.index)
-    name_list = set(samples_retrieved["name_sample"].tolist())
-    threads_job = HCGB_main.optimize_threads(options.threads, len(name_list)) ## threads optimization
-    max_workers_int = int(options.threads/threads_job)
-
     ## debug message
     if (Debug):
         print (colored("**DEBUG: options.threads " +  str(options.threads) + " **", 'yellow'))
-        print (colored("**DEBUG: max_workers " +  str(max_workers_int) + " **", 'yellow'))
-        print (colored("**DEBUG: cpu_here " +  str(threads_job) + " **", 'yellow'))
-
-    ## send job for each sample
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers_int) as executor:
-        ## send for each sample:
-        ## amrfinder_caller(sample_name, protein_file, gff_file, nuc_file, threads_num, db_fold, outfile, others)
-        commandsSent = { executor.submit(amr_run_caller, 
-                                         databases2use[0][1],                         ## database path & dbname
-                                         cluster,                           ## dataframe with information
-                                         out_dict[name_tuple[0]],                 ## output
-                                         threads_job, options,
-                                         name_tuple[0],
-                                         Debug): name_tuple[0] for name_tuple, cluster in sample_frame }
-             
-        for cmd2 in concurrent.futures.as_completed(commandsSent):
-            details = commandsSent[cmd2]
-            try:
-                data = cmd2.result()
-            except Exception as exc:
-                print ('***ERROR:')
-                print (cmd2)
-                print('%r generated an exception: %s' % (details, exc))
+
+    ## send job for each sample: threads and memory according to AMRfinder profile
+    ## amrfinder_caller(sample_name, protein_file, gff_file, nuc_file, threads_num, db_fold, outfile, others)
+    scheduler.run_batch('amrfinder', amr_run_caller, 
+                        { name_tuple[0]: [databases2use[0][1],                         ## database path & dbname
+                                          cluster,                                     ## dataframe with information
+                                          out_dict[name_tuple[0]],                     ## output
+                                          scheduler.THREADS, options,
+                                          name_tuple[0],
+                                          Debug] for name_tuple, cluster in sample_frame }, 
+                        options.threads, Debug)
          
     # check results for each database
     print ("+ Collecting information for each sample analyzed for database")
@@ -667,7 +633,7 @@ def AMRfinder_ident(options, samples_retrieved, out_dict, retrieve_db, start_tim
         outdir = input_dir
 
     ## get output
-    pd_samples_profile = sampleParser.files.get_files(options, input_dir, "profile", ["tsv"], options.debug)
+    pd_samples_profile = project_index.get_files(options, input_dir, "profile", ["tsv"], options.debug)
     
     ## debug message
     if (Debug):
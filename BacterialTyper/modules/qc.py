@@ -9,7 +9,6 @@ Generates sample quality control at raw reads, assembly or annotation level.
 ## useful imports
 import time
 import os
-import concurrent.futures
 import pandas as pd
 from termcolor import colored
 
@@ -17,6 +16,7 @@ from termcolor import colored
 from BacterialTyper.scripts import fastqc_caller
 from BacterialTyper.scripts import multiQC_report
 from BacterialTyper.scripts import BUSCO_caller
+from BacterialTyper.scripts import scheduler
 from BacterialTyper.modules import help_info
 from BacterialTyper import __version__ as pipeline_version
 
@@ -199,30 +199,16 @@ def fastqc(pd_samples_retrieved, outdir, options, start_time_total, name_analysi
     # Group dataframe by sample name
     sample_frame = pd_samples_retrieved.groupby(["name"])
 
-    ## optimize threads
-    name_list = set(pd_samples_retrieved["name"].tolist())
-    threads_job = HCGB_main.optimize_threads(options.threads, len(name_list)) ## threads optimization
-    max_workers_int = int(options.threads/threads_job)
-
     ## debug message
     if (Debug):
         HCGB_aes.debug_message("options.threads: " + str(options.threads), "yellow")
-        HCGB_aes.debug_message("max_workers: " + str(max_workers_int), "yellow")
-        HCGB_aes.debug_message("threads_job: " + str(threads_job), "yellow")
 
-    ## send for each sample
+    ## send for each sample: threads and memory according to FASTQC profile
     print ("+ Calling fastqc for samples...")    
-    with concurrent.futures.ThreadPoolExecutor(max_workers=int(max_workers_int)) as executor:
-        commandsSent = { executor.submit(fastqc_caller.run_module_fastqc, outdir_dict[name[0]], sorted( cluster["sample"].tolist() ), name[0], threads_job): name[0] for name, cluster in sample_frame }
-        
-        for cmd2 in concurrent.futures.as_completed(commandsSent):
-            details = commandsSent[cmd2]
-            try:
-                data = cmd2.result()
-            except Exception as exc:
-                print ('***ERROR:')
-                print (cmd2)
-                print('%r generated an exception: %s' % (details, exc))
+    scheduler.run_batch('fastqc', fastqc_caller.run_module_fastqc, 
+                        { name[0]: [outdir_dict[name[0]], sorted( cluster["sample"].tolist() ), name[0], scheduler.THREADS] 
+                         for name, cluster in sample_frame }, 
+                        options.threads, Debug)
 
     print ("+ FASTQC for samples has finished...")    
     
@@ -6,6 +6,11 @@
 """
 This module generates a uniq call of BacterialTyper to 
 any other module. It automates the analysis and process.
+
+Each module is called for each sample separately and samples advance 
+independently through the pipeline (e.g. a sample can be annotated while
+another is still being assembled) within the CPUs and memory provided. See 
+:func:`BacterialTyper.scripts.scheduler.run_graph` for details.
 """
 ## useful imports
 import time
@@ -13,24 +18,15 @@ import io
 import os
 import re
 import sys
+import copy
 import concurrent.futures
 from termcolor import colored
 import pandas as pd
 
 ## import my modules
 from BacterialTyper.config import set_config
-from BacterialTyper.modules import prep
-from BacterialTyper.modules import qc
-from BacterialTyper.modules import ident
-from BacterialTyper.modules import profile
-from BacterialTyper.modules import database
-from BacterialTyper.modules import MGE
-from BacterialTyper.modules import cluster
-from BacterialTyper.modules import assemble
-from BacterialTyper.modules import annot
-from BacterialTyper.modules import database
-from BacterialTyper.modules import trim
-from BacterialTyper.modules import report_generation
+from BacterialTyper.scripts import scheduler
+## modules are called in separate processes (see call_module): no need to import them here
 from BacterialTyper.modules import help_info
 from BacterialTyper import __version__ as pipeline_version
 
@@ -39,6 +35,35 @@ import HCGB.functions.aesthetics_functions as HCGB_aes
 import HCGB.functions.time_functions as HCGB_time
 import HCGB.functions.main_functions as HCGB_main
 import HCGB.functions.files_functions as HCGB_files
+import HCGB.functions.system_call_functions as HCGB_sys
+
+## pipeline stages:
+## name: (BacterialTyper module, default arguments, dependencies, threads, memory (GB), weight, per sample)
+## threads and memory for each sample according to the main software profile (see scheduler.tool_profiles)
+pipeline_stages = {
+    'prep':     ('prep', '', [], 1, 1, 1, False),
+    'qc':       ('QC', '--raw_reads --skip_report', ['prep'], *scheduler.tool_profiles['fastqc'][1:], 1, True),
+    'trim':     ('trim', '--skip_report', ['prep'], *scheduler.tool_profiles['trimmomatic'][1:], 2, True),
+    'assemble': ('assemble', '-db {database} --skip_report', ['trim'], 8, scheduler.tool_profiles['spades'][2], 10, True),
+    'annot':    ('annot', '-db {database} --skip_report', ['assemble'], 4, scheduler.tool_profiles['prokka'][2], 4, True),
+    'ident':    ('ident', '-db {database} --kraken2', ['assemble'], 4, scheduler.tool_profiles['kraken2'][2], 3, True),
+    'profile':  ('profile', '-db {database}', ['annot'], *scheduler.tool_profiles['amrfinder'][1:], 2, True),
+    'MGE':      ('MGE', '-db {database} --all_data', ['annot'], 4, 4, 3, True),
+    'cluster':  ('cluster', '-db {database} --only_project_data', ['assemble'], 4, 4, 1, False),
+}
+
+## common options forwarded to each stage: only those defined by the module (see main/BacterialTyper)
+stage_flags = {
+    'prep':     ('single_end', 'include_lane', 'include_all', 'debug'),
+    'qc':       ('single_end', 'include_lane', 'include_all', 'debug'),
+    'trim':     ('single_end', 'include_lane', 'include_all', 'debug'),
+    'assemble': ('single_end', 'include_lane', 'include_all', 'debug'),
+    'annot':    ('debug',),
+    'ident':    ('single_end', 'include_lane', 'include_all', 'debug'),
+    'profile':  ('single_end', 'include_lane', 'include_all', 'debug'),
+    'MGE':      ('single_end', 'include_lane', 'include_all', 'debug'),
+    'cluster':  ('single_end', 'include_lane', 'include_all', 'debug'),
+}
 
 ####################################
 def run_BacterialTyper(options):
@@ -58,7 +83,8 @@ def run_BacterialTyper(options):
     ##################################
     
     ## if any help_flag provided will print and exit
-    help_info.help_info(options)
+    if (help_info.help_info(options) == 1):
+        raise SystemExit()
     
     ### 
     HCGB_aes.pipeline_header("BacterialTyper", ver=pipeline_version)
@@ -68,11 +94,182 @@ def run_BacterialTyper(options):
     HCGB_time.print_time()
 
     ## absolute path for in & out
-    input_dir = os.path.abspath(options.input)
-    outdir=""
+    options.input = os.path.abspath(options.input)
+    outdir = os.path.abspath(options.output_folder)
+    options.output_folder = outdir
+    options.database = os.path.abspath(options.database)
+
+    ## folders for information and logs
+    HCGB_files.create_folder(outdir)
+    run_dir = HCGB_files.create_subfolder("run", HCGB_files.create_subfolder("report", outdir))
+    log_dir = HCGB_files.create_subfolder("logs", run_dir)
+    sample_dir = HCGB_files.create_subfolder("samples", run_dir)
+    
+    ## stages to run
+    skip_stages = options.skip if options.skip else []
+    stages = [stage for stage in pipeline_stages if stage not in skip_stages]
+    module_options = get_module_options(options.module_options)
+    
+    ## print options
+    if (Debug):
+        HCGB_aes.print_argparse_dict(options)
+        HCGB_aes.debug_message("stages: " + str(stages), "yellow")
+        HCGB_aes.debug_message("module_options: " + str(module_options), "yellow")
+    
+    ## prepare samples before any other step
+    if 'prep' in stages:
+        print ("\n+ Prepare samples:")
+        code = call_module('prep', None, options, module_options, log_dir, options.threads)
+        if code == 'FAIL':
+            HCGB_aes.raise_and_exit("Preparation of samples failed. Check log file in folder: " + log_dir)
+        stages.remove('prep')
+    
+    ## get samples in project
+    options_project = copy.copy(options)
+    options_project.batch = False
+    options_project.pair = not options.single_end
+    pd_samples_retrieved = sampleParser.files.get_files(options_project, outdir, "fastq", 
+                                                        ["fastq", "fq", "fastq.gz", "fq.gz"], 
+                                                        options.debug)
+    sample_list = sorted(set(pd_samples_retrieved["name"].tolist()))
+    print ("+ Samples to analyze: %s" %len(sample_list))
+    
+    ## generate dependency graph
+    job_list = pipeline_graph(stages, sample_list, options, module_options, log_dir, sample_dir)
+    
+    ## run
+    print ("\n+ Run pipeline [%s jobs]:" %len(job_list))
+    results = scheduler.run_graph(job_list, options.threads, options.memory, Debug)
+    
+    ## summary
+    print ("\n+ Summary:")
+    df_results = pd.DataFrame([ job_name.split(':') + [status] for job_name, status in results.items() ],
+                              columns=['stage', 'sample', 'status'])
+    df_results.to_csv(os.path.join(run_dir, 'jobs_summary.csv'), index=False)
+    print (df_results.groupby(['stage', 'status'], sort=False).size().to_string())
+    print ("\n+ Log files are available in folder: " + log_dir)
+    
+    print ("\n*************** Finish *******************")
+    HCGB_time.timestamp(start_time_total)
+    print ("+ Exiting run module.")
+    return()
 
-    ## set mode: project/detached
-    if (options.project):
-        outdir = input_dir        
-    elif (options.detached):
-        outdir = os.path.abspath(options.output_folder)
+####################################
+def get_module_options(module_options_list):
+    """Parses additional options for each module provided as *stage=options*"""
+    module_options = {}
+    if not module_options_list:
+        return (module_options)
+    
+    for each in module_options_list:
+        if '=' not in each:
+            HCGB_aes.raise_and_exit("Module options must be provided as stage=options: " + each)
+        (stage, stage_options) = each.split('=', 1)
+        if stage not in pipeline_stages:
+            HCGB_aes.raise_and_exit("Stage %s not available. Options: %s" %(stage, ', '.join(pipeline_stages)))
+        module_options[stage] = stage_options
+    return (module_options)
+
+####################################
+def pipeline_graph(stages, sample_list, options, module_options, log_dir, sample_dir):
+    """Generates the list of jobs for the stages and samples provided.
+    
+    For each stage analyzed by sample, a job for each sample is generated that depends on 
+    the previous stage(s) of the same sample. A final job for the whole project is generated
+    to summarize results once all samples are finished. Stages analyzing all samples together 
+    (e.g. cluster) depend on all samples of the previous stage(s).
+    
+    :returns: List of :class:`BacterialTyper.scripts.scheduler.job`
+    """
+    ## generate file to include each sample
+    sample_files = {}
+    for sample in sample_list:
+        sample_files[sample] = os.path.join(sample_dir, sample + '.txt')
+        HCGB_main.printList2file(sample_files[sample], [sample])
+    
+    ## skipped stages are replaced by its dependencies
+    def get_deps(stage):
+        deps = []
+        for dep in pipeline_stages[stage][2]:
+            if dep in stages:
+                deps.append(dep)
+            elif dep in pipeline_stages:
+                deps.extend(get_deps(dep))
+        return (deps)
+    
+    job_list = []
+    for stage in stages:
+        (module, default_options, dependencies, threads, memory, weight, per_sample) = pipeline_stages[stage]
+        deps = get_deps(stage)
+        
+        if per_sample:
+            for sample in sample_list:
+                job_list.append(scheduler.job(stage + ':' + sample, call_module, 
+                                              [stage, sample_files[sample], options, module_options, log_dir],
+                                              threads, memory, [dep + ':' + sample for dep in deps], weight))
+            
+            ## summary for all samples
+            job_list.append(scheduler.job(stage + ':all', call_module, 
+                                          [stage, None, options, module_options, log_dir],
+                                          threads, memory, [stage + ':' + sample for sample in sample_list], 
+                                          1, allow_failed=True))
+        else:
+            deps_all = [dep + ':' + sample for dep in deps for sample in sample_list if pipeline_stages[dep][6]]
+            deps_all += [dep + ':all' for dep in deps if not pipeline_stages[dep][6]]
+            job_list.append(scheduler.job(stage + ':all', call_module, 
+                                          [stage, None, options, module_options, log_dir],
+                                          threads, memory, deps_all, weight))
+    
+    return (job_list)
+
+####################################
+def call_module(stage, sample_file, options, module_options, log_dir, threads):
+    """Calls BacterialTyper module for a sample (or all samples if no sample file provided).
+    
+    Each module is called as a separate process and output is saved in a log file.
+    """
+    (module, default_options, dependencies, threads_def, memory, weight, per_sample) = pipeline_stages[stage]
+    
+    ## BacterialTyper main script
+    bin_BacterialTyper = '%s %s' %(sys.executable, os.path.abspath(sys.argv[0]))
+    
+    ## input/output
+    if stage == 'prep':
+        in_out = '-i %s -o %s' %(options.input, options.output_folder)
+        if options.batch:
+            in_out += ' --batch'
+        if options.copy:
+            in_out += ' --copy'
+        if options.merge:
+            in_out += ' --merge'
+        if options.rename:
+            in_out += ' --rename ' + os.path.abspath(options.rename)
+        if options.in_sample:
+            in_out += ' --in_sample ' + os.path.abspath(options.in_sample)
+        if options.ex_sample:
+            in_out += ' --ex_sample ' + os.path.abspath(options.ex_sample)
+    else:
+        in_out = '-i %s' %options.output_folder
+        if sample_file:
+            in_out += ' --in_sample ' + sample_file
+    
+    ## common options
+    for flag in stage_flags[stage]:
+        if getattr(options, flag):
+            in_out += ' --' + flag
+    
+    ## module options: summary for all samples generates the report
+    if per_sample and not sample_file:
+        default_options = default_options.replace('--skip_report', '')
+    stage_options = default_options.format(database=options.database)
+    if stage in module_options:
+        stage_options = module_options[stage]
+        if '-db' not in stage_options and '{database}' in default_options:
+            stage_options += ' -db ' + options.database
+    
+    ## log
+    name = stage + '_' + (os.path.basename(sample_file).split('.txt')[0] if sample_file else 'all')
+    logFile = os.path.join(log_dir, name + '.log')
+    
+    cmd = '%s %s %s %s -t %s > %s 2>&1' %(bin_BacterialTyper, module, in_out, stage_options, threads, logFile)
+    return (HCGB_sys.system_call(cmd))
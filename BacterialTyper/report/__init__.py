@@ -4,4 +4,10 @@ __all__ = [
 	'retrieve_genes'
 ]
 
-from BacterialTyper.report import *
+## import submodules when first used (see BacterialTyper/__init__.py)
+import importlib
+
+def __getattr__(name):
+    if name in __all__:
+        return importlib.import_module(__name__ + '.' + name)
+    raise AttributeError("module %r has no attribute %r" %(__name__, name))
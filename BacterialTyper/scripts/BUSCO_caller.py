@@ -16,13 +16,13 @@ from termcolor import colored
 import concurrent.futures
 
 ## import my modules
-import HCGB.functions.time_functions as HCGB_time
 import HCGB.functions.system_call_functions as HCGB_sys
 import HCGB.functions.aesthetics_functions as HCGB_aes
 import HCGB.functions.files_functions as HCGB_files
 import HCGB.functions.main_functions as HCGB_main
 
 from BacterialTyper.config import set_config
+from BacterialTyper.scripts import result_cache
 from BacterialTyper import data
 
 ##############################
@@ -343,19 +343,20 @@ def BUSCO_call(datasets, pd_samples, database_folder, threads, mode, Debug=False
 def BUSCO_run(sample_name, fasta, threads, output_name, dataset_name, mode, busco_db):
 
     my_out_folder = os.path.join(output_name, dataset_name, 'run_' + dataset_name)
+    summary_file = os.path.join(my_out_folder, 'short_summary.txt')
     
-    ## timestamp
-    filename_stamp =  os.path.join(my_out_folder, '.success')
-
     print (colored("\tBUSCO Dataset [%s]; Sample [%s]" %(dataset_name, sample_name), 'yellow'))
         
-    ## check previous run
-    if os.path.isfile(filename_stamp):
-        timestamp = HCGB_time.read_time_stamp(filename_stamp)
-        print (colored("\tSuccessfully run on date: %s"  %timestamp, 'green'))
+    ## check previous run: same assembly, dataset, mode and version
+    (busco_bin, busco_version) = set_config.get_exe('busco', Return_Version=True)
+    step = 'busco_' + dataset_name
+    params = {'dataset': dataset_name, 'mode': mode}
+    if result_cache.check_step(output_name, step, [fasta], params, busco_version, 
+                               outputs=[summary_file], name=sample_name, 
+                               legacy_stamp=os.path.join(my_out_folder, '.success')):
+        return()
     else:
     
-        busco_bin = set_config.get_exe('busco')
         os.chdir(output_name)
         
         ## init cmd configuration
@@ -372,9 +373,9 @@ def BUSCO_run(sample_name, fasta, threads, output_name, dataset_name, mode, busc
         ## system call
         HCGB_sys.system_call(cmd)
         
-        if os.path.isfile(os.path.join(my_out_folder, 'short_summary.txt')):
-            ## timestamp
-            HCGB_time.print_time_stamp(filename_stamp)
+        if os.path.isfile(summary_file):
+            ## save step in manifest
+            result_cache.save_step(output_name, step, [fasta], params, busco_version, outputs=[summary_file])
         else:
             print (colored("BUSCO failed: Dataset [%s]; Sample [%s]" %(dataset_name, fasta), 'red'))
             return ('FAIL')
@@ -12,6 +12,13 @@ Check information here: https://cge.cbs.dtu.dk/services/KmerFinder/
 """
 ## useful imports
 import os
+import json
+import time
+import fcntl
+import socket
+import tempfile
+import contextlib
+import subprocess
 import pandas as pd
 from sys import argv
 from termcolor import colored
@@ -512,6 +519,218 @@ def remove_db(kma_bin, db2use):
     return_code_rm = HCGB_sys.system_call(cmd_rm_db)
     
     return(return_code_rm)
+
+########################
+#### SHARED MEMORY  ####
+########################
+## Databases loaded in shared memory are registered for each host and user, so that
+## several ident calls attach to them instead of loading them again. For each database:
+## {'loaded': date, 'stamp': database files, 'segments': {shmid: bytes}, 'users': [pid], 'keep': bool}
+shm_registry_file = os.path.join(os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir(), 
+                                 'BacterialTyper_kma_shm_%s_%s.json' %(socket.gethostname(), os.getuid()))
+
+##################################################
+@contextlib.contextmanager
+def shm_registry():
+    """Yields the registry of databases loaded in memory, locked for other processes, and saves it on exit."""
+    with open(shm_registry_file + '.lock', 'w') as fh_lock:
+        fcntl.flock(fh_lock, fcntl.LOCK_EX)
+        registry = {}
+        if os.path.isfile(shm_registry_file):
+            try:
+                with open(shm_registry_file) as fh:
+                    registry = json.load(fh)
+            except ValueError:
+                registry = {}
+
+        yield (registry)
+
+        tmp_file = shm_registry_file + '.tmp' + str(os.getpid())
+        with open(tmp_file, 'w') as fh:
+            json.dump(registry, fh, indent=2)
+        os.replace(tmp_file, shm_registry_file)
+
+##################################################
+def shm_segments():
+    """Returns dictionary with shmid and size (bytes) of the shared memory segments available or None if ipcs is not available."""
+    try:
+        output = subprocess.run(['ipcs', '-m'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, 
+                                universal_newlines=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return (None)
+
+    segments = {}
+    for line in output.splitlines():
+        fields = line.split()
+        ## key shmid owner perms bytes nattch status
+        if len(fields) >= 5 and fields[0].startswith('0x') and fields[4].isdigit():
+            segments[fields[1]] = int(fields[4])
+    return (segments)
+
+##################################################
+def db_stamp(db2use):
+    """Returns sizes and modification times of the database files to check if the database changed since it was loaded."""
+    folder = os.path.dirname(db2use)
+    prefix = os.path.basename(db2use) + '.'
+    if not os.path.isdir(folder):
+        return ('')
+    return (';'.join("%s:%s:%s" %(f, os.path.getsize(os.path.join(folder, f)), os.path.getmtime(os.path.join(folder, f))) 
+                     for f in sorted(os.listdir(folder)) if f.startswith(prefix)))
+
+##################################################
+def pid_alive(pid):
+    """Returns True if the process is still running."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return (False)
+    except PermissionError:
+        return (True)
+    return (True)
+
+##################################################
+def shm_healthy(entry, segments):
+    """Returns True if all shared memory segments created when loading the database are still available."""
+    if segments is None: ## ipcs not available
+        return (True)
+    return (all(segments.get(shmid) == size for shmid, size in entry['segments'].items()))
+
+##################################################
+def attach_db(kma_bin, db2use, keep=False, Debug=False):
+    """
+    Attaches the current process to the given database in shared memory, loading it if necessary.
+    
+    Databases already loaded by previous or concurrent calls are reused if database files did 
+    not change and memory segments are still available. Each process attached is registered 
+    until :func:`detach_db` is called.
+    
+    :param kma_bin: Absolute path to KMA binary.
+    :param db2use: Database to load in memory.
+    :param keep: Keep database in memory when no process is attached (service mode).
+    :param Debug: True/False for debugging messages.
+    
+    :type kma_bin: string
+    :type db2use: string
+    :type keep: bool
+    :type Debug: bool
+    
+    :returns: System call status. 
+    """
+    with shm_registry() as registry:
+        entry = registry.get(db2use)
+        segments = shm_segments()
+        if entry:
+            entry['users'] = [pid for pid in entry['users'] if pid_alive(pid)]
+            entry['keep'] = entry.get('keep', False) or keep
+            if entry['stamp'] != db_stamp(db2use):
+                print ("+ Database files changed since loaded in memory: loading it again.")
+            elif not shm_healthy(entry, segments):
+                print ("+ Database is no longer available in memory: loading it again.")
+            else:
+                entry['users'].append(os.getpid())
+                print (colored("+ Database already loaded in memory on %s [%.1f GB; processes attached: %s]" %(
+                    entry['loaded'], sum(entry['segments'].values()) / 1024**3, len(entry['users'])), 'green'))
+                return ('OK')
+
+        ## remove any previous copy and load database on memory
+        print ("+ Loading database on memory for faster identification.")
+        remove_db(kma_bin, db2use)
+        code = load_db(kma_bin, db2use)
+        if code == 'FAIL':
+            registry.pop(db2use, None)
+            return (code)
+
+        ## segments created by KMA
+        after = shm_segments()
+        new_segments = {}
+        if segments is not None and after is not None:
+            new_segments = { shmid: size for shmid, size in after.items() if shmid not in segments }
+
+        users = entry['users'] if entry else []
+        registry[db2use] = {'loaded': time.strftime('%Y-%m-%d %H:%M:%S'), 'stamp': db_stamp(db2use),
+                            'segments': new_segments, 'users': users + [os.getpid()],
+                            'keep': bool(entry and entry['keep']) or keep}
+        print (colored("+ Database loaded in memory [%.1f GB]" %(sum(new_segments.values()) / 1024**3), 'green'))
+        if Debug:
+            print (colored("**DEBUG: shared memory segments: %s **" %new_segments, 'yellow'))
+
+    return (code)
+
+##################################################
+def detach_db(kma_bin, db2use):
+    """
+    Detaches the current process from the given database in shared memory.
+    
+    Database is removed from memory if no other process is attached and it was not loaded 
+    in service mode (see :func:`attach_db`).
+    
+    :param kma_bin: Absolute path to KMA binary.
+    :param db2use: Database loaded in memory.
+    
+    :returns: System call status. 
+    """
+    with shm_registry() as registry:
+        entry = registry.get(db2use)
+        if not entry:
+            return (remove_db(kma_bin, db2use))
+
+        entry['users'] = [pid for pid in entry['users'] if pid != os.getpid() and pid_alive(pid)]
+        if entry['users'] or entry.get('keep'):
+            print ("+ Database kept in memory [processes attached: %s]" %len(entry['users']))
+            return ('OK')
+
+        print ("+ Removing database from memory...")
+        registry.pop(db2use)
+        return (remove_db(kma_bin, db2use))
+
+##################################################
+def unload_db(kma_bin, dbs2unload=None):
+    """
+    Removes databases loaded in service mode from shared memory.
+    
+    :param kma_bin: Absolute path to KMA binary.
+    :param dbs2unload: List of databases (absolute path or name) to remove. Default: all databases.
+    
+    Databases with processes still attached are not removed.
+    """
+    with shm_registry() as registry:
+        for db2use in list(registry):
+            if dbs2unload and not any(db in (db2use, os.path.basename(db2use)) for db in dbs2unload):
+                continue
+
+            users = [pid for pid in registry[db2use]['users'] if pid_alive(pid)]
+            if users:
+                print (colored("** Database %s is in use by processes: %s. Not removed." %(db2use, ','.join(str(pid) for pid in users)), 'yellow'))
+                continue
+
+            print ("+ Removing database from memory: %s" %db2use)
+            if remove_db(kma_bin, db2use) == 'FAIL':
+                print (colored("***ERROR: Removing database from memory failed. Please do it manually! Execute command: %s shm -t_db %s -shmLvl 1 -destroy" %(kma_bin, db2use), 'red'))
+            registry.pop(db2use)
+
+##################################################
+def shm_status():
+    """Prints and returns a dataframe with databases loaded in shared memory: date loaded, memory (GB), processes attached and status."""
+    with shm_registry() as registry:
+        segments = shm_segments()
+        status = pd.DataFrame(columns=('database', 'loaded', 'memory_GB', 'processes', 'service', 'status'))
+        for db2use, entry in registry.items():
+            entry['users'] = [pid for pid in entry['users'] if pid_alive(pid)]
+            if entry['stamp'] != db_stamp(db2use):
+                health = 'changed'
+            elif shm_healthy(entry, segments):
+                health = 'OK'
+            else:
+                health = 'missing'
+            status.loc[len(status)] = (db2use, entry['loaded'], round(sum(entry['segments'].values()) / 1024**3, 2),
+                                       len(entry['users']), entry.get('keep', False), health)
+
+    print ("+ KMA databases loaded in memory:")
+    if status.empty:
+        print ("\tNone")
+    else:
+        print (status.to_string(index=False))
+    return (status)
             
 
 ########################
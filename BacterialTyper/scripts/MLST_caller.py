@@ -7,16 +7,37 @@ Created on Thu Nov  9 12:34:19 2023
 """
 
 from BacterialTyper.config import set_config
+from BacterialTyper.scripts import result_cache
 import os
+import json
+import shutil
+import tempfile
+import concurrent.futures
+import numpy
 import HCGB.functions.files_functions as HCGB_files
 import HCGB.functions.aesthetics_functions as HCGB_aes
 import HCGB.functions.system_call_functions as HCGB_sys
-import HCGB.functions.time_functions as HCGB_time
 
 
 from termcolor import colored
 import pprint
 
+## maximum number of assemblies typed within a single mlst call (batches are smaller
+## if required to use all threads available, see BacterialTyper.modules.ident.MLST_ident)
+batch_size = 50
+
+## k-mer size for the allele index of the native caller (2 bits per base in uint64)
+native_ksize = 21
+
+## 2-bit code for each base; other characters (N...) break k-mers
+base_codes = numpy.full(256, 4, dtype=numpy.uint8)
+for code, bases in enumerate((b'Aa', b'Cc', b'Gg', b'Tt')):
+    for base in bases:
+        base_codes[base] = code
+
+## allele index shared by each worker process
+_native = {}
+
 ########################################
 def help_MLST(debug=False):
 
@@ -66,7 +87,7 @@ def get_MLST_profiles(debug=False):
 ########################################
 def MLST_call(outfolder, assembly_file, mlst_profile, sample_name, 
               minid=95, mincov=10, minscore=50, debug=False):
-    mlst_bin = set_config.get_exe("mlst",Debug=debug)
+    (mlst_bin, mlst_version) = set_config.get_exe("mlst", Debug=debug, Return_Version=True)
     
     
     outfolder = HCGB_files.create_subfolder('MLST', outfolder)
@@ -74,8 +95,11 @@ def MLST_call(outfolder, assembly_file, mlst_profile, sample_name,
     out_json = os.path.join(outfolder, 'MLST_res.json')
     out_err  = os.path.join(outfolder, 'MLST_res.log')
     
-    filename_stamp = os.path.join(outfolder, '.success_mlst')
-    if HCGB_files.is_non_zero_file(filename_stamp):
+    ## reuse results if same assembly, parameters and version
+    params = {'mlst_profile': mlst_profile, 'minid': minid, 'mincov': mincov, 'minscore': minscore}
+    if result_cache.check_step(outfolder, 'mlst', [assembly_file], params, mlst_version, 
+                               outputs=[out_csv], name=sample_name, 
+                               legacy_stamp=os.path.join(outfolder, '.success_mlst'), debug=debug):
         return True
     else:
         
@@ -112,8 +136,8 @@ def MLST_call(outfolder, assembly_file, mlst_profile, sample_name,
         
         code = HCGB_sys.system_call(cmd_mlst)
         if (code == 'OK'):
-            ## success stamps
-            HCGB_time.print_time_stamp(filename_stamp)
+            ## save step in manifest
+            result_cache.save_step(outfolder, 'mlst', [assembly_file], params, mlst_version, outputs=[out_csv])
             return True
         else:
             ## Sometime the scheme name provided is not 100% correct and creates error: mtuberculosis -> mtuberculosis_2
@@ -121,15 +145,389 @@ def MLST_call(outfolder, assembly_file, mlst_profile, sample_name,
             cmd_mlst1 += ' %s > %s 2> %s' %(assembly_file, out_csv, out_err)
             code = HCGB_sys.system_call(cmd_mlst1)
             if (code == 'OK'):
-                ## success stamps
-                HCGB_time.print_time_stamp(filename_stamp)
+                ## save step in manifest
+                result_cache.save_step(outfolder, 'mlst', [assembly_file], params, mlst_version, outputs=[out_csv])
                 return True
             else:
                 return False
+
+########################################
+def resolve_scheme(mlst_profile, profiles):
+    """Returns scheme available in mlst for the name provided, or empty for automatic scheme detection.
+    
+    Some schemes include a suffix not derived from the species name (e.g. mtuberculosis: 
+    mtuberculosis_2), so names are checked before calling mlst.
+    
+    :param mlst_profile: Scheme name.
+    :param profiles: Dictionary of schemes available as returned by :func:`get_MLST_profiles`.
+    """
+    if not mlst_profile:
+        return ("")
+    if mlst_profile in profiles:
+        return (mlst_profile)
+    candidates = sorted(scheme for scheme in profiles if scheme.startswith(mlst_profile + '_'))
+    if candidates:
+        return (candidates[0])
+    return ("")
+
+########################################
+def MLST_batch(samples, mlst_profile, threads=1, minid=95, mincov=10, minscore=50, debug=False):
+    """Calls mlst once for several assemblies typed with the same scheme.
+    
+    Results are split into the MLST folder of each sample (MLST_res.csv, MLST_res.json) 
+    as generated by :func:`MLST_call`. Samples with results available for the same inputs, 
+    parameters and version are skipped. If the batch call fails, each sample is typed
+    using :func:`MLST_call`.
+    
+    :param samples: Dictionary with sample names as keys and (outfolder, assembly file) as values.
+    :param mlst_profile: Scheme already resolved (see :func:`resolve_scheme`) or empty for automatic detection.
+    :param threads: Number of CPUs for mlst.
+    
+    :returns: Dictionary with sample names as keys and True/False as values.
+    """
+    (mlst_bin, mlst_version) = set_config.get_exe("mlst", Debug=debug, Return_Version=True)
+    params = {'mlst_profile': mlst_profile, 'minid': minid, 'mincov': mincov, 'minscore': minscore}
+    
+    results = {}
+    pending = {}
+    for sample_name, (outfolder, assembly_file) in samples.items():
+        outfolder = HCGB_files.create_subfolder('MLST', outfolder)
+        if result_cache.check_step(outfolder, 'mlst', [assembly_file], params, mlst_version, 
+                                   outputs=[os.path.join(outfolder, 'MLST_res.csv')], name=sample_name, 
+                                   legacy_stamp=os.path.join(outfolder, '.success_mlst'), debug=debug):
+            results[sample_name] = True
+        else:
+            pending[sample_name] = (outfolder, os.path.abspath(assembly_file))
+    
+    if not pending:
+        return (results)
+    
+    tmp_dir = tempfile.mkdtemp(prefix='mlst_')
+    out_csv = os.path.join(tmp_dir, 'MLST_res.csv')
+    out_json = os.path.join(tmp_dir, 'MLST_res.json')
+    out_err  = os.path.join(tmp_dir, 'MLST_res.log')
     
+    cmd_mlst = mlst_bin + " --threads %s --minid %s --mincov %s" %(threads, minid, mincov)
+    if debug:
+        cmd_mlst += " --debug"    
+    cmd_mlst += " --csv --json " + out_json
+    if mlst_profile:
+        cmd_mlst += " --legacy --scheme %s  --minscore %s" %(mlst_profile, minscore)
+    cmd_mlst += ' %s > %s 2> %s' %(" ".join(assembly for (outfolder, assembly) in pending.values()), out_csv, out_err)
+    
+    if debug:
+        HCGB_aes.debug_message("call:", color='yellow')
+        print(cmd_mlst)
+    
+    try:
+        if HCGB_sys.system_call(cmd_mlst) == 'OK':
+            ## rows and records of each assembly: legacy output includes a header
+            with open(out_csv) as reader:
+                lines = reader.read().splitlines()
+            header = lines[:1] if mlst_profile else []
+            rows = { line.split(',')[0]: line for line in lines[len(header):] }
+            with open(out_json) as reader:
+                records = { os.path.abspath(record.get('filename', record.get('id'))): record for record in json.load(reader) }
+            
+            for sample_name, (outfolder, assembly_file) in pending.items():
+                if assembly_file not in rows or assembly_file not in records:
+                    continue
+                
+                ## sample name as label (--label in MLST_call)
+                with open(os.path.join(outfolder, 'MLST_res.csv'), 'w') as writer:
+                    writer.write("\n".join(header + [sample_name + rows[assembly_file][len(assembly_file):]]) + "\n")
+                with open(os.path.join(outfolder, 'MLST_res.json'), 'w') as writer:
+                    json.dump([dict(records[assembly_file], id=sample_name)], writer, indent=2)
+                shutil.copy(out_err, os.path.join(outfolder, 'MLST_res.log'))
+                
+                result_cache.save_step(outfolder, 'mlst', [assembly_file], params, mlst_version, 
+                                       outputs=[os.path.join(outfolder, 'MLST_res.csv')])
+                results[sample_name] = True
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    
+    ## type separately samples missing
+    for sample_name, (outfolder, assembly_file) in pending.items():
+        if sample_name not in results:
+            print (colored("\t+ Batch mlst call failed for sample %s: calling it separately" %sample_name, 'yellow'))
+            results[sample_name] = MLST_call(os.path.dirname(outfolder), assembly_file, mlst_profile, sample_name, 
+                                             minid=minid, mincov=mincov, minscore=minscore, debug=debug)
+    
+    return (results)
+
+########################################
+def pubmlst_folder(debug=False):
+    """Returns folder containing PubMLST schemes (alleles and profiles) within the mlst installation"""
+    mlst_bin = set_config.get_exe("mlst", Debug=debug)
+    return (os.path.abspath(os.path.join(os.path.dirname(mlst_bin), "../db/pubmlst")))
+
+########################################
+def kmer_hashes(seq, ksize=native_ksize):
+    """Returns canonical k-mers of the sequence as unsigned integers (2 bits per base).
+    
+    Canonical k-mers (minimum of the k-mer and its reverse complement) are used, so alleles 
+    are found in any strand of the contigs. K-mers containing other bases (N...) are discarded.
+    """
+    codes = base_codes[numpy.frombuffer(seq.encode(), dtype=numpy.uint8)]
+    n_kmers = len(codes) - ksize + 1
+    if n_kmers <= 0:
+        return (numpy.zeros(0, dtype=numpy.uint64))
+    
+    forward = numpy.zeros(n_kmers, dtype=numpy.uint64)
+    reverse = numpy.zeros(n_kmers, dtype=numpy.uint64)
+    for i in range(ksize):
+        code = (codes[i:i + n_kmers] & 3).astype(numpy.uint64)
+        forward = (forward << numpy.uint64(2)) | code
+        reverse |= (numpy.uint64(3) - code) << numpy.uint64(2*i)
+    
+    invalid = numpy.concatenate(([0], numpy.cumsum(codes == 4)))
+    valid = (invalid[ksize:] - invalid[:n_kmers]) == 0
+    return (numpy.minimum(forward, reverse)[valid])
+
+########################################
+def read_fasta(fasta_file):
+    """Returns list of tuples (name, sequence) for each entry of a fasta file"""
+    entries = []
+    name = None
+    seq = []
+    with open(fasta_file) as reader:
+        for line in reader:
+            line = line.strip()
+            if line.startswith('>'):
+                if name is not None:
+                    entries.append((name, ''.join(seq)))
+                name = line[1:].split()[0]
+                seq = []
+            elif line:
+                seq.append(line)
+    if name is not None:
+        entries.append((name, ''.join(seq)))
+    return (entries)
+
+########################################
+def build_allele_index(scheme, database_folder, debug=False):
+    """Builds an index of the alleles of a PubMLST scheme for :func:`MLST_native`.
     
+    Alleles (``<locus>.tfa``) and profiles (``<scheme>.txt``) are read from the mlst 
+    installation (see :func:`pubmlst_folder`). The index (numpy .npz) is saved in folder
+    MLST within the database folder and reused while files of the scheme do not change. It 
+    contains:
+    
+        - hashes: sorted canonical k-mers of all alleles and allele_row, the allele each one belongs to.
+        - loci, locus_start: alleles are sorted by locus, so each locus is a range of alleles.
+        - alleles, nkmers, seqs: allele identifier, number of distinct k-mers and sequence.
+        - profiles, sequence_types: allele identifiers of each sequence type.
+    
+    :returns: Absolute path to the index file.
+    """
+    scheme_folder = os.path.join(pubmlst_folder(debug), scheme)
+    if not os.path.isdir(scheme_folder):
+        HCGB_aes.raise_and_exit("MLST scheme %s is not available in folder %s" %(scheme, os.path.dirname(scheme_folder)))
+    
+    checksum = result_cache.folder_hash(scheme_folder)
+    index_folder = os.path.join(database_folder, 'MLST')
+    os.makedirs(index_folder, exist_ok=True)
+    index_file = os.path.join(index_folder, scheme + '.npz')
+    if os.path.isfile(index_file):
+        with numpy.load(index_file) as data:
+            if str(data['checksum']) == checksum and int(data['ksize']) == native_ksize:
+                if debug:
+                    HCGB_aes.debug_message("Loading MLST allele index: " + index_file, "yellow")
+                return (index_file)
+    
+    print ("+ Building MLST allele index for scheme %s..." %scheme)
+    
+    ## profiles: ST and loci, followed by other columns (clonal_complex...)
+    with open(os.path.join(scheme_folder, scheme + '.txt')) as reader:
+        header = reader.readline().rstrip('\n').split('\t')
+        profile_rows = [ line.rstrip('\n').split('\t') for line in reader if line.strip() ]
+    loci = [ locus for locus in header[1:] if os.path.isfile(os.path.join(scheme_folder, locus + '.tfa')) ]
+    columns = [ header.index(locus) for locus in loci ]
+    
+    alleles = []
+    seqs = []
+    hashes = []
+    locus_start = []
+    for locus in loci:
+        locus_start.append(len(alleles))
+        for (name, seq) in read_fasta(os.path.join(scheme_folder, locus + '.tfa')):
+            alleles.append(name.rsplit('_', 1)[-1])
+            seqs.append(seq.upper())
+            hashes.append(numpy.unique(kmer_hashes(seq)))
+    
+    nkmers = numpy.array([ len(h) for h in hashes ], dtype=numpy.int32)
+    all_hashes = numpy.concatenate(hashes) if hashes else numpy.zeros(0, dtype=numpy.uint64)
+    allele_row = numpy.repeat(numpy.arange(len(hashes), dtype=numpy.int32), nkmers)
+    order = numpy.argsort(all_hashes, kind='stable')
+    
+    numpy.savez(index_file, hashes=all_hashes[order], allele_row=allele_row[order], 
+                loci=numpy.array(loci), locus_start=numpy.array(locus_start, dtype=numpy.int64),
+                alleles=numpy.array(alleles), nkmers=nkmers, seqs=numpy.array(seqs),
+                profiles=numpy.array([ [row[c] for c in columns] for row in profile_rows ]).reshape(len(profile_rows), len(columns)),
+                sequence_types=numpy.array([ row[0] for row in profile_rows ]),
+                checksum=numpy.array(checksum), ksize=numpy.array(native_ksize))
+    return (index_file)
+
+########################################
+def _init_native(index_file):
+    with numpy.load(index_file) as data:
+        for key in data.files:
+            _native[key] = data[key]
+    _native['st'] = { tuple(profile): st for profile, st in zip(_native['profiles'].tolist(), _native['sequence_types'].tolist()) }
+
+########################################
+def allele_match(seq, query, ksize=native_ksize):
+    """Returns coverage and identity estimated for an allele given the sorted k-mers of an assembly.
+    
+    Coverage is the span of the allele between the first and the last k-mer shared. Ends shorter
+    than k bases are considered covered, as a mismatch within k bases of an end also removes 
+    the k-mers up to that end. A k-mer is only shared if all its bases match, so identity is 
+    estimated as fraction ** (1 / k) for the fraction of k-mers shared within the span, e.g. 
+    95 % identity shares ~34 % of 21-mers.
+    
+    :returns: Tuple with coverage and identity (0-1).
+    """
+    kmers = kmer_hashes(seq, ksize)
+    if not len(kmers) or not len(query):
+        return (0.0, 0.0)
+    
+    position = numpy.minimum(numpy.searchsorted(query, kmers), len(query) - 1)
+    present = numpy.flatnonzero(query[position] == kmers)
+    if not len(present):
+        return (0.0, 0.0)
+    
+    (first, last) = (int(present[0]), int(present[-1]))
+    if first < ksize:
+        first = 0
+    if last >= len(kmers) - ksize:
+        last = len(kmers) - 1
+    coverage = (last - first + ksize) / (len(kmers) + ksize - 1)
+    identity = (len(present) / (last - first + 1)) ** (1.0 / ksize)
+    return (coverage, identity)
+
+########################################
+def native_call(assembly_file, minid=95, mincov=10):
+    """Calls alleles of each locus for an assembly using the allele index loaded (see :func:`build_allele_index`).
+    
+    Alleles sharing all their k-mers with the assembly are checked as exact matches in 
+    either strand of the contigs and the longest one is reported. Otherwise, the allele 
+    sharing most k-mers is reported as in mlst if its identity is at least minid % (see
+    :func:`allele_match`): ~N if covered over its full length, N? if partially covered 
+    (at least mincov %, e.g. truncated at the end of a contig), or - if not found. 
+    
+    :returns: Tuple with sequence type (- if not found) and dictionary of alleles for each locus.
+    """
+    contigs = [ seq.upper() for (name, seq) in read_fasta(assembly_file) ]
+    genome = '|'.join(contigs)
+    genome_rc = genome[::-1].translate(str.maketrans('ACGT', 'TGCA'))
+    query = numpy.unique(numpy.concatenate([ kmer_hashes(seq) for seq in contigs ] + [numpy.zeros(0, dtype=numpy.uint64)]))
+    
+    ## k-mers of each allele found in the assembly
+    hashes = _native['hashes']
+    found = numpy.zeros(len(hashes), dtype=bool)
+    if len(query):
+        position = numpy.minimum(numpy.searchsorted(query, hashes), len(query) - 1)
+        found = query[position] == hashes
+    shared = numpy.bincount(_native['allele_row'][found], minlength=len(_native['alleles']))
+    fraction = shared / numpy.maximum(_native['nkmers'], 1)
+    
+    calls = {}
+    bounds = list(_native['locus_start']) + [len(_native['alleles'])]
+    for i, locus in enumerate(_native['loci'].tolist()):
+        (start, end) = (bounds[i], bounds[i + 1])
+        if start == end:
+            calls[locus] = '-'
+            continue
+        
+        candidates = start + numpy.flatnonzero(fraction[start:end] >= 1)
+        exact = [ c for c in sorted(candidates, key=lambda c: -len(_native['seqs'][c])) 
+                  if _native['seqs'][c] in genome or _native['seqs'][c] in genome_rc ]
+        best = start + int(numpy.argmax(fraction[start:end]))
+        if exact:
+            calls[locus] = str(_native['alleles'][exact[0]])
+            continue
+        
+        (coverage, identity) = allele_match(str(_native['seqs'][best]), query)
+        if identity * 100 < minid or coverage * 100 < mincov:
+            calls[locus] = '-'
+        elif coverage >= 1:
+            calls[locus] = '~' + str(_native['alleles'][best])
+        else:
+            calls[locus] = str(_native['alleles'][best]) + '?'
+    
+    return (_native['st'].get(tuple(calls.values()), '-'), calls)
+
+########################################
+def MLST_native(samples, mlst_profile, database_folder, threads=1, minid=95, mincov=10, debug=False):
+    """Types several assemblies using the built-in allele caller instead of mlst.
+    
+    The allele index of the scheme (:func:`build_allele_index`) is loaded once in each worker 
+    process and assemblies are typed in parallel (:func:`native_call`). Results are saved 
+    in the MLST folder of each sample (MLST_res.csv, MLST_res.json) as by :func:`MLST_batch`.
+    Samples that fail are typed using mlst (:func:`MLST_call`) and, if the allele index 
+    cannot be built, all samples are typed using :func:`MLST_batch`.
+    
+    :param samples: Dictionary with sample names as keys and (outfolder, assembly file) as values.
+    :param mlst_profile: Scheme already resolved (see :func:`resolve_scheme`). 
+    :param database_folder: Absolute path to the database folder to store the allele index.
+    :param threads: Number of processes.
+    
+    :returns: Dictionary with sample names as keys and True/False as values.
+    """
+    try:
+        index_file = build_allele_index(mlst_profile, database_folder, debug)
+    except Exception as exc:
+        print (colored("\t+ MLST allele index not available for scheme %s (%s): calling mlst" %(mlst_profile, exc), 'yellow'))
+        return (MLST_batch(samples, mlst_profile, threads, minid=minid, mincov=mincov, debug=debug))
+    
+    with numpy.load(index_file) as data:
+        version = 'native:' + str(data['checksum'])
+        loci = data['loci'].tolist()
+    params = {'mlst_profile': mlst_profile, 'minid': minid, 'mincov': mincov, 'engine': 'native'}
+    
+    results = {}
+    pending = {}
+    for sample_name, (outfolder, assembly_file) in samples.items():
+        outfolder = HCGB_files.create_subfolder('MLST', outfolder)
+        if result_cache.check_step(outfolder, 'mlst', [assembly_file], params, version, 
+                                   outputs=[os.path.join(outfolder, 'MLST_res.csv')], name=sample_name, debug=debug):
+            results[sample_name] = True
+        else:
+            pending[sample_name] = (outfolder, assembly_file)
     
+    if not pending:
+        return (results)
     
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(1, int(threads)), initializer=_init_native, initargs=(index_file,)) as executor:
+        futures = { executor.submit(native_call, assembly_file, minid, mincov): sample_name 
+                    for sample_name, (outfolder, assembly_file) in pending.items() }
+        for future in concurrent.futures.as_completed(futures):
+            sample_name = futures[future]
+            (outfolder, assembly_file) = pending[sample_name]
+            try:
+                (sequence_type, calls) = future.result()
+            except Exception as exc:
+                print ('***ERROR:')
+                print('%r generated an exception: %s' % (sample_name, exc))
+                continue
+            
+            ## same output as mlst --legacy --csv --json
+            with open(os.path.join(outfolder, 'MLST_res.csv'), 'w') as writer:
+                writer.write(",".join(['FILE', 'SCHEME', 'ST'] + loci) + "\n")
+                writer.write(",".join([sample_name, mlst_profile, sequence_type] + [ calls[locus] for locus in loci ]) + "\n")
+            with open(os.path.join(outfolder, 'MLST_res.json'), 'w') as writer:
+                json.dump([{'id': sample_name, 'filename': assembly_file, 'scheme': mlst_profile, 
+                            'sequence_type': sequence_type, 'alleles': calls}], writer, indent=2)
+            
+            result_cache.save_step(outfolder, 'mlst', [assembly_file], params, version, 
+                                   outputs=[os.path.join(outfolder, 'MLST_res.csv')])
+            results[sample_name] = True
     
+    ## type separately samples failed
+    for sample_name, (outfolder, assembly_file) in pending.items():
+        if sample_name not in results:
+            print (colored("\t+ Native MLST call failed for sample %s: calling mlst" %sample_name, 'yellow'))
+            results[sample_name] = MLST_call(os.path.dirname(outfolder), assembly_file, mlst_profile, sample_name, 
+                                             minid=minid, mincov=mincov, debug=debug)
     
-    
\ No newline at end of file
+    return (results)
@@ -8,6 +8,7 @@ __all__ = [
     'card_trick_caller',
     'database_generator',
     'database_user',
+    'db_catalog',
     'edirect_caller',
     'fastqc_caller',
     'genomic_island',
@@ -15,7 +16,9 @@ __all__ = [
     'min_hash_caller',
     'multiQC_report',
     'plasmidID_call',
+    'result_cache',
     'phylo_parser',
+    'project_index',
     'spades_assembler',
     'KMA_caller',
     'kraken2_caller',
@@ -25,4 +28,10 @@ __all__ = [
     'argnorm_caller'
 ]
 
-from BacterialTyper.scripts import *
\ No newline at end of file
+## import submodules when first used (see BacterialTyper/__init__.py)
+import importlib
+
+def __getattr__(name):
+    if name in __all__:
+        return importlib.import_module(__name__ + '.' + name)
+    raise AttributeError("module %r has no attribute %r" %(__name__, name))
\ No newline at end of file
@@ -20,9 +20,9 @@ from sys import argv
 from termcolor import colored
 
 ## import my modules
-import HCGB.functions.time_functions as HCGB_time
 import HCGB.functions.system_call_functions as HCGB_sys
 from BacterialTyper.config import set_config
+from BacterialTyper.scripts import result_cache
 
 #############################################
 def print_list_prokka():
@@ -53,9 +53,9 @@ def module_call(sequence_fasta, kingdom, genus, path, name, threads):
     
     - It uses Prokka_ via :func:`BacterialTyper.scripts.annotation.prokka_call`.
     
-    - It checks if previously generated 
+    - It checks if previously generated for the same assembly, options and Prokka_ version
     
-    - Once finished, it prints timestamp 
+    - Once finished, it saves the step in the manifest of the folder (see :mod:`BacterialTyper.scripts.result_cache`)
     
     :param sequence_fasta: Assembled sequences in fasta file format. 
     :param kingdom: Available kingdoms mode for Prokka software: Archaea|Bacteria|Mitochondria|Viruses
@@ -75,33 +75,32 @@ def module_call(sequence_fasta, kingdom, genus, path, name, threads):
     
         - :func:`BacterialTyper.scripts.set_config.get_exe`
         
-        - :func:`HCGB.functions.time_functions.read_time_stamp`
+        - :func:`BacterialTyper.scripts.result_cache.check_step`
         
-        - :func:`HCGB.functions.time_functions.print_time_stamp`
+        - :func:`BacterialTyper.scripts.result_cache.save_step`
                 
-        - :func:`HCGB.functions.time_functions.prokka_call`    
+        - :func:`BacterialTyper.scripts.annotation.prokka_call`    
 
     .. include:: ../../links.inc         
     """
     
-    ## check if previously assembled and succeeded
-    filename_stamp = os.path.join(path, '.success')
+    ## check if previously annotated and succeeded with same assembly, options and version
+    (prokka_bin, prokka_version) = set_config.get_exe('prokka', Return_Version=True)
+    params = {'kingdom': kingdom, 'genus': genus, 'name': name}
 
     if os.path.isdir(path):
-        if os.path.isfile(filename_stamp):
-            stamp =    HCGB_time.read_time_stamp(filename_stamp)
-            print (colored("\tA previous command generated results on: %s [%s]" %(stamp, name), 'yellow'))
+        if result_cache.check_step(path, 'prokka', [sequence_fasta], params, prokka_version, 
+                                   name=name, legacy_stamp=os.path.join(path, '.success')):
             return ()
     
     ## call prokka
-    prokka_bin = set_config.get_exe('prokka')
     dirname = prokka_call(prokka_bin, sequence_fasta, kingdom, genus, path, name, threads)
 
     if (dirname=="FAIL"):
         print (colored("\tAn error ocurred for sample: ", name), 'yellow')
     else:
-        ## success stamps
-        stamp = HCGB_time.print_time_stamp(filename_stamp)
+        ## save step in manifest
+        result_cache.save_step(path, 'prokka', [sequence_fasta], params, prokka_version)
 
     return(dirname)
 
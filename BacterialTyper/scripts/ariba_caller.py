@@ -13,7 +13,6 @@ import sys
 from io import open
 from termcolor import colored
 import pandas as pd
-from ete3 import Tree
 
 ## import my modules
 import HCGB.functions.time_functions as HCGB_time
@@ -629,6 +628,7 @@ def fix_phangando_tree(tree_file, outfile_name, dict_files):
         print (colored("*** ERROR: phandango tree file (%s) not generated ***" %tree_file, 'red'))
         return()
 
+    from ete3 import Tree ## only loaded when required
     t = Tree(tree_file)
     for leaf in t:
         for key, value in dict_files.items():
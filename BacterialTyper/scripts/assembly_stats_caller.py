@@ -4,7 +4,10 @@
 ## Copyright (C) 2019-2021 Lauro Sumoy Lab, IGTP, Spain   ##
 ############################################################
 """
-Calls assembly_stats pip module
+Generates assembly statistics (contigs and scaffolds) for fasta files.
+
+Fasta files are read in chunks and sequence lengths and GC are accumulated using numpy,
+so several assemblies can be processed in parallel and summarized in a single table.
 """
 ## useful imports
 import time
@@ -12,21 +15,188 @@ import io
 import os
 import re
 import sys
+import gzip
+import array
+import concurrent.futures
 from sys import argv
 from io import open
 from termcolor import colored
+import numpy as np
 import pandas as pd
-import assembly_stats
 
 ##
 import HCGB.functions.aesthetics_functions as HCGB_aes
 import HCGB.functions.main_functions as HCGB_main
 
+## N/L levels reported
+stats_levels = [10, 20, 30, 40, 50, 60, 70, 80, 90]
+
+## runs of N
+N_run = re.compile(rb'N+')
+
+############
+class sequence_accumulator():
+    """Accumulates scaffold and contig lengths while a fasta file is streamed.
+
+    Scaffolds are split into contigs at "NN" as :func:`str.split` would do: each pair of N
+    ends the current contig and an unpaired N is kept in the next one.
+    """
+    def __init__(self):
+        self.contig_lens = array.array('q')
+        self.scaffold_lens = array.array('q')
+        self.gc = 0
+        self.in_record = False
+        self.scaffold = 0
+        self.contig = 0
+        self.run_N = 0
+
+    def _resolve_N(self):
+        if self.run_N >= 2:
+            if self.contig:
+                self.contig_lens.append(self.contig)
+            self.contig = self.run_N % 2
+        else:
+            self.contig += self.run_N
+        self.run_N = 0
+
+    def start(self):
+        self.end()
+        self.in_record = True
+
+    def add(self, chunk):
+        if not chunk:
+            return
+        self.in_record = True
+        chunk = chunk.upper() ## lowercase (soft-masked) bases
+        self.scaffold += len(chunk)
+        self.gc += chunk.count(b'G') + chunk.count(b'C')
+
+        pos = 0
+        for match in N_run.finditer(chunk):
+            (start, end) = match.span()
+            if start > pos:
+                if self.run_N:
+                    self._resolve_N()
+                self.contig += start - pos
+            self.run_N += end - start
+            pos = end
+
+        if pos < len(chunk):
+            if self.run_N:
+                self._resolve_N()
+            self.contig += len(chunk) - pos
+
+    def end(self):
+        if not self.in_record:
+            return
+        if self.run_N:
+            self._resolve_N()
+        if self.contig:
+            self.contig_lens.append(self.contig)
+        self.scaffold_lens.append(self.scaffold)
+        self.in_record = False
+        self.scaffold = 0
+        self.contig = 0
+
+############
+def read_genome(fasta_file, chunk_size=4000000):
+    """Reads fasta file in chunks and returns contig and scaffold lengths and GC content.
+
+    :param fasta_file: Absolute path to fasta file (it might be gzipped).
+    :param chunk_size: Number of bytes read at once.
+
+    :returns: contig lengths (numpy array), scaffold lengths (numpy array), GC (%)
+    """
+    seqs = sequence_accumulator()
+
+    if fasta_file.endswith('.gz'):
+        fh = gzip.open(fasta_file, 'rb')
+    else:
+        fh = open(fasta_file, 'rb')
+
+    header = False ## within a header line
+    with fh:
+        while True:
+            block = fh.read(chunk_size)
+            if not block:
+                break
+
+            pos = 0
+            while pos < len(block):
+                if header:
+                    end_line = block.find(b'\n', pos)
+                    if end_line == -1:
+                        break
+                    header = False
+                    pos = end_line + 1
+                    continue
+
+                next_header = block.find(b'>', pos)
+                if next_header == -1:
+                    seqs.add(block[pos:].translate(None, b'\r\n\t '))
+                    break
+
+                seqs.add(block[pos:next_header].translate(None, b'\r\n\t '))
+                seqs.start()
+                header = True
+                pos = next_header + 1
+    seqs.end()
+
+    contig_lens = np.frombuffer(seqs.contig_lens, dtype=np.int64) if seqs.contig_lens else np.zeros(0, dtype=np.int64)
+    scaffold_lens = np.frombuffer(seqs.scaffold_lens, dtype=np.int64) if seqs.scaffold_lens else np.zeros(0, dtype=np.int64)
+
+    total_len = int(contig_lens.sum())
+    gc_cont = (seqs.gc / total_len) * 100 if total_len else 0.0
+
+    return (contig_lens, scaffold_lens, gc_cont)
+
+############
+def calculate_stats(seq_lens, gc_cont):
+    """Calculates length statistics and N10-N90/L10-L90 for the sequence lengths provided.
+
+    As in assembly_stats pip module, LXX is the index (0-based) of the sequence, sorted by length,
+    that reaches XX% of the total length and NXX is its length.
+    """
+    seq_array = np.asarray(seq_lens, dtype=np.int64)
+    stats = {'sequence_count': int(seq_array.size),
+             'gc_content': gc_cont}
+
+    if not seq_array.size:
+        for key in ('longest', 'shortest', 'median', 'mean', 'total_bps'):
+            stats[key] = 0
+        for level in stats_levels:
+            stats['L' + str(level)] = 0
+            stats['N' + str(level)] = 0
+        return (stats)
+
+    sorted_lens = np.sort(seq_array)[::-1]
+    stats['longest'] = int(sorted_lens[0])
+    stats['shortest'] = int(sorted_lens[-1])
+    stats['median'] = float(np.median(sorted_lens))
+    stats['mean'] = float(np.mean(sorted_lens))
+    stats['total_bps'] = int(sorted_lens.sum())
+
+    csum = np.cumsum(sorted_lens)
+    targets = (stats['total_bps'] * np.array(stats_levels) / 100).astype(np.int64)
+    idx = np.searchsorted(csum, targets, side='left')
+    for level, i in zip(stats_levels, idx):
+        stats['L' + str(level)] = int(i)
+        stats['N' + str(level)] = int(sorted_lens[i])
+
+    return (stats)
+
 ############
-def assembly_stats_caller(fasta_file, out_file, debug):
-    
-    contig_lens, scaffold_lens, gc_cont = assembly_stats.read_genome(fasta_file)
-    
+def assembly_stats_caller(fasta_file, out_file, debug, excel=False):
+    """Generates contig and scaffold statistics for a fasta file.
+
+    Statistics are saved in *out_file-contigs.csv* and *out_file-scaffolds.csv* and, optionally,
+    in excel file *out_file_stats.xlsx*. Several samples are summarized in a single table 
+    by :func:`assembly_stats_all`.
+
+    :returns: Dictionary with contigs and scaffolds statistics and excel file (or None).
+    """
+    contig_lens, scaffold_lens, gc_cont = read_genome(fasta_file)
+
     ## debug messages
     if debug:
         HCGB_aes.debug_message("contig_lens", "yellow")
@@ -35,44 +205,112 @@ def assembly_stats_caller(fasta_file, out_file, debug):
         print(scaffold_lens)
         HCGB_aes.debug_message("gc_cont", "yellow")
         print(gc_cont)
-    
+
     ## get stats
-    contig_stats = assembly_stats.calculate_stats(contig_lens, gc_cont)
-    scaffold_stats = assembly_stats.calculate_stats(scaffold_lens, gc_cont)
-    
+    contig_stats = calculate_stats(contig_lens, gc_cont)
+    scaffold_stats = calculate_stats(scaffold_lens, gc_cont)
+
     ## debug messages
     if debug:
         HCGB_aes.debug_message("contig_stats", "yellow")
         print(contig_stats)
         HCGB_aes.debug_message("scaffold_stats", "yellow")
         print(scaffold_stats)
-    
+
     stat_output = {'Contig Stats': contig_stats,
                    'Scaffold Stats': scaffold_stats}
-    
+
     ## save results in file
     HCGB_main.printDict2file(out_file + '-contigs.csv', contig_stats, ",")
     HCGB_main.printDict2file(out_file + '-scaffolds.csv', scaffold_stats, ",")
-    
+
     ## create stats in excel file
-    assembly_stats_file = out_file + '_stats.xlsx'
-    parse_stats(stat_output, assembly_stats_file, debug)
-    
+    assembly_stats_file = None
+    if excel:
+        assembly_stats_file = out_file + '_stats.xlsx'
+        parse_stats(stat_output, assembly_stats_file, debug)
+
     return(stat_output, assembly_stats_file)
 
+####################################
+def read_stats(out_file):
+    """Reads statistics previously generated by :func:`assembly_stats_caller` if available."""
+    stat_output = {}
+    for name, suffix in (('Contig Stats', '-contigs.csv'), ('Scaffold Stats', '-scaffolds.csv')):
+        if not os.path.isfile(out_file + suffix):
+            return (None)
+        stat_output[name] = HCGB_main.file2dictionary(out_file + suffix, ',')
+    return (stat_output)
+
+####################################
+def sample_stats(fasta_file, out_file):
+    """Returns statistics for a fasta file, reusing files from a previous call if newer than fasta file."""
+    stat_output = read_stats(out_file)
+    if stat_output and os.path.getmtime(out_file + '-contigs.csv') >= os.path.getmtime(fasta_file):
+        return (stat_output)
+
+    (stat_output, excel_file) = assembly_stats_caller(fasta_file, out_file, False)
+    return (stat_output)
+
+####################################
+def assembly_stats_all(dict_files, threads=1, debug=False, dict_stats=None):
+    """Generates statistics for several fasta files in parallel.
+
+    :param dict_files: Dictionary containing sample name as keys and a tuple (fasta file, out_file name) as values.
+    :param threads: Number of CPUs to use.
+    :param dict_stats: Dictionary containing sample name as keys and statistics already generated 
+        (see :func:`assembly_stats_caller`) as values. These samples are not read again.
+
+    :returns: Dataframe containing contig and scaffold statistics for all samples (see :func:`stats2dataframe`).
+    """
+    dict_stats = dict(dict_stats or {})
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(1, int(threads))) as executor:
+        commandsSent = { executor.submit(sample_stats, fasta_file, out_file): name
+                        for name, (fasta_file, out_file) in dict_files.items() if name not in dict_stats }
+
+        for cmd2 in concurrent.futures.as_completed(commandsSent):
+            details = commandsSent[cmd2]
+            try:
+                dict_stats[details] = cmd2.result()
+            except Exception as exc:
+                print ('***ERROR:')
+                print (cmd2)
+                print('%r generated an exception: %s' % (details, exc))
+
+    if debug:
+        HCGB_aes.debug_message("dict_stats", "yellow")
+        print (dict_stats)
+
+    return (stats2dataframe(dict_stats))
+
+####################################
+def stats2dataframe(dict_stats):
+    """Creates a single dataframe with a row per sample and sequence type (contigs, scaffolds)."""
+    records = []
+    for sample_name in sorted(dict_stats):
+        for seq_type, name in (('contigs', 'Contig Stats'), ('scaffolds', 'Scaffold Stats')):
+            each_record = {'type': seq_type, 'sample_name': sample_name}
+            each_record.update(dict_stats[sample_name][name])
+            records.append(each_record)
+
+    df = pd.DataFrame.from_records(records)
+    stats_cols = [col for col in df.columns if col not in ('type', 'sample_name')]
+    df[stats_cols] = df[stats_cols].apply(pd.to_numeric, errors='coerce')
+    return (df)
+
 ####################################
 def parse_stats(stat_output, assembly_stats_file, debug):
-    
+
     ## create single excel file
     ## write to excel
     with pd.ExcelWriter(assembly_stats_file, engine="xlsxwriter", engine_kwargs={"options": {"nan_inf_to_errors": True}}) as writer:
-    
+
         ## loop over dictionary and print dataframe
         for name, each_data in stat_output.items():
             if debug:
                 print ("Name: ", name)
                 print ("Data: ", each_data)
-                
+
             each_df = pd.DataFrame.from_dict(each_data, orient='index')
             each_df.to_excel(writer, sheet_name=name) ## write excel handle
 
@@ -91,17 +329,15 @@ def main():
         print ("")
     else:
         help_options()
-        exit()        
+        exit()
 
     file_in = os.path.abspath(argv[1])
     file_out = os.path.abspath(argv[2])
-    
+
     ##
-    path_to_sample = assembly_stats_caller(file_in, file_out, True)
-        
+    path_to_sample = assembly_stats_caller(file_in, file_out, True, excel=True)
+
 ############
 '''******************************************'''
 if __name__== "__main__":
     main()
-
-
@@ -21,9 +21,9 @@ import shutil
 ## import my modules
 from BacterialTyper.scripts import functions
 from BacterialTyper.config import set_config
+from BacterialTyper.scripts import result_cache
 
-## import phispy modules
-import PhiSpyModules
+## phispy modules are loaded when required (see ident_bacteriophage)
 import pkg_resources
 
 ######
@@ -46,20 +46,20 @@ def results_PhiSpy(folder, name):
 
 		- :func:`BacterialTyper.scripts.functions.create_subfolder`
 
-		- :func:`BacterialTyper.scripts.functions.read_time_stamp`
+		- :func:`BacterialTyper.scripts.result_cache.check_step`
 		
-		- :func:`BacterialTyper.scripts.functions.print_time_stamp`
+		- :func:`BacterialTyper.scripts.result_cache.save_step`
 				
 	"""
 	
 	
-	## filename stamp of the process
-	filename_stamp = folder + '/.PhiSpy_results'
+	## results are parsed again for each new PhiSpy call (see :func:`ident_bacteriophage`)
+	params = {'PhiSpy': result_cache.get_key(folder, 'PhiSpy')}
 
 	# check if previously done
-	if os.path.isfile(filename_stamp):
-		stamp =	functions.read_time_stamp(filename_stamp)
-		print (colored("\tA previous command generated results on: %s [%s]" %(stamp, name), 'yellow'))
+	if result_cache.check_step(folder, 'PhiSpy_results', [], params, '', name=name, 
+							legacy_stamp=folder + '/.PhiSpy_results'):
+		return ()
 	else:	
 	
 		## get files
@@ -125,7 +125,7 @@ def results_PhiSpy(folder, name):
 				# move to sup_folder
 				shutil.move(f, sup_folder)
 				
-			elif baseName == ".PhiSpy":
+			elif baseName in (".PhiSpy", result_cache.manifest_name):
 				continue
 				
 			
@@ -139,8 +139,8 @@ def results_PhiSpy(folder, name):
 		## close
 		writer.save()
 		
-		## print stamp time file
-		stamp =	functions.print_time_stamp(filename_stamp)
+		## save step in manifest
+		result_cache.save_step(folder, 'PhiSpy_results', [], params, '')
 		
 	return ()
 
@@ -217,13 +217,21 @@ def ident_bacteriophage(gbk_file, name, output_dir, training_set, Debug=False,
 			
 	"""
 
-	## filename stamp of the process
-	filename_stamp = output_dir + '/.PhiSpy'
-
-	# check if previously done
-	if os.path.isfile(filename_stamp):
-		stamp =	functions.read_time_stamp(filename_stamp)
-		print (colored("\tA previous command generated results on: %s [%s -- PhiSpy]" %(stamp, name), 'yellow'))
+	## PhiSpy version
+	try:
+		PhiSpy_version = pkg_resources.get_distribution('PhiSpy').version
+	except pkg_resources.DistributionNotFound:
+		PhiSpy_version = 'n.a.'
+
+	## parameters that modify results
+	params = {'training_set': training_set, 'min_contig_size': min_contig_size, 'window_size': window_size, 
+			'nonprophage_genegaps': nonprophage_genegaps, 'number_phage_genes': number_phage_genes, 
+			'randomforest_trees': randomforest_trees, 'expand_slope': expand_slope, 'kmers_type': kmers_type}
+
+	# check if previously done for the same GenBank file, parameters and version
+	if result_cache.check_step(output_dir, 'PhiSpy', [gbk_file], params, PhiSpy_version, name=name, 
+							legacy_stamp=output_dir + '/.PhiSpy', debug=Debug):
+		return (output_dir) ## contains results
 	else:	
 		## debug message
 		if (Debug):
@@ -234,6 +242,9 @@ def ident_bacteriophage(gbk_file, name, output_dir, training_set, Debug=False,
 		### create folder
 		functions.create_folder(output_dir)
 		
+		## import phispy modules
+		import PhiSpyModules
+		
 		## Filter to remove short contigs
 		gbk_filtered = PhiSpyModules.SeqioFilter(filter(lambda x: len(x.seq) > min_contig_size, SeqIO.parse(gbk_file, "genbank")))
 		ncontigs = reduce(lambda sum, element: sum + 1, gbk_filtered, 0)
@@ -283,8 +294,8 @@ def ident_bacteriophage(gbk_file, name, output_dir, training_set, Debug=False,
 		## PhiSpy Evaluation
 		PhiSpyModules.fixing_start_end(**vars(arg_parser))
 		
-		## when finished print time stamp in  output_dir + '/.PhiSpy'
-		stamp =	functions.print_time_stamp(filename_stamp)
+		## when finished save step in manifest
+		result_cache.save_step(output_dir, 'PhiSpy', [gbk_file], params, PhiSpy_version)
 
 	## final results
 	return (output_dir) ## contains results
@@ -9,7 +9,6 @@ Calls card-trick module to parse CARD resistance information.
 ## useful imports
 import os
 from termcolor import colored
-import card_trick
 
 ## import my modules
 import HCGB.functions.time_functions as HCGB_time
@@ -20,6 +19,7 @@ def get_info_CARD(IDs, term, dataF, Debug):
 	## dataF contains CARD ontology: downloaded and parse using prepare_card_data
 	## IDs is an input list
 	## term is the type of search to do using card_trick
+	import card_trick ## only loaded when required
 	
 	# search for terms provided	
 	matching_terms = card_trick.ontology_functions.search(input_list = IDs, dataF = dataF, 
@@ -55,6 +55,8 @@ def prepare_card_data(database_folder):
 
 	###
 	if download:
+		import card_trick ## only loaded when required
+		
 		## uptade database in a path
 		aro_obo_file = card_trick.ontology_functions.update_ontology(CARD_folder, False)
 	
@@ -15,8 +15,8 @@ Several functions are implemented for:
 import time
 import os
 import re
+import shutil
 import pandas as pd
-import ncbi_genome_download as ngd
 from io import open
 from termcolor import colored
 from Bio import SeqIO
@@ -26,6 +26,8 @@ from BacterialTyper.scripts import ariba_caller
 from BacterialTyper.scripts import KMA_caller
 from BacterialTyper.scripts import min_hash_caller
 from BacterialTyper.scripts import amrfinder_caller
+from BacterialTyper.scripts import db_catalog
+from BacterialTyper.scripts import scheduler
 from BacterialTyper.config import set_config
 
 
@@ -35,17 +37,23 @@ import HCGB.functions.files_functions as HCGB_files
 import HCGB.functions.main_functions as HCGB_main
 
 ##########################################################################################
-def NCBI_DB(strains2get, data_folder, Debug):
+def NCBI_DB(strains2get, data_folder, Debug, threads=4, mirror=None):
     """Donwloads given taxa from NCBI if not available and updates database information.
     
     This function checks in the given folder if strain of interest is available. If not it would connect to NCBI using python module ncbi_genome_download and downloads some information.
     
+    Several entries are downloaded at the same time (see :func:`BacterialTyper.scripts.scheduler.run_batch`) and each download is retried if it fails (see :func:`NCBIdownload_retry`). A local mirror of genbank assemblies is checked before connecting to NCBI (see :func:`mirror_download`). The database is updated once all entries are downloaded.
+    
     :param strains2get: dataframe containing genus, species and NCBI assembly columns among others. See example below.
     :param data_folder: Absolute path to database NCBI folder.
     :param Debug: Print messages for debugging purposes if desired. 
+    :param threads: Maximum number of simultaneous downloads.
+    :param mirror: Absolute path or file:// URL to a local mirror of genbank assemblies.
     :type strains2get: dataframe
     :type data_folder: string
     :type Debug: bool
+    :type threads: int
+    :type mirror: string
     :return: Dataframe of genbank database updated for all available entries.
 
     Columns for the dataframe :file:`strains2get` consist of:
@@ -72,6 +80,10 @@ def NCBI_DB(strains2get, data_folder, Debug):
     
         - :func:`BacterialTyper.scripts.database_generator.get_database`
         
+        - :func:`BacterialTyper.scripts.database_generator.check_download`
+        
+        - :func:`BacterialTyper.scripts.database_generator.ngd_batch_download`
+        
         - :func:`BacterialTyper.scripts.database_generator.NCBIdownload`
         
         - :func:`BacterialTyper.scripts.database_generator.update_db_data_file`
@@ -93,10 +105,11 @@ def NCBI_DB(strains2get, data_folder, Debug):
     ## get data existing database
     print ("+ Create the database in folder: \n", data_folder)
     HCGB_files.create_folder(data_folder)
+    database_folder = os.path.dirname(os.path.abspath(data_folder))
     
     ## read database 
-    db_frame = getdbs('NCBI', data_folder, 'genbank', Debug)
-    database_df = get_database(db_frame, Debug)
+    db_frame = getdbs('NCBI', database_folder, 'genbank', Debug)
+    database_df = get_database(db_frame, Debug, database_folder, 'genbank')
     
     #########
     if Debug:
@@ -108,12 +121,12 @@ def NCBI_DB(strains2get, data_folder, Debug):
         print ("database_df")
         print (database_df)
     
-    ## loop and download
+    ## check entries available
+    dict_download = {}
     for index, row in strains2get.iterrows():
         HCGB_aes.print_sepLine("+", 75, False)
         acc_ID = index #strains2get.loc[index]['NCBI_assembly_ID']
         info = "Genus: " + strains2get.loc[index]['genus'] + '\n' + "Species: " +  strains2get.loc[index]['species'] + '\n' + "Strain: " +  strains2get.loc[index]['name'] + '\n' + "ID accession: " +  acc_ID + '\n'
-        dir_path = data_folder + '/genbank/bacteria/' + acc_ID ## module ngd requires to download data in bacteria subfolder under genbank folder
 
         ## check if already exists
         if acc_ID in database_df.index:
@@ -121,17 +134,38 @@ def NCBI_DB(strains2get, data_folder, Debug):
             print (colored(info, 'green'))
 
         else:
-            ## download
-            print ("\n+ Downloading data for:")    
+            print ("\n+ Data to download for:")    
             print (colored(info, 'green'))
-            data_accID = NCBIdownload(acc_ID, strains2get, data_folder)
-            this_db = HCGB_main.get_data(data_accID, ',', 'index_col=0')
-            this_db = this_db.set_index('ID')
-            database_df = database_df.append(this_db)
+            dict_download[acc_ID] = [acc_ID, strains2get, data_folder, mirror, Debug]
+
+    ## check data available in folder or mirror
+    HCGB_aes.print_sepLine("+", 75, False)
+    dict_check = { acc_ID: [os.path.join(data_folder, 'genbank', 'bacteria', acc_ID), acc_ID, mirror]
+                   for acc_ID in dict_download }
+    results = scheduler.run_batch('ncbi', check_download, dict_check, threads, Debug)
+
+    ## download all missing entries at once
+    missing = [ acc_ID for acc_ID, download in results.items() if download is not False ]
+    if missing:
+        ngd_batch_download(missing, data_folder, threads, Debug)
+
+    ## process data: entries not retrieved are downloaded again individually
+    HCGB_aes.print_sepLine("+", 75, False)
+    print ("+ Processing %s entries using %s threads" %(len(dict_download), threads))
+    results = scheduler.run_batch('ncbi', NCBIdownload_retry, dict_download, threads, Debug)
+
+    new_entries = []
+    for acc_ID, data_accID in results.items():
+        if data_accID == 'FAIL':
+            HCGB_aes.error_message("Data could not be downloaded for: %s" %acc_ID)
+            continue
+        this_db = HCGB_main.get_data(data_accID, ',', 'index_col=0')
+        new_entries.append(this_db.set_index('ID'))
 
     ## Generate/Update database
     database_csv = data_folder + '/genbank_database.csv'
-    db_updated = update_db_data_file(database_df, database_csv)
+    ## entries already available are included, as in the csv file
+    db_updated = update_db_data_file(pd.concat([database_df] + new_entries), database_csv, database_folder, 'genbank')
     print ("+ Database has been generated in file: ", database_csv)
     return (db_updated)
 
@@ -145,10 +179,57 @@ def NCBI_descendant(tax_ID, NCBI_folder, Debug):
     ## and call NCBI_DB to download and update database, then returned dataframe.
     
     # Use BacDup implementation for this purpose
-def ngd_download(dir_path, acc_ID, data_folder):
+def mirror_download(dir_path, acc_ID, mirror):
+    """Retrieves genbank files for an assembly from a local mirror.
+
+    The mirror is a folder (or file:// URL) containing a folder for each assembly, either
+    directly (``mirror/acc_ID``) or as downloaded by ncbi_genome_download
+    (``mirror/genbank/bacteria/acc_ID``; e.g. the NCBI folder of another database).
+    Files might be gzipped.
+
+    :returns: True if all files (genome, proteins, GFF and genbank) were retrieved.
+    """
+    if mirror.startswith('file://'):
+        mirror = mirror[len('file://'):]
+    
+    for mirror_path in [os.path.join(mirror, acc_ID), os.path.join(mirror, 'genbank', 'bacteria', acc_ID)]:
+        if not os.path.isdir(mirror_path):
+            continue
+
+        ## CDS and RNA sequences (*_cds_from_genomic.fna, *_rna_from_genomic.fna) are not required
+        files = [f for f in os.listdir(mirror_path) 
+                 if f.replace('.gz', '').endswith(('_genomic.fna', '_genomic.gff', '_genomic.gbff', '_genomic.gbk', '_protein.faa'))
+                 and not any(tag in f for tag in ('_cds_from_', '_rna_from_'))]
+        os.makedirs(dir_path, exist_ok=True)
+        for f in files:
+            shutil.copy(os.path.join(mirror_path, f), dir_path)
+        extract_files_download(dir_path)
+
+        if all(get_files_download(dir_path)):
+            print ('+ Data retrieved from mirror: ', mirror_path)
+            return (True)
+    
+    return (False)
+
+##########################################################################################
+def extract_files_download(dir_path):
+    """Extracts gzipped files downloaded if not extracted yet."""
+    for f in os.listdir(dir_path):
+        if f.endswith('gz') and not os.path.exists(os.path.join(dir_path, f[:-3])):
+            print ("\t- Extracting files: ", f)
+            HCGB_files.extract(os.path.join(dir_path, f), dir_path)
+
+##########################################################################################
+def check_download(dir_path, acc_ID, mirror=None):
+    """Checks whether data for the entry is available in the folder or retrieves it from the mirror.
+
+    :returns: True if data needs to be downloaded.
+    """
     download = False
     print ('+ Check data for ID: ', acc_ID)
     if os.path.exists(dir_path):
+        ## resume: files downloaded but not extracted
+        extract_files_download(dir_path)
         print ('+ Folder already exists: ', dir_path)
         ## get files download
         (genome, prot, gff, gbk) = get_files_download(dir_path)
@@ -160,33 +241,103 @@ def ngd_download(dir_path, acc_ID, data_folder):
     else:
         download = True
     
+    if download and mirror:
+        download = not mirror_download(dir_path, acc_ID, mirror)
+
+    return (download)
+
+##########################################################################################
+def ngd_batch_download(acc_IDs, data_folder, threads, Debug=False, attempts=3):
+    """Downloads several entries with a single call to ncbi_genome_download.
+
+    Entries are downloaded using *threads* parallel connections. Entries still missing are
+    downloaded again until the number of attempts is reached.
+
+    :param acc_IDs: List of NCBI assembly accession IDs.
+    :param data_folder: Absolute path to the NCBI folder of the database.
+    :param threads: Number of parallel downloads.
+
+    :returns: List of entries not downloaded (see :func:`NCBIdownload_retry`).
+    """
+    import ncbi_genome_download as ngd ## only loaded when required
+
+    missing = list(acc_IDs)
+    for attempt in range(1, attempts + 1):
+        print ("+ Downloading %s entries using %s simultaneous downloads" %(len(missing), threads))
+        if Debug:
+            HCGB_aes.debug_message("ngd_batch_download: " + ",".join(missing), "yellow")
+        try:
+            ngd.download(section='genbank', file_formats='fasta,gff,protein-fasta,genbank', 
+                         assembly_accessions=",".join(missing), output=data_folder, groups='bacteria', parallel=threads)
+        except Exception as exc:
+            print (colored("\t** Download failed: %s" %exc, 'yellow'))
+
+        ## check if files are gunzip and complete
+        still_missing = []
+        for acc_ID in missing:
+            dir_path = os.path.join(data_folder, 'genbank', 'bacteria', acc_ID)
+            if os.path.isdir(dir_path):
+                extract_files_download(dir_path)
+                if all(get_files_download(dir_path)):
+                    continue
+            still_missing.append(acc_ID)
+
+        missing = still_missing
+        if not missing:
+            break
+        if attempt < attempts:
+            print (colored("\t** Download failed for %s entries (attempt %s/%s). Retry in %s s" %(len(missing), attempt, attempts, 10 * attempt), 'yellow'))
+            time.sleep(10 * attempt)
+
+    return (missing)
+
+##########################################################################################
+def ngd_download(dir_path, acc_ID, data_folder, mirror=None):
+    download = check_download(dir_path, acc_ID, mirror)
     if download:
         print ('+ Downloading:')
         ## download in data folder provided
+        import ncbi_genome_download as ngd ## only loaded when required
         ngd.download(section='genbank', file_formats='fasta,gff,protein-fasta,genbank', assembly_accessions=acc_ID, output=data_folder, groups='bacteria')
 
         ## check if files are gunzip
-        files = os.listdir(dir_path)
-        files_list = []        
-        for f in files:
-            if f.endswith('gz'):
-                files_list.append(f)
-                print ("\t- Extracting files: ", f)
-                HCGB_files.extract(dir_path + '/' + f, dir_path)
-                #os.remove(dir_path + '/' + f)
+        if os.path.isdir(dir_path):
+            extract_files_download(dir_path)
     else:
         print ('+ Data is already available, no need to download it again')
 
 
 ##########################################################################################
-def NCBIdownload(acc_ID, data, data_folder):    
+def NCBIdownload_retry(acc_ID, data, data_folder, mirror=None, Debug=False, attempts=3):
+    """Calls :func:`NCBIdownload` until all files are available or the number of attempts is reached.
+
+    Files already downloaded are kept between attempts, so only missing files are retrieved again.
+
+    :returns: Absolute path to the information file for the entry.
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            return (NCBIdownload(acc_ID, data, data_folder, mirror))
+        except Exception as exc:
+            if attempt == attempts:
+                raise
+            wait = 10 * attempt
+            print (colored("\t** Download failed for %s (attempt %s/%s): %s. Retry in %s s" %(acc_ID, attempt, attempts, exc, wait), 'yellow'))
+            if Debug:
+                HCGB_aes.debug_message("NCBIdownload_retry: %s" %repr(exc), "yellow")
+            time.sleep(wait)
+
+##########################################################################################
+def NCBIdownload(acc_ID, data, data_folder, mirror=None):    
     
     ## module ngd requires to download data in bacteria subfolder under genbank folder
     dir_path = os.path.join(data_folder, 'genbank', 'bacteria', acc_ID) 
-    ngd_download(dir_path, acc_ID, data_folder)
+    ngd_download(dir_path, acc_ID, data_folder, mirror)
     
     ## get files download
     (genome, prot, gff, gbk) = get_files_download(dir_path)
+    if not all([genome, prot, gff, gbk]):
+        raise IOError("Not all necessary data is available for %s" %acc_ID)
 
     ## check if any plasmids downloaded
     plasmid_count = 0
@@ -194,6 +345,10 @@ def NCBIdownload(acc_ID, data, data_folder):
     contig_out_file = dir_path + '/' + acc_ID + '_chromosome.fna'
     plasmid_out_file = dir_path + '/' + acc_ID + '_plasmid.fna' 
     
+    ## plasmids are appended: remove file from previous attempts
+    if os.path.exists(plasmid_out_file):
+        os.remove(plasmid_out_file)
+
     ## open
     contig_out_file_handle = open(contig_out_file, 'w')
     for seq_record in SeqIO.parse(genome, "fasta"):
@@ -212,7 +367,7 @@ def NCBIdownload(acc_ID, data, data_folder):
         else:
             contig_out_file_handle.write(seq_record.format("fasta"))
             contig_out_file_handle.write('\n')
-            contig_out_file_handle.close()
+    contig_out_file_handle.close()
 
     ## no plasmids found
     if plasmid_count == 0:
@@ -258,16 +413,43 @@ def get_files_download(folder):
     return(genome, prot, gff, gbk)            
 
 ##########################################################################################
-def get_database(db_frame, Debug):
+def get_database(db_frame, Debug, database_folder=None, source=None):
+    """Retrieves information (info.txt) for each entry of the database provided.
+
+    If *database_folder* is provided, information is retrieved from the catalog and files
+    are only read if they changed (see :func:`BacterialTyper.scripts.db_catalog.read_samples_info`).
+
+    :param db_frame: Dataframe with entries, as returned by :func:`getdbs`.
+    :param Debug: True/False for debugging messages.
+    :param database_folder: Absolute path to the database folder containing the catalog.
+    :param source: genbank or user_data.
+
+    :returns: Dataframe indexed by ID.
+    """
     data4db = pd.DataFrame()
+
+    ## information files
+    info_files = {}
     for index, row in db_frame.iterrows():
-        ## information
         this_file = db_frame.loc[index]['path'] + '/info.txt'
         if os.path.isfile(this_file):
+            info_files[str(db_frame.loc[index]['db'])] = this_file
+
+    ## retrieve all entries from catalog at once
+    if database_folder:
+        info_dict = db_catalog.read_samples_info(database_folder, source, info_files)
+
+    for index, row in db_frame.iterrows():
+        ## information
+        this_file = info_files.get(str(db_frame.loc[index]['db']))
+        if this_file:
             print ('+ Reading information for sample: ', db_frame.loc[index]['db'])
-            print (colored("\t+ Obtaining information from file: %s" %this_file, 'yellow'))
-            this_db = HCGB_main.get_data(this_file, ',', 'index_col=0')
-            data4db = data4db.append(this_db)
+            if database_folder:
+                this_db = info_dict[str(db_frame.loc[index]['db'])]
+            else:
+                print (colored("\t+ Obtaining information from file: %s" %this_file, 'yellow'))
+                this_db = HCGB_main.get_data(this_file, ',', 'index_col=0')
+            data4db = pd.concat([data4db, this_db])
             timestamp = db_frame.loc[index]['path'] + '/.success'
             if os.path.isfile(timestamp):
                 stamp =    HCGB_time.read_time_stamp(timestamp)
@@ -282,14 +464,38 @@ def get_database(db_frame, Debug):
     return(data4db)
 
 ##########################################################################################
-def update_db_data_file(data, csv):
+def update_db_data_file(data, csv, database_folder=None, source=None):
+    """Updates the database with the entries provided and saves all entries in the csv file.
+
+    If *database_folder* is provided, entries are updated in the catalog of the database
+    (see :mod:`BacterialTyper.scripts.db_catalog`) and the csv file is exported from it. If the
+    catalog is not available, the csv file is updated instead.
+
+    :param data: Dataframe indexed by ID.
+    :param csv: Absolute path to the csv file.
+    :param database_folder: Absolute path to the database folder containing the catalog.
+    :param source: genbank or user_data.
+
+    :returns: Dataframe with all entries.
+    """
+    if database_folder:
+        print ("\n+ Updating database catalog: %s" %os.path.join(database_folder, db_catalog.catalog_name))
+        if data.empty or db_catalog.update_samples(database_folder, source, data):
+            df = db_catalog.get_samples(database_folder, source)
+            if not df.empty:
+                df.to_csv(csv)
+                return (df)
+    
     if os.path.isfile(csv):
         print ("\n+ Updating database")
         print ("+ Obtaining information from database file: %s" %csv)
         db2update = HCGB_main.get_data(csv, ',', 'index_col=0')
         
         ## TODO: provide preference to db2update
-        df = pd.concat([db2update, data], join='inner', sort=True).drop_duplicates()
+        if data.empty:
+            df = db2update
+        else:
+            df = pd.concat([db2update, data], join='inner', sort=True).drop_duplicates()
         df.to_csv(csv)
         return (df)
     else:
@@ -546,7 +752,7 @@ def getdbs(source, database_folder, option, debug):
         if dbs2use[0] == 'genbank':
             ##
             if os.path.exists(path_genbank + '/bacteria'):
-                genbank_entries = os.listdir(os.path.join(path_genbank, 'bacteria'))
+                genbank_entries = db_catalog.list_folder(database_folder, os.path.join(path_genbank, 'bacteria'))
                 for entry in genbank_entries:
                     this_db = os.path.join(path_genbank,'bacteria', entry)
                     stamp = time.time() ## to do add time
@@ -562,7 +768,7 @@ def getdbs(source, database_folder, option, debug):
         ### Check if folder exists
         db2use_abs = HCGB_files.create_subfolder(dbs2use[0], database_folder)
 
-        user_entries = os.listdir(db2use_abs)
+        user_entries = db_catalog.list_folder(database_folder, db2use_abs)
         for entry in user_entries:
             this_db = db2use_abs + '/' + entry
             stamp = time.time() ## to do add time
@@ -609,7 +815,7 @@ def getdbs(source, database_folder, option, debug):
                 db2use_abs = database_folder + '/NCBI/genbank/bacteria'
                 if os.path.exists(db2use_abs):
                     print (colored("\n\t- genbank: including information from different reference strains available.", 'green')) ## include data from NCBI
-                    genbank_entries = os.listdir(db2use_abs)
+                    genbank_entries = db_catalog.list_folder(database_folder, db2use_abs)
                     for entry in genbank_entries:
                         print ('\t+ Reading information from sample: ', entry)
                         this_db = db2use_abs + '/' + entry
@@ -652,11 +858,8 @@ def getdbs(source, database_folder, option, debug):
             elif (db == "user_data"):
                 print (colored("\n\t- user_data: including information from user previously generated results", 'green')) ## include user data
                 db2use_abs = HCGB_files.create_subfolder('user_data', database_folder)
-                user_entries = os.listdir(db2use_abs)
+                user_entries = db_catalog.list_folder(database_folder, db2use_abs)
                 for entry in user_entries:
-                    if entry == 'user_database.csv':
-                        continue
-                    
                     print ('\t+ Reading information from sample: ', entry)
                     this_db = db2use_abs + '/' + entry
                     this_mash_db = this_db + '/mash/' + entry + '.sig'
@@ -753,6 +956,9 @@ def getdbs(source, database_folder, option, debug):
     
     ## index by id    
     db_Dataframe = db_Dataframe.set_index("db", drop = False)            
+
+    ## register in catalog
+    db_catalog.register_dbs(database_folder, db_Dataframe)
     return (db_Dataframe)
 
 ####################################
@@ -13,20 +13,37 @@ Prepares the database information for further analysis. Several functions are im
 import os
 import numpy as np
 import pandas as pd
+import json
 import shutil
+import threading
 from termcolor import colored
 import concurrent.futures
 
 ## import my modules
 from BacterialTyper.scripts import database_generator
+from BacterialTyper.scripts import project_index
+from BacterialTyper.scripts import result_cache
 
 ## HCGB module
-from HCGB import sampleParser
 import HCGB.functions.time_functions as HCGB_time
 import HCGB.functions.aesthetics_functions as HCGB_aes
 import HCGB.functions.files_functions as HCGB_files
 import HCGB.functions.main_functions as HCGB_main
 
+## modes to deposit project files into user_data:
+##   copy: copy files
+##   link: hardlink files (reflink or copy if not possible, e.g. across filesystems).
+##         Project and database files share content: do not edit project files in place.
+##   reflink: copy-on-write clone (copy if not supported by the filesystem)
+deposit_modes = ['copy', 'link', 'reflink']
+
+## index of content deposited (sha256 -> path relative to user_data), used to deduplicate files
+deposit_index_name = '.deposit_index.json'
+deposit_lock = threading.Lock()
+
+## ioctl to clone a file (linux/fs.h)
+FICLONE = 0x40049409
+
 ##########################################################################################
 def update_database_user_data(database_folder, project_folder, Debug, options):
     """
@@ -74,6 +91,8 @@ def update_database_user_data(database_folder, project_folder, Debug, options):
     
     ## create folder
     own_data = HCGB_files.create_subfolder("user_data", database_folder)
+    deposit_mode = getattr(options, 'deposit_mode', 'reflink')
+    deposited = read_deposit_index(own_data)
     
     ## Default missing options
     options.project = True
@@ -109,7 +128,7 @@ def update_database_user_data(database_folder, project_folder, Debug, options):
     
     print ('\n+ Get database information')
     db_frame = database_generator.getdbs('user_data', database_folder, 'user_data', Debug)
-    user_data_db = database_generator.get_database(db_frame, Debug)
+    user_data_db = database_generator.get_database(db_frame, Debug, database_folder, 'user_data')
     
     ## merge dataframe
     sample_frame = project_all_data.groupby("name")
@@ -129,6 +148,7 @@ def update_database_user_data(database_folder, project_folder, Debug, options):
 
     
     print ('\n+ Updating information using %s threads and %s parallel jobs' %(options.threads, max_workers_int))
+    print ('+ Files deposited in database using mode: %s' %deposit_mode)
 
     ####################################
     ## loop through frame using multiple threads
@@ -136,7 +156,8 @@ def update_database_user_data(database_folder, project_folder, Debug, options):
     with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers_int) as executor:
         ## send for each    
         commandsSent = { executor.submit(update_sample, name, cluster, 
-                                        own_data, user_data_db, Debug): name for name, cluster in sample_frame }
+                                        own_data, user_data_db, Debug, 
+                                        deposit_mode, deposited, threads_job): name for name, cluster in sample_frame }
         for cmd2 in concurrent.futures.as_completed(commandsSent):
             details = commandsSent[cmd2]
             try:
@@ -146,6 +167,8 @@ def update_database_user_data(database_folder, project_folder, Debug, options):
                 print (cmd2)
                 print('%r generated an exception: %s' % (details, exc))
     
+    write_deposit_index(own_data, deposited)
+    
     HCGB_aes.print_sepLine("+", 75, False)
     print ("\n+ Retrieve information ...")
 
@@ -178,7 +201,7 @@ def update_database_user_data(database_folder, project_folder, Debug, options):
     ####################################
     database_csv = own_data + '/user_database.csv'
     
-    dataUpdated = database_generator.update_db_data_file(user_data_db, database_csv)
+    dataUpdated = database_generator.update_db_data_file(user_data_db, database_csv, database_folder, 'user_data')
     print ("+ Database has been generated: \n", database_csv)
     return (dataUpdated)
 
@@ -186,12 +209,13 @@ def update_database_user_data(database_folder, project_folder, Debug, options):
 ##########################################################################################
 def get_userData_files(options, project_folder):
     ## get information regarding files
+    ## files are retrieved from the index of the project (see project_index)
 
     ## get trimmed ngs files
     print()
     HCGB_aes.print_sepLine("-", 60, 'yellow')
     print ("+ Retrieve trimmed reads information:")
-    pd_samples_reads = sampleParser.files.get_files(
+    pd_samples_reads = project_index.get_files(
         options, project_folder, "trim", ['_trim'], options.debug)
     pd_samples_reads = pd_samples_reads.set_index('name')
     HCGB_aes.print_sepLine("-", 60, 'yellow')
@@ -200,11 +224,10 @@ def get_userData_files(options, project_folder):
     print()
     HCGB_aes.print_sepLine("-", 60, 'yellow')
     print ("+ Retrieve assembly information:")
-    pd_samples_assembly = sampleParser.files.get_files(options=options, 
-                                                       input_dir=project_folder, mode= "assembly", 
-                                                       extension=["fna"], 
-                                                       debug=options.debug, bam=False, 
-                                                       append_discard_list=['annot', 'agr_results'])
+    pd_samples_assembly = project_index.get_files(options=options, 
+                                                  input_dir=project_folder, mode= "assembly", 
+                                                  extension=["fna"], debug=options.debug, 
+                                                  append_discard_list=['annot', 'agr_results'])
     
     pd_samples_assembly = pd_samples_assembly.set_index('name')
     HCGB_aes.print_sepLine("-", 60, 'yellow')
@@ -213,11 +236,10 @@ def get_userData_files(options, project_folder):
     print()
     HCGB_aes.print_sepLine("-", 60, 'yellow')
     print ("+ Retrieve annotation information:")
-    pd_samples_annot = sampleParser.files.get_files(options=options, 
-                                                    input_dir=project_folder, mode= "annot", 
-                                                    extension=['gbf', 'faa', 'gff'], 
-                                                    debug=options.debug, bam=False,
-                                                    append_discard_list=['assemble'])
+    pd_samples_annot = project_index.get_files(options=options, 
+                                               input_dir=project_folder, mode= "annot", 
+                                               extension=['gbf', 'faa', 'gff'], debug=options.debug, 
+                                               append_discard_list=['assemble'])
     pd_samples_annot = pd_samples_annot.set_index('name')
     HCGB_aes.print_sepLine("-", 60, 'yellow')
 
@@ -269,9 +291,9 @@ def get_userData_info(options, project_folder):
     print()
     HCGB_aes.print_sepLine("-", 60, 'yellow')
     print ("+ Retrieve virulence/resistance profile information:")
-    pd_samples_profile = sampleParser.files.get_files(options, project_folder, 
-                                                      "profile", ["csv", "tsv"], 
-                                                      options.debug)
+    pd_samples_profile = project_index.get_files(options, project_folder, 
+                                                 "profile", ["csv", "tsv"], 
+                                                 options.debug)
     pd_samples_profile.set_index('name', drop=False)
     HCGB_aes.print_sepLine("-", 60, 'yellow')
 
@@ -281,9 +303,9 @@ def get_userData_info(options, project_folder):
     print()
     HCGB_aes.print_sepLine("-", 60, 'yellow')
     print ("+ Retrieve species identification information:")
-    pd_samples_ident = sampleParser.files.get_files(options, project_folder, 
-                                                    "ident", ["csv", 'species.csv'], 
-                                                    options.debug)
+    pd_samples_ident = project_index.get_files(options, project_folder, 
+                                               "ident", ["csv", 'species.csv'], 
+                                               options.debug)
     
     if not pd_samples_ident.empty:
         pd_samples_ident = pd_samples_ident.set_index('name')
@@ -294,8 +316,8 @@ def get_userData_info(options, project_folder):
     print()
     HCGB_aes.print_sepLine("-", 60, 'yellow')
     print ("+ Retrieve cluster information:")
-    pd_samples_mash = sampleParser.files.get_files(options, project_folder, 
-                                                   "mash", ["sig"], options.debug)
+    pd_samples_mash = project_index.get_files(options, project_folder, 
+                                              "mash", ["sig"], options.debug)
     if not pd_samples_mash.empty:
         pd_samples_mash = pd_samples_mash.set_index('name')
     HCGB_aes.print_sepLine("-", 60, 'yellow')
@@ -339,7 +361,124 @@ def get_userData_info(options, project_folder):
     return(df)
 
 ############################################
-def update_sample(name, cluster, own_data, user_data_db, Debug):
+def read_deposit_index(own_data):
+    """Returns dictionary with content (sha256) of files deposited in user_data and their absolute path."""
+    index_file = os.path.join(own_data, deposit_index_name)
+    if not os.path.isfile(index_file):
+        return ({})
+    try:
+        with open(index_file) as fh:
+            return ({ key: os.path.join(own_data, path) for key, path in json.load(fh).items() })
+    except (ValueError, OSError):
+        return ({})
+
+############################################
+def write_deposit_index(own_data, deposited):
+    """Saves index of content deposited in user_data. Files no longer available are discarded."""
+    index = { key: os.path.relpath(path, own_data) for key, path in deposited.items() if os.path.isfile(path) }
+    index_file = os.path.join(own_data, deposit_index_name)
+    tmp_file = index_file + '.tmp' + str(os.getpid())
+    with open(tmp_file, 'w') as fh:
+        json.dump(index, fh, indent=1, sort_keys=True)
+    os.replace(tmp_file, index_file)
+
+############################################
+def reflink_file(src, dest):
+    """Creates dest as a copy-on-write clone of src (e.g. btrfs, XFS). Raises OSError if not supported."""
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError("Reflinks not supported in this system")
+
+    fh_dest = open(dest, 'wb')
+    try:
+        with open(src, 'rb') as fh_src:
+            fcntl.ioctl(fh_dest.fileno(), FICLONE, fh_src.fileno())
+    except OSError:
+        fh_dest.close()
+        os.remove(dest)
+        raise
+    fh_dest.close()
+
+############################################
+def deposit_file(src, dest_dir, deposit_mode='copy', deposited=None, Debug=False):
+    """Deposits a project file into a folder of the database.
+
+    Files already deposited are kept if they are the same file (hardlink) or have the same size
+    and were not modified after being deposited, so files are not read again. Files with the same
+    content than a file already in the database (see *deposited*) are linked to it. Otherwise, 
+    files are hardlinked, reflinked or copied according to *deposit_mode* (see :data:`deposit_modes`).
+    Checksum of files reflinked or copied is verified.
+
+    :param src: Absolute path to the project file.
+    :param dest_dir: Absolute path to the database folder.
+    :param deposit_mode: copy, link or reflink.
+    :param deposited: Dictionary with content (sha256) and path of files in the database.
+    :param Debug: True/False for debugging messages.
+
+    :returns: Absolute path to the file deposited.
+    """
+    if deposited is None:
+        deposited = {}
+    dest = os.path.join(dest_dir, os.path.basename(src))
+    src_stat = os.stat(src)
+
+    ## already deposited
+    if os.path.exists(dest):
+        dest_stat = os.stat(dest)
+        if os.path.samestat(src_stat, dest_stat) or (
+            dest_stat.st_size == src_stat.st_size and dest_stat.st_mtime >= src_stat.st_mtime):
+            return (dest)
+        print (colored("\t\t+ File %s changed in project: deposit it again" %os.path.basename(src), 'yellow'))
+
+    ## same content already in database: content is only read if any file is available to link
+    origin = src
+    src_hash = None
+    with deposit_lock:
+        lookup = deposit_mode != 'copy' and bool(deposited)
+    if lookup:
+        src_hash = result_cache.file_hash(src)
+        with deposit_lock:
+            stored = deposited.get(src_hash, '')
+        if os.path.isfile(stored) and result_cache.file_hash(stored) == src_hash:
+            origin = stored
+
+    tmp_file = dest + '.tmp' + str(threading.get_ident())
+    method = 'copy'
+    if deposit_mode == 'link':
+        try:
+            os.link(origin, tmp_file)
+            method = 'hardlink'
+        except OSError:
+            pass
+    if method == 'copy' and deposit_mode in ('link', 'reflink'):
+        try:
+            reflink_file(origin, tmp_file)
+            method = 'reflink'
+        except OSError:
+            pass
+    if method == 'copy':
+        shutil.copy(origin, tmp_file)
+
+    ## verify checksum: hardlinks are the same file
+    if not os.path.samefile(tmp_file, origin):
+        if src_hash is None:
+            src_hash = result_cache.file_hash(src)
+        if result_cache.file_hash(tmp_file) != src_hash:
+            os.remove(tmp_file)
+            raise IOError("Checksum of file deposited does not match: %s" %src)
+    os.replace(tmp_file, dest)
+
+    if src_hash:
+        with deposit_lock:
+            deposited.setdefault(src_hash, dest)
+
+    if Debug:
+        HCGB_aes.debug_message("Deposit %s -> %s [%s]" %(origin, dest, method), "yellow")
+    return (dest)
+
+############################################
+def update_sample(name, cluster, own_data, user_data_db, Debug, deposit_mode='copy', deposited=None, threads=1):
 
     ## debug message    
     if (Debug):
@@ -363,6 +502,11 @@ def update_sample(name, cluster, own_data, user_data_db, Debug):
         print (colored("\t\t+ Data available in database for sample: %s. Checking integrity..." %name, 'yellow'))
         #functions.print_sepLine("+", 75, False)
 
+    ## files to deposit: (project file, database folder)
+    files2deposit = []
+    if deposited is None:
+        deposited = {}
+
     ## data to generate
     data2dump = pd.DataFrame(columns=('ID','folder','genus','species','name',
                                       'genome', 'GFF','proteins', 'signature', 
@@ -377,8 +521,7 @@ def update_sample(name, cluster, own_data, user_data_db, Debug):
     if assembly_file:
         assembly_file_name = os.path.basename(assembly_file[0])
         genome = assembly_dir + '/' + assembly_file_name
-        if not os.path.exists(genome):
-            shutil.copy(assembly_file[0], assembly_dir)
+        files2deposit.append((assembly_file[0], assembly_dir))
     else:
         genome = ""
 
@@ -387,20 +530,16 @@ def update_sample(name, cluster, own_data, user_data_db, Debug):
     ##########
     annot_dir = HCGB_files.create_subfolder('annot', dir_sample)
     annot_files = cluster.loc[cluster['tag'] == 'annot']['sample'].to_list()
-    prof = ""
+    prot = ""
     gff = ""
     if annot_files:
         for f in annot_files:
             file_name = os.path.basename(f)
             if f.endswith('faa'):
                 prot = annot_dir + '/' + file_name
-                if os.path.exists(prot):
-                    continue
             elif f.endswith('gff'):
                 gff = annot_dir + '/' + file_name
-                if os.path.exists(gff):
-                    continue
-            shutil.copy(f, annot_dir)
+            files2deposit.append((f, annot_dir))
     else:
         gff = ""
         prot = ""
@@ -416,8 +555,7 @@ def update_sample(name, cluster, own_data, user_data_db, Debug):
             file_name = os.path.basename(f)
             reads_name = trimm_dir + '/' + file_name
             reads.append(reads_name)
-            if not os.path.exists(reads_name):
-                shutil.copy(f, trimm_dir)
+            files2deposit.append((f, trimm_dir))
 
     ##########
     ## ident
@@ -427,8 +565,7 @@ def update_sample(name, cluster, own_data, user_data_db, Debug):
     if ident_file:
         file_name = os.path.basename(ident_file[0])
         ident_file_name = ident_dir + '/' + file_name
-        if not os.path.exists(ident_file_name):
-            shutil.copy(ident_file[0], ident_dir)
+        files2deposit.append((ident_file[0], ident_dir))
     else:
         ident_file_name = ""
     
@@ -443,8 +580,7 @@ def update_sample(name, cluster, own_data, user_data_db, Debug):
             file_name = os.path.basename(f)
             profile_file_name = profile_dir + '/' + file_name
             profile_file.append(profile_file_name)
-            if not os.path.exists(profile_file_name):
-                shutil.copy(f, profile_dir)
+            files2deposit.append((f, profile_dir))
     
     ##########
     ## mash profile
@@ -454,11 +590,19 @@ def update_sample(name, cluster, own_data, user_data_db, Debug):
     if mash_file:
         file_name = os.path.basename(mash_file[0])
         sig_file = mash_dir + '/' + file_name
-        if not os.path.exists(sig_file):
-            shutil.copy(mash_file[0], mash_dir)
+        files2deposit.append((mash_file[0], mash_dir))
     else:
         sig_file = ""
     
+    ############################################
+    ### Deposit files
+    ############################################
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        commandsSent = { executor.submit(deposit_file, f, folder, deposit_mode, deposited, Debug): f for f, folder in files2deposit }
+        for cmd2 in concurrent.futures.as_completed(commandsSent):
+            ## raises exception and sample is not updated if any file fails
+            cmd2.result()
+
     ############################################
     ### Dump information
 
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+############################################################
+## Jose F. Sanchez                                        ##
+## Copyright (C) 2019-2021 Lauro Sumoy Lab, IGTP, Spain   ##
+############################################################
+"""
+Catalog of the BacterialTyper database folder.
+
+A single SQLite file (:data:`catalog_name`) in the database folder stores:
+
+    - dbs: databases available (genbank, user_data, KMA, ARIBA, Mash, AMRfinder, kraken...)
+      with path, timestamp and checksum, recorded when databases are retrieved (see
+      :func:`BacterialTyper.scripts.database_generator.getdbs`) to track changes.
+    - samples: information (``info.txt``) of each genbank and user_data entry with
+      checksum and modification time, so files are only read again if they change.
+    - folders: listing of database folders, updated if their modification time changes.
+
+Tables are indexed by source and name, so lookups do not require reading CSV files or
+listing folders. Connections wait for other writers (several threads or processes)
+to finish instead of failing. If the catalog cannot be created or written (e.g. read-only
+database folder), information is read from files as if no catalog was available.
+"""
+## useful imports
+import os
+import json
+import sqlite3
+import hashlib
+import pandas as pd
+from termcolor import colored
+
+from BacterialTyper.scripts import result_cache
+
+import HCGB.functions.main_functions as HCGB_main
+
+## catalog file within the database folder
+catalog_name = 'catalog.sqlite'
+
+## seconds to wait for other writers
+catalog_timeout = 120
+
+## errors raised if the catalog cannot be created, read or written
+catalog_errors = (sqlite3.Error, OSError)
+
+## database folders with catalog not available, reported only once
+catalog_unavailable = set()
+
+catalog_schema = """
+CREATE TABLE IF NOT EXISTS dbs (
+    source TEXT NOT NULL, db TEXT NOT NULL, path TEXT, timestamp TEXT, checksum TEXT, mtime REAL,
+    PRIMARY KEY (source, db));
+CREATE TABLE IF NOT EXISTS samples (
+    source TEXT NOT NULL, ID TEXT NOT NULL, folder TEXT, info TEXT, checksum TEXT, mtime REAL, size INTEGER,
+    PRIMARY KEY (source, ID));
+CREATE TABLE IF NOT EXISTS folders (
+    path TEXT PRIMARY KEY, mtime INTEGER, entries TEXT);
+"""
+
+############
+def connect(database_folder):
+    """Returns connection to the catalog of the database folder, creating it if necessary.
+
+    The default rollback journal is used instead of WAL, as the latter is not supported in
+    network filesystems (NFS).
+    """
+    conn = sqlite3.connect(os.path.join(database_folder, catalog_name), timeout=catalog_timeout)
+    try:
+        conn.executescript(catalog_schema)
+    except sqlite3.OperationalError:
+        ## read-only catalog: use it if tables are available
+        if not conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall():
+            conn.close()
+            raise
+    return (conn)
+
+############
+def unavailable(database_folder, err):
+    """Reports that the catalog of the database folder is not available (only once per folder)."""
+    if database_folder not in catalog_unavailable:
+        catalog_unavailable.add(database_folder)
+        print (colored("** Catalog of database %s not available (%s): information is read from files." %(database_folder, err), 'yellow'))
+
+############
+def write(database_folder, statement, rows):
+    """Executes the statement for each row within a single transaction.
+
+    The lock is acquired when the transaction starts so that concurrent writers wait
+    for each other (see :data:`catalog_timeout`).
+
+    :returns: True if rows were written or False if the catalog is not available (see :data:`catalog_errors`).
+    """
+    try:
+        conn = connect(database_folder)
+    except catalog_errors as err:
+        unavailable(database_folder, err)
+        return (False)
+
+    try:
+        conn.isolation_level = None
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany(statement, rows)
+        conn.execute("COMMIT")
+    except Exception as err:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        if not isinstance(err, catalog_errors):
+            raise
+        unavailable(database_folder, err)
+        return (False)
+    finally:
+        conn.close()
+    return (True)
+
+############
+def query(database_folder, statement, params=()):
+    """Returns rows retrieved for the statement provided or no rows if the catalog is not available."""
+    try:
+        conn = connect(database_folder)
+    except catalog_errors as err:
+        unavailable(database_folder, err)
+        return ([])
+
+    try:
+        return (conn.execute(statement, params).fetchall())
+    except catalog_errors as err:
+        unavailable(database_folder, err)
+        return ([])
+    finally:
+        conn.close()
+
+############
+def path_checksum(path):
+    """Returns checksum for a database path using names, sizes and modification times.
+
+    Databases (KMA, kraken2...) might take several GB, so content is not read. Paths
+    that are a prefix of several files (e.g. KMA databases) include all of them.
+    """
+    if os.path.isdir(path):
+        return (result_cache.folder_hash(path))
+
+    folder = os.path.dirname(path)
+    prefix = os.path.basename(path)
+    sha = hashlib.sha256()
+    if os.path.isdir(folder):
+        for each_file in sorted(os.listdir(folder)):
+            if each_file.startswith(prefix):
+                stat = os.stat(os.path.join(folder, each_file))
+                sha.update(("%s\t%s\t%s\n" %(each_file, stat.st_size, stat.st_mtime)).encode())
+    return (sha.hexdigest())
+
+############
+def register_dbs(database_folder, db_frame):
+    """Adds or updates databases in the catalog.
+
+    :param database_folder: Absolute path to the database folder.
+    :param db_frame: Dataframe with columns source, db, path and timestamp (see
+        :func:`BacterialTyper.scripts.database_generator.getdbs`).
+    """
+    if db_frame.empty or not os.path.isdir(database_folder):
+        return
+
+    ## read-only database folder: checksums are not computed
+    if not os.access(database_folder, os.W_OK) and not os.path.isfile(os.path.join(database_folder, catalog_name)):
+        return
+
+    ## checksums are computed again only if path or modification time changed and only
+    ## databases changed are written, so reading databases does not lock the catalog. 
+    ## Timestamps are not compared as most of them are the time of the call.
+    registered = { (source, db): (path, mtime, checksum) for (source, db, path, mtime, checksum) in
+                   query(database_folder, "SELECT source, db, path, mtime, checksum FROM dbs") }
+    rows = []
+    for row in db_frame[["source", "db", "path", "timestamp"]].itertuples(index=False):
+        path = str(row.path)
+        mtime = os.path.getmtime(path) if os.path.exists(path) else None
+        previous = registered.get((row.source, str(row.db)))
+        if previous and previous[0] == path and previous[1] == mtime:
+            continue
+        rows.append((row.source, str(row.db), path, str(row.timestamp), path_checksum(path), mtime))
+
+    if rows:
+        write(database_folder,
+              "INSERT OR REPLACE INTO dbs (source, db, path, timestamp, checksum, mtime) VALUES (?,?,?,?,?,?)", rows)
+
+############
+def list_folder(database_folder, folder):
+    """Returns names of subfolders within the folder. Folder is only listed again if its modification time changed."""
+    if not os.path.isdir(folder):
+        return ([])
+    mtime = os.stat(folder).st_mtime_ns
+    rows = query(database_folder, "SELECT mtime, entries FROM folders WHERE path = ?", (folder,))
+    if rows and rows[0][0] == mtime:
+        return (json.loads(rows[0][1]))
+
+    ## catalog not updated if not available (see :func:`write`)
+    entries = sorted(entry.name for entry in os.scandir(folder) if entry.is_dir())
+    write(database_folder, "INSERT OR REPLACE INTO folders (path, mtime, entries) VALUES (?,?,?)",
+          [(folder, mtime, json.dumps(entries))])
+    return (entries)
+
+############
+def read_samples_info(database_folder, source, info_files):
+    """Returns information of genbank or user_data entries.
+
+    Entries of the source are retrieved from the catalog with a single query and information
+    files are only read if they changed since they were added to the catalog.
+
+    :param database_folder: Absolute path to the database folder.
+    :param source: genbank or user_data.
+    :param info_files: Dictionary with entry name and absolute path to its information file (info.txt).
+
+    :returns: Dictionary with entry name and dataframe as read by :func:`HCGB.functions.main_functions.get_data`.
+    """
+    catalog = { ID: (info, mtime, size) for (ID, info, mtime, size) in
+                query(database_folder, "SELECT ID, info, mtime, size FROM samples WHERE source = ?", (source,)) }
+
+    info_dict = {}
+    rows = []
+    for ID, info_file in info_files.items():
+        stat = os.stat(info_file)
+        previous = catalog.get(ID)
+        if previous and previous[1] == stat.st_mtime and previous[2] == stat.st_size:
+            info_dict[ID] = pd.DataFrame(json.loads(previous[0]))
+            continue
+
+        this_db = HCGB_main.get_data(info_file, ',', 'index_col=0')
+        info = json.dumps(this_db.to_dict(orient='records'), default=str)
+        rows.append((source, ID, os.path.dirname(info_file), info, result_cache.file_hash(info_file), stat.st_mtime, stat.st_size))
+        info_dict[ID] = this_db
+
+    ## catalog not updated if not available (see :func:`write`)
+    if rows:
+        write(database_folder,
+              "INSERT OR REPLACE INTO samples (source, ID, folder, info, checksum, mtime, size) VALUES (?,?,?,?,?,?,?)", rows)
+    return (info_dict)
+
+############
+def update_samples(database_folder, source, data):
+    """Adds or updates entries of the source in the catalog.
+
+    :param database_folder: Absolute path to the database folder.
+    :param source: genbank or user_data.
+    :param data: Dataframe indexed by ID with the information for each entry.
+
+    :returns: True if entries were updated or False if the catalog is not available.
+    """
+    rows = []
+    for ID, row in data.iterrows():
+        info = json.dumps([dict({'ID': ID}, **row.to_dict())], default=str)
+        folder = row.get('folder', '')
+        info_file = os.path.join(str(folder), 'info.txt')
+        if os.path.isfile(info_file):
+            stat = os.stat(info_file)
+            rows.append((source, str(ID), folder, info, result_cache.file_hash(info_file), stat.st_mtime, stat.st_size))
+        else:
+            rows.append((source, str(ID), folder, info, '', None, None))
+
+    if not rows:
+        return (True)
+    return (write(database_folder,
+                  "INSERT OR REPLACE INTO samples (source, ID, folder, info, checksum, mtime, size) VALUES (?,?,?,?,?,?,?)", rows))
+
+############
+def get_samples(database_folder, source):
+    """Returns dataframe indexed by ID with the information of all entries of the source in the catalog."""
+    rows = query(database_folder, "SELECT info FROM samples WHERE source = ? ORDER BY ID", (source,))
+    records = [ record for (info,) in rows for record in json.loads(info) ]
+    if not records:
+        return (pd.DataFrame())
+    return (pd.DataFrame(records).set_index('ID'))
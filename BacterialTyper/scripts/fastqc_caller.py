@@ -16,13 +16,6 @@ from sys import argv
 from io import open
 import pandas as pd
 
-import matplotlib
-matplotlib.use('agg')
-import matplotlib.pyplot as plt
-from pandas.plotting import table
-from matplotlib.backends.backend_pdf import PdfPages
-import numpy as np
-
 ## import my modules
 import HCGB
 import HCGB.functions.system_call_functions as HCGB_sys
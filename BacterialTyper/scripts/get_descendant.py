@@ -21,7 +21,6 @@ import pandas as pd
 from sys import argv
 from io import open
 from termcolor import colored
-from ete3 import NCBITaxa
 
 ## import my modules
 from BacterialTyper.scripts import functions
@@ -32,6 +31,7 @@ from BacterialTyper.scripts import edirect_caller
 def NCBItaxa_db(dbfile_path):
 	
 	# Generate the ete3 NCBI taxa object
+	from ete3 import NCBITaxa ## only loaded when required
 	ncbi = NCBITaxa(dbfile_path)
 
 	## check days passed
@@ -6,15 +6,66 @@ Created on Fri Oct 20 11:52:43 2023
 @author: jsanchez
 """
 import os
+import gzip
+import json
+import time
+import subprocess
+from collections import Counter
 from termcolor import colored
 from BacterialTyper.config import set_config
+from BacterialTyper.scripts import result_cache
 import HCGB.functions.system_call_functions as HCGB_sys
-import HCGB.functions.time_functions as HCGB_time
 import HCGB.functions.aesthetics_functions as HCGB_aes
 import HCGB.functions.files_functions as HCGB_file
+import numpy as np
 import pandas as pd
 
 
+## kraken2 database files
+db_files = ('hash.k2d', 'opts.k2d', 'taxo.k2d')
+
+## memory (GB) required by each kraken2 job besides the database, as the database is
+## memory-mapped (--memory-mapping) and shared among jobs through the page cache
+job_memory = 1
+
+## per-read output of kraken2: 
+##   full: saved as is (sample.kraken2)
+##   compress: summarized and saved compressed (sample.kraken2.gz)
+##   summary: summarized and discarded
+read_output_modes = ('full', 'compress', 'summary')
+
+##################################################
+def db_size(db_fold):
+    """Returns size (GB) of the kraken2 database files"""
+    return (sum(os.path.getsize(os.path.join(db_fold, f)) for f in db_files 
+                if os.path.isfile(os.path.join(db_fold, f))) / 1024**3)
+
+##################################################
+def preload_db(db_fold, Debug=False, block_size=64*1024**2):
+    """Reads kraken2 database files into the page cache once before sending jobs.
+
+    Jobs using --memory-mapping then share the database pages in memory instead of 
+    reading the database from disk each of them.
+
+    :returns: Size of the database (GB).
+    """
+    start = time.time()
+    for f in db_files:
+        db_file = os.path.join(db_fold, f)
+        if not os.path.isfile(db_file):
+            continue
+        with open(db_file, 'rb') as fh:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(fh.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+            while fh.read(block_size):
+                pass
+
+    size = db_size(db_fold)
+    print ("+ Kraken2 database loaded in page cache: %.1f GB in %.1f s" %(size, time.time() - start))
+    if Debug:
+        HCGB_aes.debug_message("Database folder: %s" %db_fold, "yellow")
+    return (size)
+
 ##################################################
 def get_dbs(db_name, fold, Debug=False):
     ## TODO
@@ -27,7 +78,8 @@ def help_kraken():
     print (colored("\n\n***** TODO: Generate this help message *****\n\n", 'red'))
 
 ##################################################
-def kraken_caller(sample_name, read_files, threads_num, db_fold, outfolder, hit_groups=3, others="", Debug=False):
+def kraken_caller(sample_name, read_files, threads_num, db_fold, outfolder, hit_groups=3, others="", Debug=False, 
+                  read_output='full'):
     """
     
     Parameters
@@ -48,6 +100,9 @@ def kraken_caller(sample_name, read_files, threads_num, db_fold, outfolder, hit_
         DESCRIPTION. The default is "".
     Debug : TYPE, optional
         DESCRIPTION. The default is False.
+    read_output : str, optional
+        Per-read output: full, compress or summary (see :data:`read_output_modes` 
+        and :func:`reduce_output`). The default is full.
 
     Returns
     -------
@@ -65,27 +120,37 @@ def kraken_caller(sample_name, read_files, threads_num, db_fold, outfolder, hit_
     ## flag reports minimizer and distinct minimizer count information in addition 
     ## to the normal Kraken 2 report.
     
-    filename_stamp = os.path.join(outfolder, '.success_kraken')
-    if HCGB_file.is_non_zero_file(filename_stamp):
+    ## output files
+    out_file_log = os.path.join(outfolder, sample_name + '.klog')
+    outfile_res =  os.path.join(outfolder, sample_name + '.kraken2')
+    outfile_report =  os.path.join(outfolder, sample_name + '.kreport')
+    outfile_summary = os.path.join(outfolder, sample_name + '.kraken2_summary.json')
+    outputs = [outfile_report] if read_output == 'full' else [outfile_report, outfile_summary]
+    
+    ## reuse results if same reads, database, parameters and version
+    (kraken_bin, kraken_version) = set_config.get_exe("kraken2", Return_Version=True)
+    params = {'hit_groups': hit_groups, 'others': others}
+    if read_output != 'full':
+        params['read_output'] = read_output
+    if result_cache.check_step(outfolder, 'kraken2', list(read_files) + [db_fold], params, kraken_version, 
+                               outputs=outputs, name=sample_name, 
+                               legacy_stamp=os.path.join(outfolder, '.success_kraken'), debug=Debug):
         return True
     else:
      
         if Debug:
             HCGB_aes.debug_message("Calling kraken_caller", color='yellow')
         
-        ## output files
         outfolder = HCGB_file.create_folder(outfolder)
-        out_file_log = os.path.join(outfolder, sample_name + '.klog')
-        outfile_res =  os.path.join(outfolder, sample_name + '.kraken2')
-        outfile_report =  os.path.join(outfolder, sample_name + '.kreport')
         
         ## create string call
-        kraken_bin = set_config.get_exe("kraken2")
         cmd_kraken = "%s --db %s --memory-mapping --threads %s" %(
             kraken_bin, db_fold, str(threads_num))
     
-        ## output    
-        cmd_kraken += " --report-minimizer-data --report %s --output %s"%(outfile_report, outfile_res)
+        ## output: per-read output is sent to standard output if summarized
+        cmd_kraken += " --report-minimizer-data --report %s"%(outfile_report)
+        if read_output == 'full':
+            cmd_kraken += " --output %s" %outfile_res
         
         ## parameters
         cmd_kraken += " --minimum-hit-groups " + str(hit_groups)
@@ -110,15 +175,103 @@ def kraken_caller(sample_name, read_files, threads_num, db_fold, outfolder, hit_
             HCGB_aes.debug_message("call:", color='yellow')
             print(cmd_kraken)
         
-        code = HCGB_sys.system_call(cmd_kraken)
+        if read_output == 'full':
+            code = HCGB_sys.system_call(cmd_kraken)
+        else:
+            code = stream_call(cmd_kraken, outfile_summary, 
+                               outfile_res + '.gz' if read_output == 'compress' else None)
+        
         if (code == 'OK'):
-            ## success stamps
-            HCGB_time.print_time_stamp(filename_stamp)
+            ## save step in manifest
+            result_cache.save_step(outfolder, 'kraken2', list(read_files) + [db_fold], params, kraken_version, 
+                                   outputs=outputs)
             return True
         else:
             return False
 
 
+##################################################
+def hits_bin(hits):
+    """Returns label of the bin for the number of minimizer hits of a read: 0, 1, 2-3, 4-7, 8-15..."""
+    if hits < 2:
+        return (str(hits))
+    low = 1 << (hits.bit_length() - 1)
+    return ("%s-%s" %(low, 2*low - 1))
+
+##################################################
+def reduce_output(lines, top=10, raw_file=None):
+    """Summarizes kraken2 per-read output while it is generated.
+    
+    Each line contains: C/U, read name, taxonomy ID, length and the LCA mapping of 
+    k-mers (taxid:count pairs, ``|:|`` separates paired reads). Minimizer hits of a 
+    read are the k-mers assigned to any taxon (neither 0 nor ambiguous).
+    
+    :param lines: Iterable with lines of kraken2 output.
+    :param top: Number of most abundant taxa to report.
+    :param raw_file: File handle to save lines read, if desired.
+    
+    :returns: Dictionary with reads, classified reads, unclassified fraction, top taxa 
+        (taxonomy ID, reads and fraction) and distribution of minimizer hits per read.
+    """
+    taxa = Counter()
+    hits_distribution = Counter()
+    reads = 0
+    classified = 0
+    for line in lines:
+        if raw_file:
+            raw_file.write(line)
+        fields = line.rstrip('\n').split('\t')
+        if len(fields) < 5:
+            continue
+        reads += 1
+        if fields[0] == 'C':
+            classified += 1
+            taxa[fields[2]] += 1
+        
+        hits = 0
+        for pair in fields[4].split():
+            (taxid, sep, count) = pair.rpartition(':')
+            if taxid not in ('0', 'A', '|') and count.isdigit():
+                hits += int(count)
+        hits_distribution[hits_bin(hits)] += 1
+    
+    return ({'reads': reads,
+             'classified': classified,
+             'unclassified_fraction': (reads - classified) / reads if reads else 0,
+             'top_taxa': [ [taxid, count, count / reads] for taxid, count in taxa.most_common(top) ],
+             'minimizer_hits': dict(sorted(hits_distribution.items(), key=lambda item: int(item[0].split('-')[0])))})
+
+##################################################
+def stream_call(cmd_kraken, outfile_summary, outfile_raw=None):
+    """Calls kraken2 sending per-read output through :func:`reduce_output` instead of saving it.
+    
+    :param cmd_kraken: Command to call kraken2 without --output, so per-read output is sent to standard output.
+    :param outfile_summary: JSON file to save the summary of reads.
+    :param outfile_raw: Gzip file to save per-read output compressed, if desired.
+    
+    :returns: OK or FAIL as :func:`HCGB.functions.system_call_functions.system_call`.
+    """
+    proc = subprocess.Popen(cmd_kraken, shell=True, stdout=subprocess.PIPE, universal_newlines=True, bufsize=1048576)
+    try:
+        if outfile_raw:
+            with gzip.open(outfile_raw + '.tmp', 'wt', compresslevel=1) as raw_file:
+                summary = reduce_output(proc.stdout, raw_file=raw_file)
+        else:
+            summary = reduce_output(proc.stdout)
+    finally:
+        proc.stdout.close()
+        code = proc.wait()
+    
+    if code:
+        print (colored("** ERROR: kraken2 call failed with code %s: %s" %(code, cmd_kraken), 'red'))
+        return ('FAIL')
+    
+    if outfile_raw:
+        os.replace(outfile_raw + '.tmp', outfile_raw)
+    with open(outfile_summary, 'w') as fh:
+        json.dump(summary, fh, indent=2)
+    return ('OK')
+
 ##################################################
 def bracken_caller(sample_name, outfolder, db_fold, level_abundance="S", thres_count = 50, Debug=False):
     """
@@ -145,24 +298,28 @@ def bracken_caller(sample_name, outfolder, db_fold, level_abundance="S", thres_c
 
     """
     
-    filename_stamp = os.path.join(outfolder, '.success_bracken')
-    if HCGB_file.is_non_zero_file(filename_stamp):
+    ## output files
+    out_file_log = os.path.join(outfolder, sample_name + '.blog')
+    kraken_res =  os.path.join(outfolder, sample_name + '.kreport')
+    
+    outfile_report =  os.path.join(outfolder, sample_name + '.breport')
+    outfile_res =  os.path.join(outfolder, sample_name + '.bracken')
+    
+    ## reuse results if same kraken2 report, database, parameters and version
+    (bracken_bin, bracken_version) = set_config.get_exe("bracken", Return_Version=True)
+    params = {'level_abundance': level_abundance, 'thres_count': thres_count}
+    if result_cache.check_step(outfolder, 'bracken', [kraken_res, db_fold], params, bracken_version, 
+                               outputs=[outfile_res], name=sample_name, 
+                               legacy_stamp=os.path.join(outfolder, '.success_bracken'), debug=Debug):
        return True
     else:
     
         if Debug:
             HCGB_aes.debug_message("Calling bracken_caller", color='yellow')
         
-        ## output files
         outfolder = HCGB_file.create_folder(outfolder)
-        out_file_log = os.path.join(outfolder, sample_name + '.blog')
-        kraken_res =  os.path.join(outfolder, sample_name + '.kreport')
-        
-        outfile_report =  os.path.join(outfolder, sample_name + '.breport')
-        outfile_res =  os.path.join(outfolder, sample_name + '.bracken')
         
         ## create string call
-        bracken_bin = set_config.get_exe("bracken")
         cmd_bracken = "%s -d %s -i %s -w %s -o %s" %(
             bracken_bin, db_fold, kraken_res, outfile_report, outfile_res)
     
@@ -178,60 +335,117 @@ def bracken_caller(sample_name, outfolder, db_fold, level_abundance="S", thres_c
         
         code = HCGB_sys.system_call(cmd_bracken)
         if (code == 'OK'):
-            ## success stamps
-            HCGB_time.print_time_stamp(filename_stamp)
+            ## save step in manifest
+            result_cache.save_step(outfolder, 'bracken', [kraken_res, db_fold], params, bracken_version, 
+                                   outputs=[outfile_res])
             return True
         else:
             return False
 
 ##################################################
 def kraken_run_all(sample_name, read_files, threads_num, db_fold, outfolder, 
-                   level_abundance="S", thres_count = 50, hit_groups=3, others="", debug=False):
+                   level_abundance="S", thres_count = 50, hit_groups=3, others="", debug=False, 
+                   read_output='full'):
     
     
     
+    ## each step is skipped if results are available for the same inputs, 
+    ## parameters and version (see BacterialTyper.scripts.result_cache)
     outfolder_here = HCGB_file.create_subfolder('kraken', outfolder)
-    filename_stamp = os.path.join(outfolder_here, '.success')
     
-    if HCGB_file.is_non_zero_file(filename_stamp):
-        stamp =    HCGB_time.read_time_stamp(filename_stamp)
-        print (colored("\tA previous kraken2 command generated results on: %s [Files: %s]" %(stamp, sample_name), 'green'))
+    if debug:
+        print(" *** Call kraken2 for sample %s ***" %sample_name)
+    
+    codeK = kraken_caller(sample_name, read_files, threads_num, db_fold, outfolder_here, 
+                 hit_groups = hit_groups, others=others, Debug=debug, read_output=read_output)
+    if not codeK:
+        return('FAIL')
+    
+    if debug:
+        print(" *** Call bracken for sample %s ***" %sample_name)
+    
+    codeB = bracken_caller(sample_name, outfolder_here, db_fold, level_abundance, 
+                   thres_count = thres_count, Debug= debug)
+    
+    if codeB:
+        return('OK')
     else:
-        if debug:
-            print(" *** Call kraken2 for sample %s ***" %sample_name)
-        
-        codeK = kraken_caller(sample_name, read_files, threads_num, db_fold, outfolder_here, 
-                     hit_groups = hit_groups, others=others, Debug=debug)
-        if debug:
-            print(" *** Call bracken for sample %s ***" %sample_name)
-        
-        codeB = bracken_caller(sample_name, outfolder_here, db_fold, level_abundance, 
-                       thres_count = thres_count, Debug= debug)
-        
-        if codeB & codeK:
-            ## success stamps
-            HCGB_time.print_time_stamp(filename_stamp)
-            return('OK')
-        else:
-            return('FAIL')
+        return('FAIL')
         
+## Bracken output columns and types: taxa are categorical and fractions float32
+bracken_dtypes = {'name': str, 'taxonomy_id': 'int32', 'taxonomy_lvl': str,
+                  'kraken_assigned_reads': 'int64', 'added_reads': 'int64', 
+                  'new_est_reads': 'int64', 'fraction_total_reads': 'float32'}
+
 ##################################################
-def parse_results(bracken_res, folder, cut_off=0.90):
+def read_bracken(bracken_files):
+    """Returns a single table with the Bracken abundance estimation of all samples.
     
-    ## read and write in excel
-    bracken_df = pd.read_csv(bracken_res, sep="\t")
-    bracken_df.to_excel(bracken_res + '.xlsx')
+    :param bracken_files: Dictionary with sample names as keys and Bracken output files as values.
+    :returns: Dataframe with column *sample* followed by Bracken columns. Samples, taxa 
+        names and levels are categorical.
+    """
+    tables = [ pd.read_csv(f, sep="\t", dtype=bracken_dtypes, usecols=list(bracken_dtypes)) 
+               for f in bracken_files.values() ]
+    if tables:
+        abundance = pd.concat(tables, ignore_index=True)
+    else:
+        abundance = pd.DataFrame({ col: pd.Series(dtype=dtype) for col, dtype in bracken_dtypes.items() })
     
-    filt_db = bracken_df[bracken_df['fraction_total_reads']>cut_off]
-    sp_put = filt_db.iat[0,0]
+    ## categories are set once all samples are read
+    samples = list(bracken_files)
+    abundance.insert(0, 'sample', pd.Categorical(
+        np.repeat(samples, [ len(t) for t in tables ]), categories=samples))
+    for col in ('name', 'taxonomy_lvl'):
+        abundance[col] = abundance[col].astype('category')
+    return (abundance)
+
+##################################################
+def species_calls(abundance, cut_off=0.90, contamination=0.05):
+    """Returns species identified for each sample given Bracken abundances of all samples.
+    
+    :param abundance: Dataframe as returned by :func:`read_bracken`.
+    :param cut_off: Minimum fraction of reads to assign a species to a sample.
+    :param contamination: Minimum fraction of reads for a taxon to be considered present.
+    
+    :returns: Dataframe indexed by sample with columns:
     
+        - species_id: most abundant taxon if above cut_off, else empty.
+        - fraction: fraction of reads of the most abundant taxon.
+        - taxa: number of taxa above the contamination threshold.
+        - multi_isolate: more than one taxon above the contamination threshold.
+        - contamination: reads not assigned to the most abundant taxon above the contamination threshold.
+          False for samples without any taxon in the Bracken output.
+    """
+    fractions = abundance['fraction_total_reads']
+    top = abundance.loc[fractions.groupby(abundance['sample'], observed=True).idxmax()].set_index('sample')
+    
+    calls = pd.DataFrame(index=abundance['sample'].cat.categories)
+    calls['fraction'] = top['fraction_total_reads'].reindex(calls.index).fillna(0).astype('float32')
+    calls['species_id'] = top['name'].astype(str).reindex(calls.index).where(calls['fraction'] > cut_off, "")
+    calls['taxa'] = (fractions >= contamination).groupby(abundance['sample'], observed=False).sum().astype('int32')
+    calls['multi_isolate'] = calls['taxa'] > 1
+    calls['contamination'] = ((1 - calls['fraction']) >= contamination) & (abundance.groupby('sample', observed=False).size() > 0)
+    return (calls[['species_id', 'fraction', 'taxa', 'multi_isolate', 'contamination']])
+
+##################################################
+def write_species(folder, species):
+    """Saves species identified in file species.csv within the folder"""
     with open(os.path.join(folder, "species.csv"), 'w') as opener:
-        opener.write('species:' + sp_put)
-        
+        opener.write('species:' + species)
+
+##################################################
+def parse_results(bracken_res, folder, cut_off=0.90):
+    """Returns species identified for a single Bracken output and saves it within the folder.
+    
+    See :func:`read_bracken` and :func:`species_calls` to parse several samples at once.
+    """
+    calls = species_calls(read_bracken({'sample': bracken_res}), cut_off)
+    sp_put = calls['species_id'].iat[0]
+    write_species(folder, sp_put)
     return(sp_put)
     
 
-
 ##################################################
 def main():
     
@@ -17,6 +17,10 @@ Calls sourmash_ and generates signatures for each genome, clusterizes and genera
 ## useful imports
 import time
 import io
+import concurrent.futures
+import gzip
+import hashlib
+import fcntl
 import os
 import re
 import sys
@@ -24,22 +28,17 @@ import pandas as pd
 from sys import argv
 from io import open
 from termcolor import colored
-from Bio import Phylo
 from io import StringIO
 
 ## import modules sourmash
 import csv
 import shutil
 import sourmash
-import screed
 import numpy
 from sourmash import SourmashSignature, save_signatures, load_one_signature
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
 
-import pylab
-import scipy.cluster.hierarchy as sch
+## plotting and clustering libraries (matplotlib, scipy, Bio.Phylo) are loaded 
+## within the functions using them to speed up start
 
 ## import my modules
 import HCGB
@@ -54,12 +53,166 @@ def helpMash():
 	print (colored("\n\n***** TODO: Generate this help message *****\n\n", 'red'))
 
 ##################################################		
-def sketch_database(dict_files, folder, Debug, ksize_n, num_sketch):	
+def read_sequence_chunks(seq_file, ksize_n, chunk_size=1000000):
+	"""Streams sequences from a FASTA/FASTQ file in chunks
+	
+	Sequence lines are accumulated up to *chunk_size* characters and yielded as a single string
+	instead of building full records. Consecutive records are separated by an 'N', so no k-mer
+	spans two records when sketching with force=True. The last *ksize_n - 1* characters of each 
+	chunk are carried over to the next one, so k-mers spanning chunk boundaries are kept.
+	
+	Plain or gzipped FASTA and FASTQ files are supported.
+	
+	:param seq_file: Absolute path to FASTA/FASTQ file.
+	:param ksize_n: Kmer size value.
+	:param chunk_size: Approximate number of characters per chunk.
+	
+	:type seq_file: string
+	:type ksize_n: integer
+	:type chunk_size: integer
+	
+	:returns: Generator of sequence strings.
+	"""
+	opener = gzip.open if seq_file.endswith('.gz') else open
+	buffer = []
+	size = 0
+	fastq = None
+	with opener(seq_file, 'rt') as fh:
+		for line_number, line in enumerate(fh):
+			if fastq is None:
+				fastq = line.startswith('@')
+			
+			if fastq:
+				## header, sequence, separator, quality
+				if line_number % 4 != 1:
+					continue
+				buffer.append(line.strip())
+				buffer.append('N')
+			elif line.startswith('>'):
+				buffer.append('N')
+				continue
+			else:
+				buffer.append(line.strip())
+			
+			size += len(line)
+			if size >= chunk_size:
+				chunk = ''.join(buffer)
+				yield chunk
+				buffer = [chunk[-(ksize_n - 1):]] if ksize_n > 1 else []
+				size = 0
+	
+	if buffer:
+		yield ''.join(buffer)
+
+##################################################		
+def sketch_sample(name, seq_file, outfile_name, ksize_n, num_sketch):
+	"""Sketch a single sequence file and save signature
+	
+	Sequences are read using :func:`read_sequence_chunks` and added to a :func:`sourmash.MinHash`. 
+	The signature is first written to a temporary file and renamed once finished, so an interrupted
+	run never leaves a truncated signature behind.
+	
+	:param name: Sample name.
+	:param seq_file: Absolute path to FASTA/FASTQ file.
+	:param outfile_name: Signature file to generate.
+	:param ksize_n: Kmer size value.
+	:param num_sketch: Number of sketches to include in the hash signature. 
+	
+	:type name: string
+	:type seq_file: string
+	:type outfile_name: string
+	:type ksize_n: integer
+	:type num_sketch: integer
+	
+	:returns: Signature file generated and SourmashSignature.
+	"""
+	E = sourmash.MinHash(n=num_sketch, ksize=ksize_n)	## generate hash according to number of sketches and kmer size
+	for chunk in read_sequence_chunks(seq_file, ksize_n):
+		E.add_sequence(chunk, True)
+	## in add_sequence and for speed reasons, we set force=True to skip over k-mers containing characters other than ACTG, rather than raising an exception.
+
+	sig1 = SourmashSignature(E, name=name)
+	save_signature(sig1, outfile_name)
+	
+	return (outfile_name, sig1)
+
+##################################################		
+def save_signature(sig, outfile_name):
+	"""Saves a signature in a file. The signature is first written to a temporary file and renamed once finished."""
+	tmp_name = outfile_name + '.tmp'
+	with open(tmp_name, 'wt') as fp:
+		save_signatures([sig], fp)
+	os.replace(tmp_name, outfile_name)
+
+##################################################		
+def sketch_files(dict_files, dict_outfiles, Debug, ksize_n, num_sketch, threads=1, on_complete=None):
+	"""Sketch several sequence files in parallel
+	
+	Each file is sketched using :func:`sketch_sample` in a pool of *threads* processes. Each signature 
+	is saved as soon as it is finished and, if provided, *on_complete* is called with the name and
+	signature file generated.
+	
+	:param dict_files: keys are the names of the files and values are the path to the fasta file
+	:param dict_outfiles: keys are the names of the files and values are the signature files to generate
+	:param Debug: True/False to print developing messages.
+	:param ksize_n: Kmer size value.
+	:param num_sketch: Number of sketches to include in the hash signature. 
+	:param threads: Number of CPUs to use.
+	:param on_complete: Function to call for each signature generated.
+	
+	:type dict_files: Dictionary
+	:type dict_outfiles: Dictionary
+	:type Debug: bool
+	:type ksize_n: integer
+	:type num_sketch: integer
+	:type threads: integer
+	:type on_complete: function
+	
+	:returns: Dictionary with signature file and SourmashSignature for each name.
+	"""
+	results = {}
+	
+	def add_result(name, outfile_name, sig1):
+		results[name] = (outfile_name, sig1)
+		if on_complete:
+			on_complete(name, outfile_name)
+
+	if int(threads) < 2 or len(dict_files) < 2:
+		for name, g in dict_files.items():
+			print ('\t+ Skecthing sample: ', name)
+			(outfile_name, sig1) = sketch_sample(name, g, dict_outfiles[name], ksize_n, num_sketch)
+			add_result(name, outfile_name, sig1)
+	else:
+		with concurrent.futures.ProcessPoolExecutor(max_workers=int(threads)) as executor:
+			commandsSent = { executor.submit(sketch_sample, name, g, dict_outfiles[name], ksize_n, num_sketch): name for name, g in dict_files.items() }
+			for cmd in concurrent.futures.as_completed(commandsSent):
+				details = commandsSent[cmd]
+				try:
+					(outfile_name, sig1) = cmd.result()
+					print ('\t+ Skecthing sample finished: ', details)
+					add_result(details, outfile_name, sig1)
+				except Exception as exc:
+					print ('***ERROR:')
+					print (cmd)
+					print('%r generated an exception: %s' % (details, exc))
+
+	## Debug messages
+	if Debug:
+		print (colored("\n*** DEBUG: signatures *****\n", 'red'))
+		print (results)
+
+	return (results)
+
+##################################################		
+def sketch_database(dict_files, folder, Debug, ksize_n, num_sketch, threads=1):	
 	"""Sketch sequence files
 	
 	This function generates a sourmash index, also called sketch, of the sequences 
 	provided in the folder specified.
 	
+	Files are sketched in parallel using :func:`sketch_files`. Sequences are streamed in
+	chunks and each signature is saved as soon as it is finished.
+	
 	For speed reasons, we set force=True in add_sequence step to skip over k-mers containing 
 	characters other than ACTG, rather than raising an exception.
 
@@ -68,12 +221,14 @@ def sketch_database(dict_files, folder, Debug, ksize_n, num_sketch):
 	:param Debug: True/False to print developing messages.
 	:param ksize_n: Kmer size value.
 	:param num_sketch: Number of sketches to include in the hash signature. 
+	:param threads: Number of CPUs to use.
 	
 	:type dict_files: Dictionary
 	:type folder: string 
 	:type Debug: bool
 	:type ksize_n: integer
 	:type num_sketch: integet
+	:type threads: integer
 	
 	:returns: List of SourmashSignature signatures (siglist) and absolute path files generated (siglist_file).  
 	
@@ -101,34 +256,18 @@ def sketch_database(dict_files, folder, Debug, ksize_n, num_sketch):
 	## num_sketch=5000
 	## ksize_n=31
 	
-	minhashes = {}
-	for name,g in dict_files.items():
-		print ('\t+ Skecthing sample: ', name)
-		E = sourmash.MinHash(n=num_sketch, ksize=ksize_n)	## generate hash according to number of sketches and kmer size
-		for record in screed.open(g):
-			E.add_sequence(record.sequence, True)
-		## in add_sequence and for speed reasons, we set force=True to skip over k-mers containing characters other than ACTG, rather than raising an exception.
-		minhashes[name]= E
-		
-	## Debug messages
-	if Debug:
-		print (colored("\n*** DEBUG: minhashes *****\n", 'red'))
-		print (type(minhashes))	
-		print (minhashes)
-
-	siglist = []
-	siglist_file = []
-
 	### save as signature
 	HCGB_files.create_folder(folder)
-	for names,hashes in minhashes.items():
-		sig1 = SourmashSignature(hashes, name=names)
-		outfile_name = folder + '/' + str(names) + '.sig'
-		with open(outfile_name, 'wt') as fp:
-			save_signatures([sig1], fp)
-
-		siglist_file.append(outfile_name)
-		siglist.append(sig1)
+	dict_outfiles = { name: folder + '/' + str(name) + '.sig' for name in dict_files }
+	results = sketch_files(dict_files, dict_outfiles, Debug, ksize_n, num_sketch, threads)
+	
+	## keep order provided
+	siglist = []
+	siglist_file = []
+	for name in dict_files:
+		if name in results:
+			siglist_file.append(results[name][0])
+			siglist.append(results[name][1])
 	
 	return(siglist_file, siglist)		
 	
@@ -161,7 +300,478 @@ def read_signature(sigfile, ksize_n):
 	return (sig)
 
 ##################################################
-def compare(siglist, output, Debug):
+## signature store: content-addressed signatures in a single binary file
+store_columns = ['key', 'checksum', 'file', 'size', 'mtime', 'ksize', 'num_sketch', 'name', 'offset', 'length']
+
+def file_checksum(seq_file, block_size=1048576):
+	"""Returns sha256 checksum of the file content"""
+	sha = hashlib.sha256()
+	with open(seq_file, 'rb') as fh:
+		for block in iter(lambda: fh.read(block_size), b''):
+			sha.update(block)
+	return (sha.hexdigest())
+
+def store_key(checksum, ksize_n, num_sketch):
+	"""Key for a signature: file content checksum + kmer size + sketch size"""
+	return ('%s_%s_%s' %(checksum, int(ksize_n), int(num_sketch)))
+
+##################################################
+def load_signature_store(store_folder):
+	"""Loads index of the signature store
+	
+	The signature store is a folder containing all hashes of all signatures concatenated in a 
+	binary file (*signatures.bin*, uint64) and an index (*index.csv*) with a row per signature: key 
+	(checksum of the sequence file, kmer size and sketch size), original file, size and 
+	modification time, name, offset and number of hashes within the binary file.
+	
+	:param store_folder: Absolute path to store folder.
+	:type store_folder: string
+	
+	:returns: Dataframe with store index.
+	"""
+	index_file = os.path.join(store_folder, 'index.csv')
+	if not os.path.exists(index_file):
+		return (pd.DataFrame(columns=store_columns))
+	
+	return (pd.read_csv(index_file, dtype={'key': str, 'checksum': str, 'file': str, 'name': str}))
+
+##################################################
+def store_lookup_table(index_df):
+	"""Returns dictionary to look up entries of the store index
+	
+	It contains the checksum of each (file, size, modification time) and the set of keys available, 
+	so each lookup (:func:`store_lookup`) does not filter the whole index.
+	"""
+	files = { (row.file, row.size, row.mtime): row.checksum 
+			  for row in index_df[['file', 'size', 'mtime', 'checksum']].itertuples(index=False) }
+	return ({'files': files, 'keys': set(index_df['key'])})
+
+##################################################
+def store_lookup(lookup_table, seq_file, ksize_n, num_sketch):
+	"""Get store key for a sequence file
+	
+	The file checksum is only computed if the file path, size or modification time do not match
+	any entry previously stored.
+	
+	:param lookup_table: Dictionary generated by :func:`store_lookup_table`.
+	
+	:returns: Key and checksum for the file, and True/False if key is available in the store.
+	"""
+	stat = os.stat(seq_file)
+	checksum = lookup_table['files'].get((seq_file, stat.st_size, stat.st_mtime))
+	if not checksum:
+		checksum = file_checksum(seq_file)
+	
+	key = store_key(checksum, ksize_n, num_sketch)
+	return (key, checksum, key in lookup_table['keys'])
+
+##################################################
+def get_store_signatures(store_folder, index_df, dict_keys):
+	"""Loads signatures from the store in a single read
+	
+	:param store_folder: Absolute path to store folder.
+	:param index_df: Dataframe with store index (:func:`load_signature_store`).
+	:param dict_keys: keys are the names to assign to each signature and values the store keys.
+	
+	:returns: Dictionary with SourmashSignature for each name.
+	"""
+	signatures = {}
+	if not dict_keys:
+		return (signatures)
+	
+	all_hashes = numpy.fromfile(os.path.join(store_folder, 'signatures.bin'), dtype='<u8')
+	index_keys = index_df.drop_duplicates('key').set_index('key')
+	for name, key in dict_keys.items():
+		row = index_keys.loc[key]
+		offset = int(row['offset'])
+		E = sourmash.MinHash(n=int(row['num_sketch']), ksize=int(row['ksize']))
+		E.add_many(all_hashes[offset:offset + int(row['length'])].tolist())
+		signatures[name] = SourmashSignature(E, name=name)
+
+	return (signatures)
+
+##################################################
+def add_store_signatures(store_folder, index_df, dict_entries, ksize_n, num_sketch):
+	"""Adds signatures to the store
+	
+	Hashes are appended to the binary file and index is rewritten once for all new entries. The 
+	store is locked meanwhile, so several runs can add signatures to the same store: the index is 
+	read again within the lock and entries already added by other runs are skipped.
+	
+	:param store_folder: Absolute path to store folder.
+	:param index_df: Dataframe with store index (:func:`load_signature_store`).
+	:param dict_entries: keys are names and values a tuple with the sequence file, its checksum and SourmashSignature.
+	:param ksize_n: Kmer size value.
+	:param num_sketch: Number of sketches to include in the hash signature.
+	
+	:returns: Dataframe with store index updated.
+	"""
+	if not dict_entries:
+		return (index_df)
+	
+	HCGB_files.create_folder(store_folder)
+	bin_file = os.path.join(store_folder, 'signatures.bin')
+	index_file = os.path.join(store_folder, 'index.csv')
+	
+	with open(os.path.join(store_folder, '.lock'), 'w') as lock:
+		fcntl.flock(lock, fcntl.LOCK_EX)
+		
+		## entries added by other runs meanwhile
+		index_df = load_signature_store(store_folder)
+		keys = set(index_df['key'])
+		
+		new_rows = []
+		with open(bin_file, 'ab') as fh:
+			offset = int(fh.tell() / 8)
+			for name, (seq_file, checksum, sig) in dict_entries.items():
+				key = store_key(checksum, ksize_n, num_sketch)
+				if key in keys:
+					continue
+				keys.add(key)
+				hashes = numpy.sort(numpy.fromiter(sig.minhash.hashes, dtype=numpy.uint64)).astype('<u8')
+				fh.write(hashes.tobytes())
+				stat = os.stat(seq_file)
+				new_rows.append([key, checksum, seq_file, stat.st_size, stat.st_mtime, 
+								int(ksize_n), int(num_sketch), name, offset, len(hashes)])
+				offset += len(hashes)
+			fh.flush()
+			os.fsync(fh.fileno())
+	
+		if new_rows:
+			index_df = pd.concat([index_df, pd.DataFrame(new_rows, columns=store_columns)], ignore_index=True)
+			
+			## replace index at once
+			tmp_file = index_file + '.tmp' + str(os.getpid())
+			index_df.to_csv(tmp_file, index=False)
+			os.replace(tmp_file, index_file)
+	
+	return (index_df)
+
+##################################################
+def pack_signatures(siglist):
+	"""Packs signature hashes into a matrix
+	
+	Each MinHash is converted into a sorted uint64 array and stored as a row of a matrix 
+	padded up to the largest sketch. Rows are compared later using vectorized numpy operations
+	instead of calling :func:`sourmash.MinHash.similarity` for each pair.
+	
+	:param siglist: List of SourmashSignature signatures.
+	:type siglist: list
+	
+	:returns: Matrix of sorted hashes (numpy.uint64), array with the number of valid hashes per row and sketch size (num) used to truncate unions (0 if not bounded).
+	"""
+	hash_list = [ numpy.sort(numpy.fromiter(sig.minhash.hashes, dtype=numpy.uint64)) for sig in siglist ]
+	lengths = numpy.array([len(h) for h in hash_list], dtype=numpy.int64)
+	
+	width = int(lengths.max()) if len(lengths) else 0
+	M = numpy.full((len(hash_list), width), numpy.iinfo(numpy.uint64).max, dtype=numpy.uint64)
+	for i, h in enumerate(hash_list):
+		M[i, :len(h)] = h
+
+	num = int(siglist[0].minhash.num) if siglist else 0
+	return (M, lengths, num)
+
+##################################################
+## packed signatures shared by each worker process
+_packed = {}
+
+def _init_packed(M, lengths, num):
+	_packed['M'] = M
+	_packed['lengths'] = lengths
+	_packed['num'] = num
+
+##################################################
+def jaccard_one_vs_many(A, sub, sub_len, num):
+	"""Similarity of a sketch against several packed sketches
+	
+	It reproduces the bottom-k estimate of sourmash: hashes shared by A and B that fall within the 
+	*num* smallest hashes of the union, divided by the size of that truncated union. 
+	
+	The rank of each hash of B within the union is obtained using :func:`numpy.searchsorted` 
+	against A, so all comparisons are computed without any python loop over pairs.
+	
+	:param A: Sorted hashes of the query sketch.
+	:param sub: Matrix of sorted and padded hashes (see :func:`pack_signatures`).
+	:param sub_len: Number of valid hashes for each row of sub.
+	:param num: Sketch size used to truncate unions (0 if not bounded).
+	
+	:returns: Numpy array with similarity values.
+	"""
+	if not num:
+		num = numpy.iinfo(numpy.int64).max
+	cols = numpy.arange(sub.shape[1])
+	
+	if len(A):
+		pos = numpy.searchsorted(A, sub)
+		inA = (A[numpy.minimum(pos, len(A) - 1)] == sub) & (cols[None, :] < sub_len[:, None])
+	else:
+		pos = numpy.zeros(sub.shape, dtype=numpy.int64)
+		inA = numpy.zeros(sub.shape, dtype=bool)
+	
+	## rank in the union: hashes from A below + hashes from B below - shared below
+	common_below = numpy.cumsum(inA, axis=1) - inA
+	rank = cols[None, :] + pos - common_below
+	common = numpy.count_nonzero(inA & (rank < num), axis=1)
+	union = numpy.minimum(len(A) + sub_len - numpy.count_nonzero(inA, axis=1), num)
+	
+	return (common / numpy.maximum(union, 1))
+
+##################################################
+def _jaccard_rows(row_start, row_end, chunk_elements=2000000):
+	"""Similarity of a block of rows against the rest of the packed matrix
+	
+	Each row is compared using :func:`jaccard_one_vs_many`. Only the upper triangle (j >= i) 
+	is computed. Columns are processed in chunks of approximately *chunk_elements* hashes 
+	to keep memory bounded.
+	
+	:returns: Start row and block of similarities (rows x n).
+	"""
+	M = _packed['M']
+	lengths = _packed['lengths']
+	num = _packed['num']
+	
+	n, width = M.shape
+	chunk = max(1, int(chunk_elements / max(1, width)))
+	block = numpy.zeros([row_end - row_start, n])
+	
+	for i in range(row_start, row_end):
+		A = M[i, :lengths[i]]
+		for start in range(i, n, chunk):
+			end = min(n, start + chunk)
+			block[i - row_start, start:end] = jaccard_one_vs_many(A, M[start:end], lengths[start:end], num)
+
+	return (row_start, block)
+
+##################################################
+def similarity_matrix(siglist, threads=1, n_rows=None):
+	"""Generates all-vs-all similarity matrix
+	
+	Signatures are packed using :func:`pack_signatures` and the Jaccard similarity matrix is 
+	computed by blocks of rows using :func:`_jaccard_rows`. If several threads are provided, blocks 
+	are distributed in a pool of processes.
+	
+	If *n_rows* is provided, only the first *n_rows* rows (and columns) are computed, and the rest 
+	of the matrix is left as zero to be filled by the caller (see :func:`incremental_matrix`).
+	
+	:param siglist: List of SourmashSignature signatures.
+	:param threads: Number of CPUs to use.
+	:param n_rows: Number of rows to compute [Default: all].
+	
+	:type siglist: list
+	:type threads: integer
+	:type n_rows: integer
+	
+	:returns: Numpy symmetric matrix with similarity values.
+	"""
+	(M, lengths, num) = pack_signatures(siglist)
+	n = len(siglist)
+	if n_rows is None:
+		n_rows = n
+	
+	## blocks of rows: several per process to balance the triangular workload
+	threads = max(1, int(threads))
+	n_blocks = min(n_rows, threads * 4) if threads > 1 else min(n_rows, 1)
+	bounds = numpy.linspace(0, n_rows, n_blocks + 1, dtype=int)
+	
+	D = numpy.zeros([n, n])
+	if threads > 1 and n_blocks > 1:
+		with concurrent.futures.ProcessPoolExecutor(max_workers=threads, initializer=_init_packed, initargs=(M, lengths, num)) as executor:
+			commandsSent = [ executor.submit(_jaccard_rows, bounds[b], bounds[b+1]) for b in range(n_blocks) ]
+			for cmd in concurrent.futures.as_completed(commandsSent):
+				(row_start, block) = cmd.result()
+				D[row_start:row_start + block.shape[0]] = block
+	elif n_blocks:
+		_init_packed(M, lengths, num)
+		(row_start, block) = _jaccard_rows(0, n_rows)
+		D[:n_rows] = block
+		_packed.clear()
+	
+	## mirror upper triangle
+	D = numpy.triu(D) + numpy.triu(D, 1).T
+	return (D)
+
+##################################################
+def incremental_matrix(siglist, previous_file, threads=1, Debug=False):
+	"""Generates similarity matrix reusing a previous one
+	
+	The matrix and signature checksums (md5sum) of a previous comparison are stored in *previous_file* 
+	(numpy .npz). Signatures already available are not compared again: only rows for new or modified
+	signatures (new x old and new x new) are computed using :func:`similarity_matrix`. Matrix and 
+	checksums are saved in *previous_file* for the next run.
+	
+	:param siglist: List of SourmashSignature signatures.
+	:param previous_file: Absolute path to the file containing previous matrix.
+	:param threads: Number of CPUs to use.
+	:param Debug: True/False to print developing messages.
+	
+	:type siglist: list
+	:type previous_file: string
+	:type threads: integer
+	:type Debug: bool
+	
+	:returns: Numpy symmetric matrix with similarity values in the order of siglist.
+	"""
+	keys = [sig.md5sum() for sig in siglist]
+	
+	previous_pos = {}
+	if os.path.exists(previous_file):
+		with numpy.load(previous_file) as data:
+			D_prev = data['D']
+			previous_pos = { key: i for i, key in enumerate(data['keys']) }
+	
+	old_idx = [i for i, key in enumerate(keys) if key in previous_pos]
+	new_idx = [i for i, key in enumerate(keys) if key not in previous_pos]
+	print ('+ Similarity matrix: %s signatures compared previously, %s new signatures' %(len(old_idx), len(new_idx)))
+	
+	## new signatures first: compute only their rows
+	order = new_idx + old_idx
+	D = similarity_matrix([siglist[i] for i in order], threads, n_rows=len(new_idx))
+	
+	## fill old x old from previous matrix
+	if old_idx:
+		prev = [previous_pos[keys[i]] for i in old_idx]
+		D[len(new_idx):, len(new_idx):] = D_prev[numpy.ix_(prev, prev)]
+	
+	## restore order of siglist
+	inverse = numpy.argsort(order)
+	D = D[numpy.ix_(inverse, inverse)]
+	
+	## Debug messages
+	if Debug:
+		print (colored("\n*** DEBUG: incremental matrix: reused %s, new %s *****\n" %(len(old_idx), len(new_idx)), 'red'))
+	
+	numpy.savez(previous_file, D=D, keys=numpy.array(keys))
+	return (D)
+
+##################################################
+def build_nearest_index(ref_siglist, index_file=None):
+	"""Builds an inverted index of hashes for nearest neighbour search
+	
+	All hashes of the reference signatures are sorted in a single array together with the
+	reference each one belongs to, so the references sharing hashes with a query are retrieved 
+	using :func:`numpy.searchsorted` instead of comparing against every reference. 
+	
+	If *index_file* is provided, the index is saved (numpy .npz) and reused while the md5sum of
+	the reference signatures do not change.
+	
+	:param ref_siglist: List of SourmashSignature reference signatures.
+	:param index_file: Absolute path to the file to store the index.
+	
+	:type ref_siglist: list
+	:type index_file: string
+	
+	:returns: Dictionary containing the index.
+	"""
+	keys = numpy.array([sig.md5sum() for sig in ref_siglist])
+	if index_file and os.path.exists(index_file):
+		with numpy.load(index_file) as data:
+			if numpy.array_equal(data['keys'], keys):
+				print ('+ Loading nearest neighbour index: ', index_file)
+				nearest_index = { key: data[key] for key in data.files }
+				nearest_index['num'] = int(nearest_index['num'])
+				return (nearest_index)
+	
+	print ('+ Building nearest neighbour index for %s references...' %len(ref_siglist))
+	(M, lengths, num) = pack_signatures(ref_siglist)
+	valid = numpy.arange(M.shape[1])[None, :] < lengths[:, None]
+	all_hashes = M[valid]
+	ref_id = numpy.repeat(numpy.arange(len(ref_siglist)), lengths)
+	order = numpy.argsort(all_hashes, kind='stable')
+	
+	nearest_index = { 'hashes': all_hashes[order], 'ref_id': ref_id[order], 'M': M, 'lengths': lengths, 
+						'num': num, 'keys': keys, 'labels': numpy.array([str(sig.name) for sig in ref_siglist]) }
+	if index_file:
+		numpy.savez(index_file, **nearest_index)
+	
+	return (nearest_index)
+
+##################################################
+def query_nearest(nearest_index, sig, top_k, candidates_factor=5):
+	"""Top-K closest references for a signature
+	
+	References sharing any hash with the query are retrieved from the inverted index 
+	(:func:`build_nearest_index`) and ranked by the number of shared hashes. Only the best 
+	*top_k x candidates_factor* candidates are compared using :func:`jaccard_one_vs_many`.
+	
+	:param nearest_index: Dictionary containing the index.
+	:param sig: SourmashSignature to query.
+	:param top_k: Number of hits to report.
+	:param candidates_factor: Number of candidates compared per hit reported.
+	
+	:returns: List of tuples (label, similarity, shared hashes) sorted by similarity.
+	"""
+	A = numpy.sort(numpy.fromiter(sig.minhash.hashes, dtype=numpy.uint64))
+	left = numpy.searchsorted(nearest_index['hashes'], A, side='left')
+	right = numpy.searchsorted(nearest_index['hashes'], A, side='right')
+	
+	## references for each hash found
+	lens = right - left
+	positions = numpy.arange(lens.sum()) + numpy.repeat(left - (numpy.cumsum(lens) - lens), lens)
+	shared = numpy.bincount(nearest_index['ref_id'][positions], minlength=len(nearest_index['lengths']))
+	
+	candidates = numpy.flatnonzero(shared)
+	n_candidates = int(top_k) * int(candidates_factor)
+	if len(candidates) > n_candidates:
+		candidates = candidates[numpy.argpartition(-shared[candidates], n_candidates)[:n_candidates]]
+	if not len(candidates):
+		return ([])
+	
+	similarity = jaccard_one_vs_many(A, nearest_index['M'][candidates], nearest_index['lengths'][candidates], nearest_index['num'])
+	best = numpy.argsort(-similarity, kind='stable')[:int(top_k)]
+	return ([ (nearest_index['labels'][candidates[b]], similarity[b], shared[candidates[b]]) for b in best ])
+
+##################################################
+def nearest(query_siglist, ref_siglist, top_k, output, index_file=None, sources=None):
+	"""Nearest neighbour search against reference signatures
+	
+	Generates a tab-separated file (*output.nearest.tsv*) with the top-K closest references for each
+	query signature using :func:`build_nearest_index` and :func:`query_nearest`.
+	
+	:param query_siglist: List of SourmashSignature signatures to query.
+	:param ref_siglist: List of SourmashSignature reference signatures.
+	:param top_k: Number of hits to report for each query.
+	:param output: Name tag for output file.
+	:param index_file: Absolute path to the file to store the index.
+	:param sources: Dictionary with the source (genbank, user_data...) of each reference.
+	
+	:returns: Dataframe with results.
+	"""
+	nearest_index = build_nearest_index(ref_siglist, index_file)
+	
+	results = []
+	for sig in query_siglist:
+		for rank, (hit, similarity, shared) in enumerate(query_nearest(nearest_index, sig, top_k)):
+			results.append([str(sig.name), rank + 1, hit, similarity, shared])
+	
+	results_df = pd.DataFrame(results, columns=['sample', 'rank', 'hit', 'similarity', 'shared_hashes'])
+	if sources:
+		results_df['source'] = results_df['hit'].map(sources)
+	results_df.to_csv(output + '.nearest.tsv', sep='\t', index=False, float_format='%.4f')
+	print ('+ Wrote nearest neighbours to:', output + '.nearest.tsv')
+	return (results_df)
+
+##################################################
+def compare(siglist, output, Debug, threads=1, previous_file=None):
+	"""Compares all signatures 
+	
+	Generates the all-vs-all similarity matrix using :func:`similarity_matrix` and saves
+	matrix (*output.matrix.csv*) and labels (*output.labels.txt*). If *previous_file* is provided,
+	the matrix is updated incrementally using :func:`incremental_matrix`.
+	
+	:param siglist: List of SourmashSignature signatures.
+	:param output: Name tag for output files.
+	:param Debug: True/False to print developing messages.
+	:param threads: Number of CPUs to use.
+	:param previous_file: File to store and reuse previous similarity matrix.
+	
+	:type siglist: list
+	:type output: string
+	:type Debug: bool
+	:type threads: integer
+	:type previous_file: string
+	
+	:returns: Numpy matrix and list of labels.
+	"""
 	#################################################
 	## code taken and adapted from: 
 	##	https://sourmash.readthedocs.io/en/latest/api-example.html
@@ -169,21 +779,12 @@ def compare(siglist, output, Debug):
 	#################################################
    
 	# build the distance matrix
-	D = numpy.zeros([len(siglist), len(siglist)])
 	numpy.set_printoptions(precision=3, suppress=True)
-
-	# do all-by-all calculation
-	labeltext = []
-	for i, E in enumerate(siglist):
-		for j, E2 in enumerate(siglist):
-			if i < j:
-				continue
-			similarity = E.similarity(E2, False) ## False -> ignore abundances
-			D[i][j] = similarity
-			D[j][i] = similarity
-
-		#labeltext.append(E.name())
-		labeltext.append(E.name)
+	if previous_file:
+		D = incremental_matrix(siglist, previous_file, threads, Debug)
+	else:
+		D = similarity_matrix(siglist, threads)
+	labeltext = [E.name for E in siglist]
 
    	## Debug messages
 	if Debug:
@@ -264,6 +865,11 @@ def plot(D, labeltext, filename, pdf, colorLabel):
 	##	https://sourmash.readthedocs.io/en/latest/api-example.html
 	## 	https://github.com/dib-lab/sourmash/blob/master/sourmash/commands.py
 	#################################################
+	import matplotlib
+	matplotlib.use('Agg')
+	import matplotlib.pyplot as plt
+	import pylab
+	import scipy.cluster.hierarchy as sch
 
 	matrix_out = filename + '.matrix'
 
@@ -369,6 +975,8 @@ def get_Newick_tree(cluster_hierachy, DataMatrix, labeltext, output):
 		- :func:`BacterialTyper.scripts.functions.printList2file`
 		
 	"""
+	import scipy.cluster.hierarchy as sch
+	from Bio import Phylo
 	
 	tree = sch.to_tree(cluster_hierachy, False)
 	Newick_tree = generateNewick(tree, "", DataMatrix, labeltext)
@@ -10,19 +10,16 @@ Parses and prepares for phylogenetic analysis
 import time
 import io
 import os
+import concurrent.futures
+import resource
 import re
 import sys
 from sys import argv
 from io import open
 from termcolor import colored
 import pandas as pd
-from ete3 import Tree
 from Bio import AlignIO
 import numpy
-import scipy.cluster.hierarchy as sch
-from scipy.sparse.csgraph import minimum_spanning_tree
-import networkx
-import pylab
 
 ## import my modules
 from BacterialTyper.config import set_config
@@ -30,12 +27,20 @@ from BacterialTyper.scripts import min_hash_caller
 import HCGB.functions.system_call_functions as HCGB_sys
 
 ##################################
-def get_snp_distance(aln_file, mode, countGaps, output, Debug):
+def get_snp_distance(aln_file, mode, countGaps, output, Debug, threads=1, variable_only=False):
     """
+    Calculate SNP distance matrix and save matrix, labels and Newick tree.
     
+    :param aln_file: Alignment file.
+    :param mode: Format of aln_file: [nexus,phylip,clustalw,fasta]
+    :param countGaps: True/false for counting gaps as differences.
+    :param output: Name tag for output files.
+    :param Debug: True/false for debugging messages.
+    :param threads: Number of CPUs to use.
+    :param variable_only: True/false for using only variable sites (see :func:`variable_sites`).
     """
 
-    (D, labeltext) = snp_distance(aln_file, mode, countGaps, Debug)
+    (D, labeltext) = snp_distance(aln_file, mode, countGaps, Debug, threads, variable_only)
 
     ### Write output
     labeltext_string = [str(x) for x in labeltext] ## generat strings, avoid if integers alone
@@ -49,6 +54,7 @@ def get_snp_distance(aln_file, mode, countGaps, output, Debug):
 
     ## create minimum spanning tree
         ## https://docs.scipy.org/doc/scipy/reference/generated/scipy.cluster.hierarchy.linkage.html
+    import scipy.cluster.hierarchy as sch ## only loaded when required
     Y = sch.linkage(D, method='single', optimal_ordering=True)
     min_hash_caller.get_Newick_tree(Y, D, labeltext, output)
         
@@ -62,45 +68,274 @@ def get_snp_distance(aln_file, mode, countGaps, output, Debug):
     return()
 
 ##################################
-def snp_distance(aln_file, mode, countGaps, Debug):
+def read_fasta_records(aln_file):
+    """
+    Streams records of a FASTA alignment one at a time.
+    
+    :returns: Generator of tuples (id, sequence).
+    """
+    name = None
+    seq = []
+    with open(aln_file, 'r') as fh:
+        for line in fh:
+            if line.startswith('>'):
+                if name is not None:
+                    yield (name, ''.join(seq))
+                name = line[1:].split()[0]
+                seq = []
+            else:
+                seq.append(line.strip())
+    
+    if name is not None:
+        yield (name, ''.join(seq))
+
+##################################
+def load_alignment_matrix(aln_file, mode, Debug=False):
+    """
+    Load alignment as a memory-mapped matrix (samples x positions) of bytes (uint8).
+    
+    The alignment is parsed once and stored next to it: *aln_file.matrix.u8* (raw bytes, one row 
+    per sample) and *aln_file.matrix.labels.txt*. Further calls (SNP distance, statistics...) map 
+    the matrix from disk without reading the alignment again, as long as it is newer than the
+    alignment file. FASTA alignments are streamed record by record; other formats are read 
+    using Biopython.
+    
+    :param aln_file: Alignment file.
+    :param mode: Format of aln_file: [nexus,phylip,clustalw,fasta]
+    :param Debug: True/false for debugging messages.
+    
+    :returns: Numpy memmap (read-only) and list of labels.
+    """
+    matrix_file = aln_file + '.matrix.u8'
+    labels_file = aln_file + '.matrix.labels.txt'
+    
+    if not all([ os.path.exists(matrix_file), os.path.exists(labels_file) ]) or os.path.getmtime(matrix_file) < os.path.getmtime(aln_file):
+        print ('+ Parsing alignment into matrix: ', matrix_file)
+        if mode == 'fasta':
+            records = read_fasta_records(aln_file)
+        else:
+            records = ((record.id, str(record.seq)) for record in AlignIO.read(aln_file, mode))
+        
+        labeltext = []
+        length = None
+        with open(matrix_file + '.tmp', 'wb') as fh:
+            for (name, seq) in records:
+                if length is None:
+                    length = len(seq)
+                elif len(seq) != length:
+                    print (colored("** ERROR: Length of DNA strings are not the same...", 'red'))
+                    exit()
+                fh.write(seq.encode())
+                labeltext.append(name)
+        
+        os.replace(matrix_file + '.tmp', matrix_file)
+        with open(labels_file, 'w') as fp:
+            fp.write("\n".join(labeltext))
+    
+    with open(labels_file, 'r') as fp:
+        labeltext = fp.read().splitlines()
+    
+    n = len(labeltext)
+    length = int(os.path.getsize(matrix_file) / n) if n else 0
+    X = numpy.memmap(matrix_file, dtype=numpy.uint8, mode='r', shape=(n, length))
+    
+    if Debug:
+        print (colored("** DEBUG: alignment matrix %s: %s samples x %s positions" %(matrix_file, n, length), 'yellow'))
+    
+    return (X, labeltext)
+
+##################################
+def variable_sites(aln_file, mode, Debug=False, chunk_elements=50000000):
+    """
+    Extract polymorphic columns of an alignment.
+    
+    Invariant columns add nothing to SNP distances, so only columns with any difference 
+    (including gaps or ambiguous bases) are kept. Invariant columns of A, C, G and T are counted
+    to be provided to IQ-TREE using option *-fconst*.
+    
+    Results are stored compactly in *aln_file.variable.npz* (variable matrix, positions and 
+    constant sites) and as FASTA alignment (*aln_file.variable.fasta*). Both are reused while newer 
+    than the alignment file.
+    
+    :param aln_file: Alignment file.
+    :param mode: Format of aln_file: [nexus,phylip,clustalw,fasta]
+    :param Debug: True/false for debugging messages.
+    
+    :returns: Dictionary with variable matrix (X), labels, positions, constant sites counts (fconst: A,C,G,T) and FASTA alignment file (aln).
+        If no variable sites are available, positions is empty and so it is the FASTA alignment, which cannot be used for tree reconstruction.
+    """
+    compressed_file = aln_file + '.variable.npz'
+    fasta_file = aln_file + '.variable.fasta'
+    
+    (X, labeltext) = load_alignment_matrix(aln_file, mode, Debug)
+    
+    if not all([ os.path.exists(compressed_file), os.path.exists(fasta_file) ]) or os.path.getmtime(compressed_file) < os.path.getmtime(aln_file):
+        print ('+ Extracting variable sites from alignment: ', aln_file)
+        n, length = X.shape
+        chunk = max(1, int(chunk_elements / max(1, n)))
+        
+        positions = []
+        const_counts = numpy.zeros(256, dtype=numpy.int64)
+        for start in range(0, length, chunk):
+            sub = numpy.asarray(X[:, start:start + chunk])
+            variable = (sub != sub[0]).any(axis=0)
+            positions.append(numpy.flatnonzero(variable) + start)
+            const_counts += numpy.bincount(sub[0, ~variable], minlength=256)
+        
+        positions = numpy.concatenate(positions) if positions else numpy.array([], dtype=numpy.int64)
+        X_variable = numpy.asarray(X[:, positions]) if n else numpy.zeros([0, 0], dtype=numpy.uint8)
+        fconst = numpy.array([ const_counts[ord(base)] + const_counts[ord(base.lower())] for base in 'ACGT' ])
+        
+        numpy.savez_compressed(compressed_file, X=X_variable, positions=positions, fconst=fconst)
+        with open(fasta_file, 'w') as fh:
+            for i, name in enumerate(labeltext):
+                fh.write('>' + name + '\n' + X_variable[i].tobytes().decode() + '\n')
+
+    with numpy.load(compressed_file) as data:
+        compressed = { 'X': data['X'], 'positions': data['positions'], 'fconst': data['fconst'] }
+    compressed['labels'] = labeltext
+    compressed['aln'] = fasta_file
+    
+    print ('+ Variable sites: %s of %s positions' %(len(compressed['positions']), X.shape[1]))
+    if not len(compressed['positions']):
+        print (colored("** No variable sites in alignment %s: FASTA alignment of variable sites is empty." %aln_file, 'yellow'))
+    if Debug:
+        print (colored("** DEBUG: constant sites (A,C,G,T): %s" %compressed['fconst'], 'yellow'))
+    
+    return (compressed)
+
+##################################
+def peak_rss():
+    """
+    Peak resident set size (MB) of this process and of its finished child processes.
+    """
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    return (self_rss, children_rss)
+
+##################################
+## alignment matrix shared by each worker process
+_aln = {}
+
+def _init_aln(X, countGaps):
+    ## memory-mapped matrices are opened again in each worker instead of being copied
+    if isinstance(X, tuple):
+        X = numpy.memmap(X[0], dtype=numpy.uint8, mode='r', shape=X[1])
+    _aln['X'] = X
+    _aln['countGaps'] = countGaps
+
+##################################
+def _snp_rows(row_start, row_end, chunk_elements=50000000):
+    """
+    SNP differences of a block of rows against the following rows of the alignment matrix.
+    
+    Only the upper triangle (j > i) is computed. Positions are processed in chunks of columns
+    so that approximately *chunk_elements* bytes are compared at once. Same semantics as 
+    :func:`distance`: any different character is a difference and, if countGaps is False, 
+    positions with a gap in either sequence are not counted.
+    
+    :returns: Start row and block of SNP differences (rows x n).
+    """
+    X = _aln['X']
+    countGaps = _aln['countGaps']
+    gap = ord('-')
+    
+    n, length = X.shape
+    chunk = max(1, int(chunk_elements / max(1, n)))
+    block = numpy.zeros([row_end - row_start, n], dtype=numpy.int64)
+    
+    for start in range(0, length, chunk):
+        sub = numpy.asarray(X[:, start:start + chunk])
+        if not countGaps:
+            sub_gaps = (sub == gap)
+        
+        for i in range(row_start, row_end):
+            diff = (sub[i+1:] != sub[i])
+            if not countGaps:
+                diff &= ~(sub_gaps[i+1:] | sub_gaps[i])
+            block[i - row_start, i+1:] += numpy.count_nonzero(diff, axis=1)
+
+    return (row_start, block)
+
+##################################
+def snp_distance_matrix(X, countGaps, threads=1):
+    """
+    Pairwise SNP distance matrix of an alignment matrix (see :func:`load_alignment_matrix`).
+    
+    Blocks of rows are computed using :func:`_snp_rows`, distributed in a pool of processes 
+    if several threads are provided.
+    
+    :param X: Numpy uint8 matrix or memmap (samples x positions).
+    :param countGaps: True/false for counting gaps as differences.
+    :param threads: Number of CPUs to use.
+    
+    :returns: Numpy symmetric matrix with SNP distances.
+    """
+    n = X.shape[0]
+    threads = max(1, int(threads))
+    n_blocks = min(n, threads * 4) if threads > 1 else min(n, 1)
+    bounds = numpy.linspace(0, n, n_blocks + 1, dtype=int)
+    
+    D = numpy.zeros([n, n])
+    if threads > 1 and n_blocks > 1:
+        X_shared = (X.filename, X.shape) if isinstance(X, numpy.memmap) else X
+        with concurrent.futures.ProcessPoolExecutor(max_workers=threads, initializer=_init_aln, initargs=(X_shared, countGaps)) as executor:
+            commandsSent = [ executor.submit(_snp_rows, bounds[b], bounds[b+1]) for b in range(n_blocks) ]
+            for cmd in concurrent.futures.as_completed(commandsSent):
+                (row_start, block) = cmd.result()
+                D[row_start:row_start + block.shape[0]] = block
+    elif n_blocks:
+        _init_aln(X, countGaps)
+        (row_start, block) = _snp_rows(0, n)
+        D[:] = block
+        _aln.clear()
+    
+    ## mirror upper triangle
+    D = D + D.T
+    return (D)
+
+##################################
+def snp_distance(aln_file, mode, countGaps, Debug, threads=1, variable_only=False):
     """
     Calculate SNP difference between records in alignment
     
+    The alignment is parsed once into a memory-mapped matrix (:func:`load_alignment_matrix`) and 
+    pairwise differences are computed vectorized (:func:`snp_distance_matrix`). Peak memory 
+    before and after is reported.
+    
+    If variable_only is set, only polymorphic columns are compared (:func:`variable_sites`).
+    
     :param aln_file: Alignment file.
     :param mode: Format of aln_file: [nexus,phylip,clustalw,fasta]
     :param countGaps: True/false for counting gaps as differences.
     :param Debug: True/false for debugging messages.
+    :param threads: Number of CPUs to use.
+    :param variable_only: True/false for using only variable sites.
     
     :type aln_file: string
     :type mode: string 
     :type countGaps: bool
     :type Debug: bool
+    :type threads: integer
+    :type variable_only: bool
     
     :returns: Numpy matrix with SNP distance matrix and list of labels.
     
     """
     
+    print ('+ Peak memory (RSS) before SNP distance: %.1f MB (child processes: %.1f MB)' %peak_rss())
+    
     ## read alingment
-    alignment = AlignIO.read(aln_file, mode)
+    if variable_only:
+        compressed = variable_sites(aln_file, mode, Debug)
+        (X, labeltext) = (compressed['X'], compressed['labels'])
+    else:
+        (X, labeltext) = load_alignment_matrix(aln_file, mode, Debug)
     
     # build the distance matrix
-    D = numpy.zeros([len(alignment), len(alignment)])
-
-    labeltext = []
+    D = snp_distance_matrix(X, countGaps, threads)
     
-    for i, record in enumerate(alignment):
-        for j, record2 in enumerate(alignment):
-            snps_diff = 0
-            if (record.id != record2.id):
-                snps_diff = distance(record.seq, record2.seq, gaps=countGaps)
-        
-            if Debug:
-                print (colored("** DEBUG: record.id, record2.id, snps_diff", 'yellow'))
-                print ("%s vs %s : %i" %(record.id, record2.id, snps_diff))
-            D[i][j] = snps_diff
-            D[j][i] = snps_diff
-        
-        labeltext.append(record.id)
+    print ('+ Peak memory (RSS) after SNP distance: %.1f MB (child processes: %.1f MB)' %peak_rss())
         
     ## Debug messages
     if Debug:
@@ -150,27 +385,39 @@ def distance(seq1, seq2, gaps=False):
     return(snps)
 
 ##################################
-def ml_tree(folder, name, threads, output, Debug):
+def ml_tree(folder, name, threads, output, Debug, aln_file=None, fconst=None):
     """
     Create Maximum Likelihood tree reconstruction 
     
     We use IQ-Tree for the versatility and the ability to automatically set parameters. 
     
+    If an alignment of variable sites is provided (see :func:`variable_sites`), the number 
+    of constant sites (A,C,G,T) removed must be provided via fconst.
+    
     :param folder: Snippy-core folder containing results.
     :param name: Name of the analysis.
     :param Debug: True/false for debugging messages
+    :param aln_file: Alignment file to use [Default: folder/name.aln].
+    :param fconst: Constant sites counts for A,C,G,T.
     
     :type folder: string 
     :type name: string
     :type Debug: bool 
+    :type aln_file: string
+    :type fconst: list
     """
     iqtree_exe = set_config.get_exe('iqtree', Debug) 
     bootstrap_number = '1000'
-    aln_file = os.path.join(folder, name + '.aln')
+    if not aln_file:
+        aln_file = os.path.join(folder, name + '.aln')
     output_log = os.path.join(output, 'iqtree.error.log')
     output_files = os.path.join(output, 'iqtree_' + name)
     
-    iqtree_cmd = '%s -s %s -redo --threads-max %s --prefix %s -B %s 2> %s' %(iqtree_exe, aln_file, 
+    fconst_option = ''
+    if fconst is not None:
+        fconst_option = '-fconst ' + ','.join([str(x) for x in fconst]) + ' '
+    
+    iqtree_cmd = '%s -s %s %s-redo --threads-max %s --prefix %s -B %s 2> %s' %(iqtree_exe, aln_file, fconst_option,
                                                                       threads, output_files, 
                                                                       bootstrap_number, output_log)
     code = HCGB_sys.system_call(iqtree_cmd)
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+############################################################
+## Jose F. Sanchez                                        ##
+## Copyright (C) 2019-2021 Lauro Sumoy Lab, IGTP, Spain   ##
+############################################################
+"""
+Index of files within a project folder.
+
+The project folder is listed once using ``os.scandir`` and the index is saved in the
+``info`` folder of the project (:data:`index_name`). Later calls only list again
+folders whose modification time changed (files added, removed or renamed), so retrieving
+samples for several modes does not walk the whole project each time.
+
+:func:`get_files` returns the same dataframe as ``HCGB.sampleParser.files.get_files``
+for a project folder.
+"""
+## useful imports
+import os
+import json
+import time
+import threading
+from termcolor import colored
+
+from HCGB import sampleParser
+import HCGB.functions.aesthetics_functions as HCGB_aes
+
+## index file within the info folder of the project
+index_name = 'files_index.json'
+
+## lock to update the index from several threads
+index_lock = threading.Lock()
+
+## indexes already loaded: absolute path of project -> dictionary of folders
+project_indexes = {}
+
+## folders modified less than these seconds before listing them are listed again next time,
+## as files might be still being created within the same time stamp
+racy_seconds = 2
+
+## files discarded by HCGB.sampleParser.files.get_files
+discard_list = ['.bam', '.sam', '.log', '.annot', '.abundances.txt', '.gff3', 'trimmed.fq',
+                'trim.clpsd.fq', 'failed.fq.gz', 'unjoin', '00.0_0.cor.fastq.gz']
+
+############
+def read_index(project_folder):
+    """Returns index saved for the project as a dictionary (empty if not available)."""
+    index_file = os.path.join(project_folder, 'info', index_name)
+    if not os.path.isfile(index_file):
+        return ({})
+    try:
+        with open(index_file) as fh:
+            return (json.load(fh))
+    except (ValueError, OSError):
+        print (colored("\t** Index file %s could not be read. Project folder will be listed again." %index_file, 'yellow'))
+        return ({})
+
+############
+def write_index(project_folder, index):
+    """Saves the index in the info folder of the project. The file is replaced at once to avoid incomplete files."""
+    info_dir = os.path.join(project_folder, 'info')
+    try:
+        os.makedirs(info_dir, exist_ok=True)
+        index_file = os.path.join(info_dir, index_name)
+        tmp_file = index_file + '.tmp' + str(os.getpid()) + '_' + str(threading.get_ident())
+        with open(tmp_file, 'w') as fh:
+            json.dump(index, fh)
+        os.replace(tmp_file, index_file)
+    except OSError as error:
+        ## e.g. read-only project: index is kept in memory
+        print (colored("\t** Index of files could not be saved in %s: %s" %(info_dir, error), 'yellow'))
+
+############
+def scan_folder(project_folder, index):
+    """Lists folders of the project using the index provided for those not modified.
+
+    :param project_folder: Absolute path to the project folder.
+    :param index: Dictionary with relative path of each folder as key and its modification
+        time, files and subfolders as values.
+
+    :returns: Tuple with the updated index and the number of folders listed (but info).
+    """
+    new_index = {}
+    listed = 0
+    now = time.time()
+    pending = ['']
+    while pending:
+        rel_path = pending.pop()
+        path = os.path.join(project_folder, rel_path)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            continue
+
+        entry = index.get(rel_path)
+        if not entry or entry['mtime'] != mtime:
+            files = []
+            folders = []
+            try:
+                with os.scandir(path) as entries:
+                    for each_entry in entries:
+                        try:
+                            if each_entry.is_dir(follow_symlinks=False):
+                                folders.append(each_entry.name)
+                            elif not each_entry.is_dir():
+                                files.append(each_entry.name)
+                        except OSError:
+                            continue
+            except OSError:
+                continue
+
+            if now - mtime / 1e9 < racy_seconds:
+                mtime = -1
+            entry = {'mtime': mtime, 'files': sorted(files), 'dirs': sorted(folders)}
+            ## info folder changes each time the index is saved
+            if rel_path != 'info':
+                listed += 1
+
+        new_index[rel_path] = entry
+        pending.extend(os.path.join(rel_path, folder) for folder in entry['dirs'])
+
+    return (new_index, listed)
+
+############
+def list_files(project_folder, debug=False):
+    """Returns absolute path of all files within the project folder, updating the index of the project."""
+    project_folder = os.path.abspath(project_folder)
+    with index_lock:
+        if project_folder not in project_indexes:
+            project_indexes[project_folder] = read_index(project_folder)
+
+        start = time.time()
+        (index, listed) = scan_folder(project_folder, project_indexes[project_folder])
+        project_indexes[project_folder] = index
+        if listed:
+            write_index(project_folder, index)
+
+        if debug:
+            HCGB_aes.debug_message("Index of %s: %s folders (%s listed again) in %.2f s" %(
+                project_folder, len(index), listed, time.time() - start), "yellow")
+
+    return ([ os.path.join(project_folder, folder, each_file)
+              for folder in sorted(index) for each_file in index[folder]['files'] ])
+
+############
+def get_samples_names(options):
+    """Returns list of sample names to include or exclude and whether to exclude them, as in HCGB.sampleParser.files.get_files"""
+    if options.in_sample:
+        sample_option = options.in_sample
+        exclude = False
+    elif options.ex_sample:
+        sample_option = options.ex_sample
+        exclude = True
+    else:
+        return (['.*'], False)
+
+    if os.path.isfile(os.path.abspath(sample_option)): ## a file
+        samples_names = [line.rstrip('\n') for line in open(os.path.abspath(sample_option))]
+    else: ## a single ID
+        samples_names = [sample_option]
+
+    if options.debug:
+        HCGB_aes.debug_message("project_index.get_files %s sample list" %('exclude' if exclude else 'include'), "yellow")
+        print (samples_names, '\n')
+
+    return (list(filter(None, samples_names)), exclude)
+
+############
+def get_files(options, input_dir, mode, extension, debug, append_discard_list=()):
+    """Retrieves samples for the mode and extensions provided using the index of the project.
+
+    It returns the same dataframe as ``HCGB.sampleParser.files.get_files``, which is called
+    instead if input is not a project folder (``options.project``) or it is a batch file.
+
+    :param options: Options provided (project, batch, in_sample, ex_sample, pair...).
+    :param input_dir: Absolute path to the project folder.
+    :param mode: trim, assembly, annot, profile, ident, mash...
+    :param extension: List of extensions (or patterns for trim mode) to retrieve.
+    :param debug: True/False for debugging messages.
+    :param append_discard_list: Additional patterns to discard files.
+
+    :returns: Dataframe with samples information.
+    """
+    if not options.project or options.batch:
+        if append_discard_list:
+            return (sampleParser.files.get_files(options=options, input_dir=input_dir, mode=mode,
+                                                 extension=extension, debug=debug, bam=False,
+                                                 append_discard_list=list(append_discard_list)))
+        return (sampleParser.files.get_files(options, input_dir, mode, extension, debug))
+
+    if not os.path.isdir(input_dir):
+        if debug:
+            HCGB_aes.debug_message("project_index.get_files input folder does not exist", "yellow")
+            print (input_dir)
+        HCGB_aes.raise_and_exit('Input folder does not exist or it is not readable')
+
+    all_files = list_files(input_dir, debug)
+    if mode == 'trim':
+        files = set(s for s in all_files if any(ext in s for ext in extension))
+    else:
+        files = set(s for s in all_files if any(s.endswith(ext) for ext in extension))
+
+    ## discard some files obtained
+    files = [s for s in sorted(files) if not any(d in s for d in discard_list + list(append_discard_list))]
+
+    (samples_names, exclude) = get_samples_names(options)
+
+    ## get information
+    if mode in ['fastq', 'trim', 'join']:
+        pd_samples_retrieved = sampleParser.samples.select_samples(files, samples_names, options.pair, exclude,
+                                                                   debug, options.include_lane, options.include_all)
+    else:
+        pd_samples_retrieved = sampleParser.samples.select_other_samples(options.project, files, samples_names,
+                                                                         mode, extension, exclude, debug)
+
+    ## remove duplicates & return
+    return (pd_samples_retrieved.drop_duplicates())
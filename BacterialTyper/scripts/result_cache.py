@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+############################################################
+## Jose F. Sanchez                                        ##
+## Copyright (C) 2019-2021 Lauro Sumoy Lab, IGTP, Spain   ##
+############################################################
+"""
+Cache of results generated by each step of the analysis.
+
+Each output folder contains a manifest file (:data:`manifest_name`) with an entry for
+each step successfully finished. The entry stores a key computed from the content of
+the input files, the parameters and the software version used. A step is skipped only
+if the key is still the same, so results are generated again whenever any of them change.
+
+Hashes of input files are also saved in the entry with their size and modification time,
+so later executions only read again input files modified since (see :func:`load_hashes`).
+"""
+## useful imports
+import os
+import json
+import time
+import hashlib
+import threading
+from datetime import datetime
+from termcolor import colored
+
+import HCGB.functions.aesthetics_functions as HCGB_aes
+
+## manifest file within each output folder
+manifest_name = '.manifest.json'
+
+## lock to update manifests from several threads
+manifest_lock = threading.Lock()
+
+## content hash of files already read: (path, size, mtime) -> hash
+file_hashes = {}
+
+############
+def file_hash(file_name, block_size=1048576):
+    """Returns sha256 of the content of a file. Files not modified are only read once."""
+    stat = os.stat(file_name)
+    stamp = (os.path.abspath(file_name), stat.st_size, stat.st_mtime)
+    if stamp not in file_hashes:
+        sha = hashlib.sha256()
+        with open(file_name, 'rb') as fh:
+            for block in iter(lambda: fh.read(block_size), b''):
+                sha.update(block)
+        file_hashes[stamp] = sha.hexdigest()
+    return (file_hashes[stamp])
+
+############
+def load_hashes(entry):
+    """Adds hashes of input files saved in a manifest entry to :data:`file_hashes`.
+
+    Files with the same size and modification time are not read again (see :func:`file_hash`).
+    """
+    for path, (size, mtime, sha) in entry.get('hashes', {}).items():
+        file_hashes.setdefault((path, size, mtime), sha)
+
+############
+def input_hashes(inputs):
+    """Returns dictionary of input files with size, modification time and hash to save in a manifest entry."""
+    hashes = {}
+    for each_input in inputs:
+        if each_input and os.path.isfile(each_input):
+            stat = os.stat(each_input)
+            hashes[os.path.abspath(each_input)] = (stat.st_size, stat.st_mtime, file_hash(each_input))
+    return (hashes)
+
+############
+def folder_hash(folder):
+    """Returns sha256 of the names, sizes and modification times of files within a folder.
+
+    Folders are databases (kraken2, BUSCO datasets, etc.) that might take several GB, so
+    content is not read.
+    """
+    sha = hashlib.sha256()
+    for root, dirs, files in sorted(os.walk(folder)):
+        dirs.sort()
+        for each_file in sorted(files):
+            path = os.path.join(root, each_file)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            sha.update(("%s\t%s\t%s\n" %(os.path.relpath(path, folder), stat.st_size, stat.st_mtime)).encode())
+    return (sha.hexdigest())
+
+############
+def input_signature(inputs):
+    """Returns hashes of the input files or folders provided, in the same order.
+
+    Missing inputs are reported as *missing* so that the key changes once they are available.
+    """
+    signature = []
+    for each_input in inputs:
+        if not each_input:
+            continue
+        if os.path.isdir(each_input):
+            signature.append(folder_hash(each_input))
+        elif os.path.isfile(each_input):
+            signature.append(file_hash(each_input))
+        else:
+            signature.append('missing')
+    return (signature)
+
+############
+def step_key(inputs, params, version):
+    """Returns the key for a step given input files, dictionary of parameters and software version."""
+    content = {'inputs': input_signature(inputs),
+               'params': params,
+               'version': version}
+    return (hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest())
+
+############
+def read_manifest(folder):
+    """Returns the manifest of the folder as a dictionary (empty if not available)."""
+    manifest_file = os.path.join(folder, manifest_name)
+    if not os.path.isfile(manifest_file):
+        return ({})
+    try:
+        with open(manifest_file) as fh:
+            return (json.load(fh))
+    except (ValueError, OSError):
+        print (colored("\t** Manifest file %s could not be read. Results will be generated again." %manifest_file, 'yellow'))
+        return ({})
+
+############
+def write_manifest(folder, manifest):
+    """Saves manifest in the folder. The file is replaced at once to avoid incomplete files."""
+    manifest_file = os.path.join(folder, manifest_name)
+    tmp_file = manifest_file + '.tmp' + str(os.getpid()) + '_' + str(threading.get_ident())
+    with open(tmp_file, 'w') as fh:
+        json.dump(manifest, fh, indent=2, sort_keys=True)
+    os.replace(tmp_file, manifest_file)
+
+############
+def get_key(folder, step):
+    """Returns key of a step already finished in the folder, or empty string."""
+    return (read_manifest(folder).get(step, {}).get('key', ''))
+
+############
+def check_step(folder, step, inputs, params, version, outputs=(), name='', legacy_stamp=None, debug=False):
+    """Checks whether results for a step are available and generated with the same inputs,
+    parameters and software version.
+
+    :param folder: Absolute path to the folder containing results and manifest.
+    :param step: Name of the step (e.g. kraken2, mlst).
+    :param inputs: List of input files or folders.
+    :param params: Dictionary with parameters that modify results.
+    :param version: Software version.
+    :param outputs: List of output files that must exist.
+    :param name: Sample name for messages.
+    :param legacy_stamp: Time stamp file generated by previous versions of BacterialTyper.
+        If available and no entry in manifest, results are considered valid and added to the manifest.
+    :param debug: True/False for debugging messages.
+
+    :returns: True if results can be reused; False if step must be executed.
+    """
+    entry = read_manifest(folder).get(step)
+
+    ## results generated before manifests were available
+    if not entry and legacy_stamp and os.path.isfile(legacy_stamp):
+        if all(os.path.exists(f) for f in outputs):
+            print (colored("\tA previous command generated results on: %s [%s -- %s]" %(
+                datetime.fromtimestamp(os.path.getmtime(legacy_stamp)).strftime('%Y-%m-%d %H:%M:%S'), name, step), 'yellow'))
+            save_step(folder, step, inputs, params, version, outputs)
+            return (True)
+
+    if not entry:
+        return (False)
+
+    ## input files not modified are not read again
+    load_hashes(entry)
+    key = step_key(inputs, params, version)
+    if debug:
+        HCGB_aes.debug_message("Step %s key: %s; manifest: %s" %(step, key, entry.get('key')), "yellow")
+
+    if key != entry.get('key'):
+        print (colored("\t+ Inputs, parameters or software version changed since last %s call [%s]: generating results again" %(step, name), 'yellow'))
+        return (False)
+
+    missing = [f for f in outputs if not os.path.exists(f)]
+    if missing:
+        print (colored("\t+ Results missing for %s [%s]: generating results again" %(step, name), 'yellow'))
+        if debug:
+            print (missing)
+        return (False)
+
+    ## input files touched but not modified: save current size and modification time
+    hashes = json.loads(json.dumps(input_hashes(inputs)))
+    if hashes != entry.get('hashes'):
+        with manifest_lock:
+            manifest = read_manifest(folder)
+            if step in manifest:
+                manifest[step]['hashes'] = hashes
+                write_manifest(folder, manifest)
+
+    print (colored("\tA previous command generated results on: %s [%s -- %s]" %(entry.get('date'), name, step), 'yellow'))
+    return (True)
+
+############
+def save_step(folder, step, inputs, params, version, outputs=()):
+    """Adds an entry for the step in the manifest of the folder once results are generated.
+
+    See :func:`check_step` for details on arguments.
+    """
+    entry = {'key': step_key(inputs, params, version),
+             'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+             'inputs': [os.path.abspath(f) for f in inputs if f],
+             'hashes': input_hashes(inputs),
+             'params': params,
+             'version': version,
+             'outputs': [os.path.abspath(f) for f in outputs]}
+
+    with manifest_lock:
+        manifest = read_manifest(folder)
+        manifest[step] = entry
+        write_manifest(folder, json.loads(json.dumps(manifest, default=str)))
+
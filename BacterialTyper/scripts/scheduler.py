@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+############################################################
+## Jose F. Sanchez                                        ##
+## Copyright (C) 2019-2021 Lauro Sumoy Lab, IGTP, Spain   ##
+############################################################
+"""
+Resource-aware scheduler for BacterialTyper jobs.
+
+Jobs are organized as a dependency graph (DAG). A job is sent as soon as all its
+dependencies are finished and enough CPUs and memory are available within the global
+budget provided. Among jobs ready to run, those with the longest remaining path in the
+graph (critical path) are sent first.
+
+Batches of jobs calling the same software for several samples are sent using the resource
+profile of the software (see :data:`tool_profiles` and :func:`run_batch`).
+"""
+## useful imports
+import os
+import time
+import concurrent.futures
+from termcolor import colored
+
+import HCGB.functions.aesthetics_functions as HCGB_aes
+
+## Resource profiles for each software:
+## name: (minimum threads, threads sweet spot, memory per job (GB))
+## Threads above the sweet spot do not speed up the software significantly.
+tool_profiles = {
+    'spades':       (2, 16, 16),
+    'prokka':       (2, 8, 2),
+    'fastqc':       (1, 2, 1),
+    'trimmomatic':  (2, 4, 2),
+    'kraken2':      (4, 16, 10),
+    'kma':          (1, 4, 2),
+    'mlst':         (1, 4, 1),
+    'ariba':        (1, 4, 4),
+    'amrfinder':    (1, 4, 2),
+    'snippy':       (2, 8, 4),
+    'ncbi':         (1, 1, 0.5),
+    'default':      (1, 4, 2),
+}
+
+## placeholder for the number of threads in the arguments of a batch job
+THREADS = '__threads__'
+
+############
+class job():
+    """Job to be executed within the dependency graph.
+
+    :param name: Unique name for the job.
+    :param func: Function to call. It is called as ``func(*args, threads)``.
+    :param args: List of arguments for the function.
+    :param threads: Number of CPUs required.
+    :param memory: Memory required (GB).
+    :param deps: List of job names this job depends on.
+    :param weight: Estimated relative cost of the job, used to prioritize the critical path.
+    :param allow_failed: Run the job even if some dependencies failed.
+    """
+    def __init__(self, name, func, args, threads=1, memory=1, deps=None, weight=1, allow_failed=False):
+        self.name = name
+        self.func = func
+        self.args = list(args)
+        self.threads = threads
+        self.memory = memory
+        self.deps = list(deps) if deps else []
+        self.weight = weight
+        self.allow_failed = allow_failed
+        self.status = 'PENDING'
+
+    def __repr__(self):
+        return ("job(%s, threads=%s, memory=%s, deps=%s, status=%s)" %(self.name, self.threads, self.memory, self.deps, self.status))
+
+############
+def available_memory():
+    """Returns memory available (GB) for new processes without swapping.
+
+    MemAvailable (/proc/meminfo) includes page cache that can be reclaimed. Free physical
+    pages are used if not available.
+    """
+    try:
+        with open('/proc/meminfo') as fh:
+            for line in fh:
+                if line.startswith('MemAvailable:'):
+                    return (int(line.split()[1]) / 1024**2)
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        return (os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES') / 1024**3)
+    except (ValueError, OSError, AttributeError):
+        return (8)
+
+############
+def critical_path(jobs):
+    """Returns for each job the cost of the longest path from the job to the end of the graph"""
+    children = {name: [] for name in jobs}
+    for name, each_job in jobs.items():
+        for dep in each_job.deps:
+            children[dep].append(name)
+
+    rank = {}
+    def get_rank(name):
+        if name not in rank:
+            rank[name] = jobs[name].weight + max([get_rank(child) for child in children[name]], default=0)
+        return (rank[name])
+
+    for name in jobs:
+        get_rank(name)
+    return (rank)
+
+############
+def check_graph(jobs):
+    """Checks dependencies exist and there are no cycles. Exits if any error."""
+    for name, each_job in jobs.items():
+        for dep in each_job.deps:
+            if dep not in jobs:
+                HCGB_aes.raise_and_exit("Job %s depends on %s, which is not defined" %(name, dep))
+
+    visited = {}
+    def visit(name, path):
+        if visited.get(name) == 'done':
+            return
+        if visited.get(name) == 'visiting':
+            HCGB_aes.raise_and_exit("Cycle detected in dependency graph: %s" %' -> '.join(path + [name]))
+        visited[name] = 'visiting'
+        for dep in jobs[name].deps:
+            visit(dep, path + [name])
+        visited[name] = 'done'
+
+    for name in jobs:
+        visit(name, [])
+
+############
+def run_graph(job_list, max_threads, max_memory=None, debug=False):
+    """Executes jobs following dependencies within a CPU and memory budget.
+
+    A job requiring more resources than the budget is resized to the budget. Jobs depending
+    on a failed job are skipped unless they allow failed dependencies.
+
+    :param job_list: List of :class:`job`.
+    :param max_threads: Total number of CPUs available.
+    :param max_memory: Total memory available (GB). Default: physical memory.
+    :param debug: Boolean for debugging messages.
+
+    :returns: Dictionary with status (OK, FAIL, SKIPPED) for each job.
+    """
+    jobs = { each_job.name: each_job for each_job in job_list }
+    check_graph(jobs)
+
+    if not max_memory:
+        max_memory = available_memory()
+    max_threads = max(1, int(max_threads))
+
+    for each_job in jobs.values():
+        each_job.threads = max(1, min(int(each_job.threads), max_threads))
+        each_job.memory = min(each_job.memory, max_memory)
+
+    rank = critical_path(jobs)
+    free_threads = max_threads
+    free_memory = max_memory
+    running = {}
+
+    if debug:
+        HCGB_aes.debug_message("Jobs: %s; CPUs: %s; memory: %.1f GB" %(len(jobs), max_threads, max_memory), "yellow")
+        for name in sorted(jobs, key=lambda x: -rank[x]):
+            print ("\t%s [rank: %s]" %(jobs[name], rank[name]))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_threads) as executor:
+        while True:
+            ## skip jobs with failed dependencies
+            for each_job in jobs.values():
+                if each_job.status != 'PENDING' or each_job.allow_failed:
+                    continue
+                if any(jobs[dep].status in ('FAIL', 'SKIPPED') for dep in each_job.deps):
+                    each_job.status = 'SKIPPED'
+                    print (colored("\t- Skip job %s: some dependencies failed" %each_job.name, 'yellow'))
+
+            ## jobs ready to run sorted by critical path
+            ready = [ each_job for each_job in jobs.values() if each_job.status == 'PENDING'
+                     and all(jobs[dep].status in ('OK', 'FAIL', 'SKIPPED') for dep in each_job.deps) ]
+            ready.sort(key=lambda x: -rank[x.name])
+
+            for each_job in ready:
+                if each_job.threads > free_threads or each_job.memory > free_memory:
+                    continue
+
+                free_threads -= each_job.threads
+                free_memory -= each_job.memory
+                each_job.status = 'RUNNING'
+                each_job.start = time.time()
+                print ("+ Sending job %s [CPUs: %s; memory: %s GB]" %(each_job.name, each_job.threads, each_job.memory))
+                running[executor.submit(each_job.func, *each_job.args, each_job.threads)] = each_job
+
+            if not running:
+                break
+
+            done, not_done = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                each_job = running.pop(future)
+                free_threads += each_job.threads
+                free_memory += each_job.memory
+                try:
+                    code = future.result()
+                except Exception as exc:
+                    print ('***ERROR:')
+                    print('%r generated an exception: %s' % (each_job.name, exc))
+                    code = 'FAIL'
+
+                each_job.status = 'FAIL' if code == 'FAIL' else 'OK'
+                print (colored("+ Job %s finished [%s] in %.1f s" %(each_job.name, each_job.status, time.time() - each_job.start),
+                               'green' if each_job.status == 'OK' else 'red'))
+
+    return ({ name: each_job.status for name, each_job in jobs.items() })
+
+############
+def is_threads(value):
+    """Returns True if the argument is the :data:`THREADS` placeholder (arguments might be dataframes, lists...)"""
+    return (isinstance(value, str) and value == THREADS)
+
+############
+def threads_batch(tool, free_threads, free_memory, pending, min_threads=None):
+    """Returns number of threads for the next job of a batch.
+
+    Free CPUs are split among the jobs that could run at the same time (limited by pending
+    jobs and memory available) within the thresholds of the software profile. Near the
+    tail of a batch, fewer jobs remain and each of them gets more CPUs. Jobs never get
+    fewer threads than min_threads (default: profile minimum): the caller waits until
+    enough CPUs are free.
+    """
+    (min_profile, sweet_spot, memory) = tool_profiles.get(tool, tool_profiles['default'])
+    if min_threads is None:
+        min_threads = min_profile
+    min_threads = max(1, min_threads)
+    slots = min(pending, max(1, int(free_memory // memory)), max(1, free_threads // min_threads))
+    return (max(min_threads, min(sweet_spot, free_threads // max(1, slots))))
+
+############
+def run_batch(tool, func, dict_args, max_threads, debug=False, max_memory=None, memory=None, max_jobs=None):
+    """Calls the same function for several samples using the resource profile of the software.
+
+    Jobs are admitted if enough memory is available according to the profile (see
+    :data:`tool_profiles`) and the number of threads for each job is set when the job is
+    sent (see :func:`threads_batch`), so that CPUs freed by finished jobs are assigned to
+    the remaining jobs.
+
+    :param tool: Software name in :data:`tool_profiles`.
+    :param func: Function to call for each sample.
+    :param dict_args: Dictionary with sample names as keys and a list (positional) or dictionary 
+        (keyword) of arguments as values. :data:`THREADS` is replaced by the threads for the job.
+    :param max_threads: Total number of CPUs available.
+    :param debug: Boolean for debugging messages.
+    :param max_memory: Total memory available (GB). Default: physical memory.
+    :param memory: Memory required by each job (GB), if known (e.g. database size). Default: software profile.
+    :param max_jobs: Maximum number of jobs running at the same time. Default: no limit.
+
+    :returns: Dictionary with the result of each sample or *FAIL* if an exception was raised.
+    """
+    if not max_memory:
+        max_memory = available_memory()
+    max_threads = max(1, int(max_threads))
+    if not memory:
+        memory = tool_profiles.get(tool, tool_profiles['default'])[2]
+    memory = min(memory, max_memory)
+    max_jobs = max(1, int(max_jobs or len(dict_args)))
+    ## jobs wait for the minimum threads of the profile (or all CPUs, if fewer)
+    min_threads = min(tool_profiles.get(tool, tool_profiles['default'])[0], max_threads)
+
+    pending = list(dict_args)
+    results = {}
+    running = {}
+    free_threads = max_threads
+    free_memory = max_memory
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_threads) as executor:
+        while pending or running:
+            while pending and free_threads >= min_threads and memory <= free_memory and len(running) < max_jobs:
+                threads_job = threads_batch(tool, free_threads, free_memory, min(len(pending), max_jobs - len(running)), min_threads)
+                name = pending.pop(0)
+                args = dict_args[name]
+                if isinstance(args, dict):
+                    kwargs = { key: (threads_job if is_threads(value) else value) for key, value in args.items() }
+                    future = executor.submit(func, **kwargs)
+                else:
+                    future = executor.submit(func, *[ threads_job if is_threads(value) else value for value in args ])
+
+                if debug:
+                    HCGB_aes.debug_message("%s job %s: threads: %s; memory: %s GB; free CPUs: %s; pending: %s" %(
+                        tool, name, threads_job, memory, free_threads - threads_job, len(pending)), "yellow")
+
+                running[future] = (name, threads_job)
+                free_threads -= threads_job
+                free_memory -= memory
+
+            done, not_done = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                (name, threads_job) = running.pop(future)
+                free_threads += threads_job
+                free_memory += memory
+                try:
+                    results[name] = future.result()
+                except Exception as exc:
+                    print ('***ERROR:')
+                    print (future)
+                    print('%r generated an exception: %s' % (name, exc))
+                    results[name] = 'FAIL'
+
+    return (results)
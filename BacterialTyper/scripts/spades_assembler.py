@@ -15,11 +15,11 @@ from sys import argv
 from io import open
 from Bio import SeqIO
 import shutil
-from termcolor import colored
 
 ## import my modules
 from BacterialTyper.config import set_config
 from BacterialTyper.scripts import assembly_stats_caller
+from BacterialTyper.scripts import result_cache
 
 import HCGB.functions.time_functions as HCGB_time
 import HCGB.functions.main_functions as HCGB_main
@@ -91,13 +91,15 @@ def run_SPADES_assembly(path, file1, file2, sample, SPADES_bin, threads, debug=F
 def SPADES_systemCall(sample_folder, file1, file2, name, SPADES_bin, options, threads, debug=False):
 	"""Generate SPADES system call.
 	
-	It calls system for SPADES and generates time stamp file in the folder provided (sample_folder + '/.success_assembly') for later analysis.
+	It calls system for SPADES and saves the step in the manifest of the folder provided (see :mod:`BacterialTyper.scripts.result_cache`) for later analysis.
 	
 	Steps:
 	
+	- It checks whether reads, options and SPADES version changed since a previous assembly. 
+	
 	- It generates system call for SPADES assembly. 
 	
-	- It generates timestamp file.
+	- It saves the step in the manifest.
 	
 	:param sample_folder: Absolute path to store results. It must exists.
 	:param file1: Absolute path to fastq reads (R1).
@@ -123,14 +125,15 @@ def SPADES_systemCall(sample_folder, file1, file2, name, SPADES_bin, options, th
 	
 		- :func:`HCGB.functions.main_functions.system_call`
 	
-		- :func:`HCGB.functions.time_functions.print_time_stamp`
+		- :func:`BacterialTyper.scripts.result_cache.check_step`
 	"""
 	
-	## check if previously assembled and succeeded
-	filename_stamp = sample_folder + '/.success_assembly'
-	if os.path.isfile(filename_stamp):
-		stamp =	HCGB_time.read_time_stamp(filename_stamp)
-		print (colored("\tA previous command generated results on: %s [%s]" %(stamp, name), 'yellow'))
+	## check if previously assembled and succeeded with same reads, options and version
+	SPADES_version = set_config.get_version('spades', SPADES_bin, Debug=debug)
+	params = {'options': options}
+	outputs = [os.path.join(sample_folder, 'scaffolds.fasta')]
+	if result_cache.check_step(sample_folder, 'spades', [file1, file2], params, SPADES_version, outputs=outputs, 
+							name=name, legacy_stamp=sample_folder + '/.success_assembly', debug=debug):
 		return('OK')
 
 	## call system for SPADES sample given
@@ -142,9 +145,8 @@ def SPADES_systemCall(sample_folder, file1, file2, name, SPADES_bin, options, th
 	code = HCGB_sys.system_call(cmd_SPADES)
 	
 	if (code == 'OK'):
-		## success stamps
-		filename_stamp = sample_folder + '/.success_assembly'
-		stamp =	HCGB_time.print_time_stamp(filename_stamp)
+		## save step in manifest
+		result_cache.save_step(sample_folder, 'spades', [file1, file2], params, SPADES_version, outputs=outputs)
 		return('OK')
 
 	return "FAIL"
@@ -173,8 +175,8 @@ def run_module_assembly(name, folder, file1, file2, threads, debug=False):
 	:type file1: string
 	:type file2: string
 	:type threads: integer
-	:return: Assembly statistics file.
-	:rtype: string : Path to file assembly statistics file.
+	:return: Assembly statistics dictionary and assembly fasta file.
+	:rtype: list
 	:warnings: Returns **FAIL** if assembly process stopped.
 	
 	.. seealso:: This function depends on other BacterialTyper functions called:
@@ -206,8 +208,8 @@ def run_module_assembly(name, folder, file1, file2, threads, debug=False):
 		(stats_dict, excel_file) = contig_stats(path_to_contigs, debug)
 	
 		## check statistics in file
-		print ("+ Check statistics for sample %s in file:\n\t%s" %(name, excel_file))
-		return([stats_dict, excel_file])
+		print ("+ Check statistics for sample %s in file:\n\t%s" %(name, path_to_contigs.split(".fna")[0] + '-contigs.csv'))
+		return([stats_dict, path_to_contigs])
 
 
 ################################################
@@ -215,7 +217,8 @@ def run_module_assembly(name, folder, file1, file2, threads, debug=False):
 def contig_stats(assembly_file, debug):
 	"""Generate assembly statistics
 	
-	Create assembly statistics using the script assembly_stats_caller and pip module assembly_stats
+	Create assembly statistics using the script assembly_stats_caller (See :func:`BacterialTyper.scripts.assembly_stats_caller.assembly_stats_caller`).
+	Statistics previously generated for the same assembly are reused (See :func:`BacterialTyper.scripts.assembly_stats_caller.sample_stats`).
 	
 	:param assembly_file: Absolute path to assembly fasta file.
 	:type assembly_file: string
@@ -226,8 +229,8 @@ def contig_stats(assembly_file, debug):
 	
 	"""
 	name_file_list = assembly_file.split(".fna")
-	info = assembly_stats_caller.assembly_stats_caller(assembly_file, name_file_list[0], debug)
-	return (info)	
+	stats_dict = assembly_stats_caller.sample_stats(assembly_file, name_file_list[0])
+	return (stats_dict, None)	
 
 ################################################
 def	help_options():
@@ -12,13 +12,16 @@ import io
 import os
 import re
 import sys
+import shutil
 from sys import argv
 from io import open
 from termcolor import colored
+from Bio import SeqIO
 
 ## import my modules
 from BacterialTyper.config import set_config
 import HCGB.functions.system_call_functions as HCGB_sys
+import HCGB.functions.time_functions as HCGB_time
 
 ## https://pyvcf.readthedocs.io/en/latest/
 
@@ -41,7 +44,7 @@ def parse_snippy_files(folder_results):
 	return ()
 
 ##############################
-def snippy_call(reference_fasta, list_files, threads, outdir, name, contig_option, other_options, Debug):
+def snippy_call(reference_fasta, list_files, threads, outdir, name, contig_option, other_options, Debug, bam_file=None):
 	"""
 	Creates variant calling for a sample vs. a reference.
 	
@@ -59,6 +62,7 @@ def snippy_call(reference_fasta, list_files, threads, outdir, name, contig_optio
 	:param contig_option: True/false to map contigs provided instead of files. Contigs provided via list_files.
 	:param other_options: String of options to include in snippy call
 	:param Debug: True/false for debugging messages
+	:param bam_file: BAM file previously generated (see :func:`map_reads`) to use instead of aligning reads.
 	
 	:type reference_fasta: string
 	:type list_files: list
@@ -68,6 +72,7 @@ def snippy_call(reference_fasta, list_files, threads, outdir, name, contig_optio
 	:type contig_options: bool
 	:type other_options: string
 	:type Debug: bool
+	:type bam_file: string
 	"""
 	
 	## create snippy call
@@ -82,7 +87,9 @@ def snippy_call(reference_fasta, list_files, threads, outdir, name, contig_optio
 	## unmapped option: keep unmapped reads
 	
 	## add files to map
-	if contig_option:
+	if bam_file:
+		snippy_cmd = snippy_cmd + ' --bam ' + bam_file
+	elif contig_option:
 		snippy_cmd = snippy_cmd + ' --ctgs ' + list_files[0]
 	else:
 		if (len(list_files) == 1):
@@ -104,6 +111,103 @@ def snippy_call(reference_fasta, list_files, threads, outdir, name, contig_optio
 	## create system call
 	return(HCGB_sys.system_call(snippy_cmd, returned=False, message=True))
 
+###############################
+def prepare_reference(reference, outdir, Debug):
+	"""
+	Prepares reference for mapping once to be shared by all samples.
+	
+	Extracts FASTA sequences from the GenBank reference, named after the LOCUS name as snippy 
+	does, and creates samtools and bwa indexes in ``outdir``. 
+	
+	:param reference: Absolute path to reference GenBank (or FASTA) file.
+	:param outdir: Output folder.
+	:param Debug: True/false for debugging messages
+	
+	:type reference: string
+	:type outdir: string
+	:type Debug: bool
+	
+	:returns: Absolute path to reference FASTA file indexed or False if failed.
+	"""
+	ref_fasta = os.path.join(outdir, 'ref.fa')
+	filename_stamp = os.path.join(outdir, '.success')
+	if os.path.isfile(filename_stamp):
+		stamp = HCGB_time.read_time_stamp(filename_stamp)
+		print (colored("\tA previous command generated results on: %s [reference]" %stamp, 'yellow'))
+		return (ref_fasta)
+	
+	## extract fasta
+	if reference.endswith(('.fa', '.fasta', '.fna')):
+		shutil.copy(reference, ref_fasta)
+	else:
+		with open(ref_fasta, 'w') as fh:
+			for record in SeqIO.parse(reference, 'genbank'):
+				fh.write('>%s\n%s\n' %(record.name, str(record.seq)))
+	
+	## create indexes
+	samtools_exe = set_config.get_exe('samtools', Debug)
+	bwa_exe = set_config.get_exe('bwa', Debug)
+	log_file = os.path.join(outdir, "index_cmd.log")
+	
+	for cmd in ['%s faidx %s 2>> %s' %(samtools_exe, ref_fasta, log_file), 
+				'%s index %s 2>> %s' %(bwa_exe, ref_fasta, log_file)]:
+		if (Debug):
+			print (colored("**DEBUG: index cmd **", 'yellow'))
+			print (cmd)
+		code = HCGB_sys.system_call(cmd, returned=False, message=True)
+		if code != 'OK':
+			return (False)
+	
+	HCGB_time.print_time_stamp(filename_stamp)
+	return (ref_fasta)
+
+###############################
+def map_reads(ref_fasta, list_files, threads, outdir, name, Debug):
+	"""
+	Maps reads to a reference previously indexed using :func:`prepare_reference`.
+	
+	Reads are aligned using bwa mem and sorted using samtools. The BAM file generated can be
+	provided to snippy (:func:`snippy_call`) so the reference is not indexed again for each sample.
+	
+	:param ref_fasta: Absolute path to reference fasta file indexed.
+	:param list_files: List of absolute path to fastq files (single end or paired-end).
+	:param threads: Number of CPU cores to use.
+	:param outdir: Output folder.
+	:param name: Name of the sample
+	:param Debug: True/false for debugging messages
+	
+	:returns: Absolute path to BAM file or False if failed.
+	"""
+	if not list_files or len(list_files) > 2:
+		print(colored("** ERROR: No reads provided...", "red"))
+		return (False)
+	
+	samtools_exe = set_config.get_exe('samtools', Debug)
+	bwa_exe = set_config.get_exe('bwa', Debug)
+	
+	bam_file = os.path.join(outdir, name + '.bam')
+	log_file = os.path.join(outdir, "bwa_cmd.log")
+	read_group = "'@RG\\tID:%s\\tSM:%s'" %(name, name)
+	
+	map_cmd = '%s mem -t %s -R %s %s %s 2> %s | %s sort -@ %s -o %s - 2>> %s' %(
+		bwa_exe, threads, read_group, ref_fasta, " ".join(list_files), log_file,
+		samtools_exe, threads, bam_file, log_file)
+	
+	## debug message
+	if (Debug):
+		print (colored("**DEBUG: map_cmd **", 'yellow'))	
+		print (map_cmd)
+	
+	code = HCGB_sys.system_call(map_cmd, returned=False, message=True)
+	if code != 'OK':
+		return (False)
+	
+	code = HCGB_sys.system_call('%s index %s' %(samtools_exe, bam_file), returned=False, message=True)
+	if code != 'OK':
+		return (False)
+	
+	return (bam_file)
+
 ###############################
 def snippy_core_call(list_folder, options, name, output_dir, output_format, Debug):
 	"""
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+##########################################################
+## Jose F. Sanchez                                      ##
+## Copyright (C) 2019 Lauro Sumoy Lab, IGTP, Spain      ##
+##########################################################
+'''
+Benchmark cold vs. warm runs of the cluster module using the signature store.
+
+Cluster is called on a temporary database folder linking all entries of the database
+provided but the signature store (*mash_store*), so the store of the database is never
+modified: the cold run starts with an empty store and warm runs reuse it. Similarity
+values saved by previous runs (*.previous_matrix.npz*) are moved aside before each run,
+and restored once finished, so all runs compare every sample. Any additional argument is
+passed to cluster.
+
+Usage:
+    python devel/benchmark/benchmark_cluster_cache.py -i project_folder -db database_folder [--runs 2] [cluster options]
+'''
+import time
+import os
+import glob
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+##################################################
+def run_cluster(input_folder, database, extra_args):
+    cmd = ['BacterialTyper', 'cluster', '-i', input_folder, '-db', database] + extra_args
+    start = time.time()
+    subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+    return (time.time() - start)
+
+##################################################
+def temp_database(database):
+    """Returns a temporary folder linking all entries of the database but the signature store"""
+    tmp_database = tempfile.mkdtemp(prefix='benchmark_db_')
+    for entry in os.listdir(database):
+        if entry != 'mash_store':
+            os.symlink(os.path.join(database, entry), os.path.join(tmp_database, entry))
+    return (tmp_database)
+
+##################################################
+def hide_previous_matrix(input_folder, hidden):
+    """Moves similarity values saved by previous runs to the hidden folder"""
+    for matrix_file in glob.glob(os.path.join(input_folder, '**', '.previous_matrix.npz'), recursive=True):
+        hidden_file = os.path.join(hidden, str(len(os.listdir(hidden))) + '.npz')
+        os.replace(matrix_file, hidden_file)
+        with open(hidden_file + '.path', 'w') as fh:
+            fh.write(matrix_file)
+
+##################################################
+def restore_previous_matrix(hidden):
+    """Restores similarity values moved by :func:`hide_previous_matrix`"""
+    for path_file in glob.glob(os.path.join(hidden, '*.path')):
+        with open(path_file) as fh:
+            shutil.move(path_file[:-len('.path')], fh.read())
+
+##################################################
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark cold vs warm cluster runs")
+    parser.add_argument("-i", "--input", required=True, help="Project folder.")
+    parser.add_argument("-db", "--database", required=True, help="Database folder.")
+    parser.add_argument("--runs", type=int, default=2, help="Number of warm runs.")
+    (args, extra_args) = parser.parse_known_args()
+
+    if not extra_args:
+        extra_args = ['--all_data']
+
+    database = os.path.abspath(args.database)
+    tmp_database = temp_database(database)
+    hidden = tempfile.mkdtemp(prefix='benchmark_matrix_')
+    try:
+        print ("run\ttime (s)")
+        hide_previous_matrix(args.input, hidden)
+        print ("cold\t%.2f" %run_cluster(args.input, tmp_database, extra_args))
+        for i in range(args.runs):
+            ## matrix of the previous run is discarded: only the store is reused
+            for matrix_file in glob.glob(os.path.join(args.input, '**', '.previous_matrix.npz'), recursive=True):
+                os.remove(matrix_file)
+            print ("warm_%i\t%.2f" %(i + 1, run_cluster(args.input, tmp_database, extra_args)))
+    finally:
+        for matrix_file in glob.glob(os.path.join(args.input, '**', '.previous_matrix.npz'), recursive=True):
+            os.remove(matrix_file)
+        restore_previous_matrix(hidden)
+        shutil.rmtree(hidden, ignore_errors=True)
+        shutil.rmtree(tmp_database, ignore_errors=True)
+
+##################################################
+if __name__== "__main__":
+    main()
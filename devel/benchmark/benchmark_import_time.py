@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+##########################################################
+## Jose F. Sanchez                                      ##
+## Copyright (C) 2019 Lauro Sumoy Lab, IGTP, Spain      ##
+##########################################################
+'''
+Benchmark start up (import) time of BacterialTyper subcommands using python -X importtime.
+
+For each command it reports the total import time and the heavy third-party packages
+loaded. It exits with an error if any command takes longer than --max_ms or if a light
+command (help, config, prep, version...) loads any heavy package, so regressions in
+lazy loading are caught.
+
+Usage:
+    python devel/benchmark/benchmark_import_time.py [--runs 3] [--max_ms 1500] [--module ident ...]
+'''
+import os
+import re
+import sys
+import argparse
+import subprocess
+
+main_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'main', 'BacterialTyper')
+
+## packages that must only be loaded by the modules using them
+heavy_packages = ['matplotlib', 'scipy', 'sourmash', 'ete3', 'PhiSpyModules', 'spaTyper',
+                  'networkx', 'card_trick', 'ncbi_genome_download', 'pylab']
+
+## subcommands that must not load any heavy package
+light_commands = [['--help'], ['config', '--help'], ['prep', '--help'], ['version', 'only'], ['citation', 'only']]
+
+## modules within BacterialTyper.modules
+modules = ['annot', 'assemble', 'citation', 'cluster', 'config', 'database', 'ident', 'help_info',
+           'MGE', 'phylo', 'profile', 'prep', 'qc', 'run', 'report_generation', 'trim', 'version']
+
+##################################################
+def import_time(cmd):
+    """Returns total import time (ms) and top-level packages imported for the python arguments provided.
+    Exits if the command fails."""
+    proc = subprocess.run([sys.executable, '-X', 'importtime'] + cmd,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    total = 0
+    packages = set()
+    for line in proc.stderr.splitlines():
+        hits = re.match(r'import time:\s+(\d+)\s+\|\s+(\d+)\s+\|( *)(\S+)', line)
+        if not hits:
+            continue
+        packages.add(hits.group(4).split('.')[0])
+        if len(hits.group(3)) == 1: ## top level import (nested imports are indented)
+            total += int(hits.group(2))
+
+    if proc.returncode:
+        print ("ERROR: command failed: %s\n%s" %(' '.join(cmd), proc.stderr.splitlines()[-1]))
+        sys.exit(1)
+    return (total / 1000, packages)
+
+##################################################
+def benchmark(cmd, runs):
+    """Returns best import time (ms) among runs and heavy packages loaded."""
+    results = [ import_time(cmd) for i in range(runs) ]
+    best = min(time_ms for time_ms, packages in results)
+    heavy = sorted(set(heavy_packages).intersection(results[0][1]))
+    return (best, heavy)
+
+##################################################
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark import time of BacterialTyper subcommands")
+    parser.add_argument("--runs", type=int, default=3, help="Number of runs for each command. Best time is reported.")
+    parser.add_argument("--max_ms", type=float, help="Maximum import time allowed (ms) for light commands.")
+    parser.add_argument("--module", nargs='*', default=modules, help="Modules to import. [Default: all]")
+    args = parser.parse_args()
+
+    errors = []
+    print ("command\ttime (ms)\theavy packages")
+    for cmd in light_commands:
+        name = 'BacterialTyper ' + ' '.join(cmd)
+        (best, heavy) = benchmark([main_script] + cmd, args.runs)
+        print ("%s\t%.1f\t%s" %(name, best, ','.join(heavy)))
+        if heavy:
+            errors.append("%s loads heavy packages: %s" %(name, ','.join(heavy)))
+        if args.max_ms and best > args.max_ms:
+            errors.append("%s takes %.1f ms (max: %.1f ms)" %(name, best, args.max_ms))
+
+    for module in args.module:
+        name = 'import BacterialTyper.modules.' + module
+        (best, heavy) = benchmark(['-c', name], args.runs)
+        print ("%s\t%.1f\t%s" %(name, best, ','.join(heavy)))
+
+    if errors:
+        print ("\n" + "\n".join(errors))
+        sys.exit(1)
+
+##################################################
+if __name__== "__main__":
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+##########################################################
+## Jose F. Sanchez                                      ##
+## Copyright (C) 2019 Lauro Sumoy Lab, IGTP, Spain      ##
+##########################################################
+'''
+Benchmark all-vs-all MinHash comparison: python loop (sourmash similarity per pair)
+vs. vectorized engine in :func:`BacterialTyper.scripts.min_hash_caller.similarity_matrix`.
+
+Usage:
+    python devel/benchmark/benchmark_mash_compare.py [--sizes 100,1000,5000] [--threads 4] [--skip_loop 1000]
+'''
+import time
+import argparse
+import random
+import numpy
+import sourmash
+
+from BacterialTyper.scripts import min_hash_caller
+
+##################################################
+def synthetic_signatures(n, num_sketch, n_groups=10, seed=123):
+    """Generate signatures sharing hashes within groups to simulate related genomes"""
+    random.seed(seed)
+    groups = [ [random.getrandbits(64) for _ in range(num_sketch * 2)] for _ in range(n_groups) ]
+    siglist = []
+    for i in range(n):
+        base = groups[i % n_groups]
+        hashes = random.sample(base, num_sketch) + [random.getrandbits(64) for _ in range(num_sketch // 4)]
+        mh = sourmash.MinHash(n=num_sketch, ksize=51)
+        mh.add_many(hashes)
+        siglist.append(sourmash.SourmashSignature(mh, name='sample_' + str(i)))
+    return (siglist)
+
+##################################################
+def loop_matrix(siglist):
+    """Previous implementation: nested loop calling similarity for each pair"""
+    D = numpy.zeros([len(siglist), len(siglist)])
+    for i, E in enumerate(siglist):
+        for j, E2 in enumerate(siglist):
+            if i < j:
+                continue
+            similarity = E.similarity(E2, False)
+            D[i][j] = similarity
+            D[j][i] = similarity
+    return (D)
+
+##################################################
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark MinHash all-vs-all comparison")
+    parser.add_argument("--sizes", default="100,1000,5000", help="Comma separated number of signatures.")
+    parser.add_argument("--n_sketch", type=int, default=5000, help="Sketch size.")
+    parser.add_argument("--threads", type=int, default=1, help="Number of CPUs for vectorized engine.")
+    parser.add_argument("--skip_loop", type=int, default=1000, help="Do not run python loop above this number of signatures.")
+    args = parser.parse_args()
+
+    print ("n\tloop (s)\tvectorized (s)\tspeedup\tmax_diff")
+    for n in [int(x) for x in args.sizes.split(',')]:
+        siglist = synthetic_signatures(n, args.n_sketch)
+
+        start = time.time()
+        D_vec = min_hash_caller.similarity_matrix(siglist, args.threads)
+        time_vec = time.time() - start
+
+        if n > args.skip_loop:
+            print ("%i\tNA\t%.2f\tNA\tNA" %(n, time_vec))
+            continue
+
+        start = time.time()
+        D_loop = loop_matrix(siglist)
+        time_loop = time.time() - start
+
+        print ("%i\t%.2f\t%.2f\t%.1fx\t%.2e" %(n, time_loop, time_vec, time_loop/max(time_vec, 1e-9), numpy.abs(D_loop - D_vec).max()))
+
+##################################################
+if __name__== "__main__":
+    main()